@@ -5,8 +5,24 @@ from datetime import datetime
 from bs4 import BeautifulSoup
 import wikifunctions as wf
 import re
-#import argparse
+import argparse
+import json
+import sqlite3
 from pathlib import Path
+import wikihelpers as wiki
+import wikimetrics
+import wikiprofile
+import wikistore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--incremental', action='store_true', help='Only read the daily logs created or edited since the last run (see refresh_recent_logs), and append to the monthly case files.')
+parser.add_argument('--lookback-days', type=int, default=14, help='With --incremental, how many days before the high-water mark to re-check for edits (relists, closes).')
+parser.add_argument('--log-links', type=str, default=None, help='The log link file to use (e.g., ./../log_links_20250624_145626.tsv); asked for if not given.')
+parser.add_argument('--export-index', action='store_true', help='Write the discussion index (one row per discussion, with its first and last log dates and relist count) to ./../deletion_cases_index.tsv and stop.')
+parser.add_argument('--shard', type=str, default=None, help='Only read the daily logs in shard i/N (by a stable hash of the log link; case titles are not known until the logs are read), writing to deletion_cases/shard_i_of_N; combine the shards with merge_shards.py. Not used with --incremental.')
+parser.add_argument('--profile', action='store_true', help='Read a random sample of daily logs (see --profile-sample) under cProfile and tracemalloc, write the report to ./../profiles, and stop.')
+parser.add_argument('--profile-sample', type=int, default=20, help='How many daily logs --profile samples.')
+parser.add_argument('--metrics', type=str, default=None, help='File (relative to the parent directory) to write request/parse metrics to every 30 seconds while running; JSON, or Prometheus text if it ends in .prom.')
 
 def extract_date_link(link):
     match = re.search(r'/Log/(\d{4}) (\w+) (\d{1,2})', link.get_text())
@@ -64,11 +80,13 @@ def get_deletion_cases(log_page_link, case_list_output):
     # open log page and soup it
     title = log_page_link[6:]
     #print(title)
-    soup = BeautifulSoup( wf.get_page_raw_content(title), features="html.parser")
+    page_html = wf.get_page_raw_content(title)
+    with wikimetrics.timer('parse.daily_log'):
+        soup = BeautifulSoup( page_html, features="html.parser")
 
-    # get all the deletion cases for that day
-    # block > boilerplate afd vfd xfd-closed archived
-    cases = soup.find_all("div", class_=lambda classes: classes and 'boilerplate' in classes)
+        # get all the deletion cases for that day
+        # block > boilerplate afd vfd xfd-closed archived
+        cases = soup.find_all("div", class_=lambda classes: classes and 'boilerplate' in classes)
 
     # case title > mw-heading mw-heading3
     for c in cases[1:]:
@@ -93,7 +111,264 @@ def get_deletion_cases(log_page_link, case_list_output):
 
         case_list_output.append(formatted_case)
 
+months = ["January", "February", "March", "April", "May", "June","July", "August", "September", "October", "November", "December"]
+
+months_to_numbers = {"January": "01", "February": "02", "March": "03", "April": "04", "May": "05", "June": "06", "July": "07", "August": "08", "September": "09", "October": "10", "November": "11", "December": "12"}
+
+CASE_COLUMNS = ["log_link", "case_title", "case_discussion_url", "multiple_noms"]
+
+"""
+relists: a relisted discussion shows up on several daily logs; the case index keeps one row per (discussion, log)
+listing, and the monthly case files only keep a discussion's first listing
+"""
+CASE_INDEX_FILE = "_case_index.sqlite"
+
+LOG_DATE_RE = re.compile(r'/Log/(\d{4})[_ ](\w+)[_ ](\d{1,2})')
+
+def log_link_date(log_link):
+    """
+    The date of a daily log from its link, as YYYY-MM-DD, or None if the link isn't a dated log.
+    """
+    match = LOG_DATE_RE.search(str(log_link))
+    if not match or match.group(2) not in months_to_numbers:
+        return None
+    return f"{match.group(1)}-{months_to_numbers[match.group(2)]}-{int(match.group(3)):02d}"
+
+def open_case_index(index_file):
+    """
+    The persistent index of discussion listings. The `discussions` view has one row per discussion with its
+    first and last log dates, how many logs it was listed on, and relists (listings after the first).
+    """
+    conn = sqlite3.connect(str(index_file))
+    conn.execute("CREATE TABLE IF NOT EXISTS listings (case_discussion_url TEXT, log_link TEXT, log_date TEXT, case_title TEXT, multiple_noms INTEGER, PRIMARY KEY (case_discussion_url, log_link))")
+    conn.execute("""CREATE VIEW IF NOT EXISTS discussions AS
+        SELECT case_discussion_url, MIN(case_title) AS case_title, MIN(log_date) AS first_log_date, MAX(log_date) AS last_log_date,
+            COUNT(*) AS n_listings, COUNT(*) - 1 AS relists, MAX(multiple_noms) AS multiple_noms
+        FROM listings GROUP BY case_discussion_url""")
+    conn.commit()
+    return conn
+
+def record_listings(conn, cases_df):
+    """
+    Records the cases read off daily logs in the case index, and drops the rows that are relists.
+
+    Returns:
+    cases_df - only the rows that are the first listing of their discussion (by log date), and the rows with no
+        discussion url (which still need to be corrected in post)
+    """
+    cases_df = cases_df.reset_index(drop=True)
+    log_dates = cases_df['log_link'].map(log_link_date)
+    has_url = cases_df['case_discussion_url'].notna() & log_dates.notna()
+
+    rows = [[url, link, date, title, int(bool(noms))] for url, link, date, title, noms in zip(
+        cases_df.loc[has_url, 'case_discussion_url'], cases_df.loc[has_url, 'log_link'], log_dates[has_url],
+        cases_df.loc[has_url, 'case_title'], cases_df.loc[has_url, 'multiple_noms'])]
+    conn.executemany("INSERT OR IGNORE INTO listings (case_discussion_url, log_link, log_date, case_title, multiple_noms) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    urls = cases_df.loc[has_url, 'case_discussion_url'].unique().tolist()
+    first_dates = {}
+    for batch in [urls[i:i + 500] for i in range(0, len(urls), 500)]:
+        query = f"SELECT case_discussion_url, MIN(log_date) FROM listings WHERE case_discussion_url IN ({', '.join('?' * len(batch))}) GROUP BY case_discussion_url"
+        first_dates.update(conn.execute(query, batch).fetchall())
+
+    first_listing = has_url & (log_dates == cases_df['case_discussion_url'].map(first_dates))
+    # a discussion that appears twice on the same log only counts once
+    first_listing &= ~cases_df.duplicated(subset=['log_link', 'case_discussion_url'])
+    keep = ~has_url | first_listing
+    if (~keep).sum():
+        print(f"Dropped {(~keep).sum()} relisted cases (recorded in the case index).")
+    return cases_df[keep]
+
+def drop_missing_listings(conn, log_link, cases_df):
+    """
+    For a daily log that was read again: takes the listings of discussions that are no longer on it (e.g., a
+    relisted discussion moved to a later log) out of the case index, so that the discussion's earliest remaining
+    listing counts as its first. A discussion with no other listing keeps this one, so it doesn't lose its only row.
+
+    Returns:
+    gone - the discussion urls that are no longer on the log
+    """
+    present = set(cases_df['case_discussion_url'].dropna())
+    listed = [row[0] for row in conn.execute("SELECT case_discussion_url FROM listings WHERE log_link = ?", (log_link,))]
+    gone = [url for url in listed if url not in present]
+    conn.executemany("""DELETE FROM listings WHERE case_discussion_url = ? AND log_link = ?
+        AND EXISTS (SELECT 1 FROM listings other WHERE other.case_discussion_url = listings.case_discussion_url AND other.log_link != listings.log_link)""",
+        [(url, log_link) for url in gone])
+    conn.commit()
+    return gone
+
+def first_listing_rows(conn, urls):
+    """
+    The first listing in the case index of each discussion in urls, as rows of the monthly case files.
+
+    Returns:
+    df - a DataFrame with the CASE_COLUMNS and year | month | day
+    """
+    rows = []
+    for batch in [urls[i:i + 500] for i in range(0, len(urls), 500)]:
+        query = f"""SELECT log_link, case_title, case_discussion_url, multiple_noms, MIN(log_date) FROM listings
+            WHERE case_discussion_url IN ({', '.join('?' * len(batch))}) GROUP BY case_discussion_url"""
+        rows += conn.execute(query, batch).fetchall()
+    df = pd.DataFrame(rows, columns=CASE_COLUMNS + ['log_date'])
+    df['multiple_noms'] = df['multiple_noms'].astype(bool)
+    dates = pd.to_datetime(df['log_date'])
+    df['year'] = dates.dt.year
+    df['month'] = [months[m - 1] for m in dates.dt.month]
+    df['day'] = dates.dt.day
+    return df.drop(columns=['log_date'])
+
+def export_case_index(index_file, output_file):
+    """
+    Writes the discussions view (one row per discussion) to a tsv, sorted by first log date.
+    """
+    conn = open_case_index(index_file)
+    df = pd.read_sql_query("SELECT * FROM discussions ORDER BY first_log_date, case_discussion_url", conn)
+    conn.close()
+    df.to_csv(output_file, sep="\t", index=False, header=True)
+    print(f"Wrote {len(df)} discussions ({(df['relists'] > 0).sum()} relisted) to {output_file}")
+    return df
+
+def daily_log_link(date):
+    """
+    The link to a day's AfD log, in the same form as the links collected from the archive pages.
+    """
+    return f"/wiki/Wikipedia:Articles_for_deletion/Log/{date.year}_{months[date.month - 1]}_{date.day}"
+
+def latest_collected_date(case_output_dir):
+    """
+    The latest log day in the monthly case files, for when there is no high-water mark yet.
+    """
+    latest = None
+    for case_file in sorted(case_output_dir.glob("deletion_cases_*_uncleaned.tsv")):
+        df = pd.read_csv(case_file, sep="\t", usecols=['year', 'month', 'day'])
+        df = df[df['year'] > 0]
+        if len(df) == 0:
+            continue
+        dates = pd.to_datetime(dict(year=df['year'], month=df['month'].map(months_to_numbers).astype(int), day=df['day']))
+        if latest is None or dates.max() > latest:
+            latest = dates.max()
+    return latest
+
+def refresh_recent_logs(case_output_dir, lookback_days=14):
+    """
+    Incremental alternative to re-crawling the archive homepage and every yearly archive.
+    A state file in the case directory keeps a high-water mark (the latest log day read) and the lastrevid of every
+    daily log page read. Each run looks at the days from (high-water mark - lookback_days) through today, checks
+    their lastrevid in batches of 50, and only fetches the log pages that are new or edited since they were last read.
+    The cases of a refetched day replace that day's rows in its monthly case file. A discussion that is no longer on
+    the log it was first listed on (but still on a later one) gets its row from its earliest remaining listing.
+    """
+    state_file = case_output_dir / "_log_state.json"
+    if state_file.exists():
+        with open(state_file, "r") as f:
+            state = json.load(f)
+    else:
+        latest = latest_collected_date(case_output_dir)
+        state = {'high_water_mark': latest.strftime("%Y-%m-%d") if latest is not None else "2005-01-01", 'lastrevids': {}}
+    print(f"High-water mark: {state['high_water_mark']}")
+
+    start = pd.Timestamp(state['high_water_mark']) - pd.Timedelta(days=lookback_days)
+    days = pd.date_range(start, pd.Timestamp.today().normalize(), freq='D')
+    links = {daily_log_link(d)[6:]: d for d in days}
+
+    lastrevids = wiki.get_last_revids(list(links))
+    changed = [title for title, revid in lastrevids.items() if revid is not None and state['lastrevids'].get(title) != revid]
+    print(f"{len(changed)} of {len(links)} daily logs are new or edited since the last run.")
+
+    writer = wikistore.ResultWriter(case_output_dir, pattern="deletion_cases_*_uncleaned.tsv")
+    writer.verify(checksums=True)
+    index = open_case_index(case_output_dir / CASE_INDEX_FILE)
+
+    fetched = {}
+    for title in changed:
+        cases = []
+        get_deletion_cases(f"/wiki/{title}", cases)
+        fetched[f"/wiki/{title}"] = pd.DataFrame(cases, columns=CASE_COLUMNS)
+
+    # listings that are gone from the logs read again come out of the index before the new ones are recorded,
+    # so that relists are decided against the listings that are still there
+    gone = []
+    for log_link, cases_df in fetched.items():
+        gone += drop_missing_listings(index, log_link, cases_df)
+
+    cases_by_month = {}
+    for title in changed:
+        date = links[title]
+        cases_df = record_listings(index, fetched[f"/wiki/{title}"])
+        cases_df['year'] = date.year
+        cases_df['month'] = months[date.month - 1]
+        cases_df['day'] = date.day
+        cases_by_month.setdefault((date.year, f"{date.month:02d}"), []).append(cases_df)
+
+    # discussions that left their first log: their earliest remaining listing becomes their row,
+    # unless it is already among the rows just read
+    listed = {(link, url) for frames in cases_by_month.values() for df in frames for link, url in zip(df['log_link'], df['case_discussion_url'])}
+    promoted_df = first_listing_rows(index, sorted(set(gone)))
+    promoted_df = promoted_df[[(link, url) not in listed for link, url in zip(promoted_df['log_link'], promoted_df['case_discussion_url'])]]
+    if len(promoted_df):
+        print(f"{len(promoted_df)} discussions are no longer on the log they were first listed on; using their earliest remaining listing.")
+    for (year, month), promoted_month_df in promoted_df.groupby(['year', 'month']):
+        cases_by_month.setdefault((year, months_to_numbers[month]), []).append(promoted_month_df)
+
+    for (year, n), frames in sorted(cases_by_month.items()):
+        new_df = pd.concat(frames, ignore_index=True)
+        case_output_file = case_output_dir / f"deletion_cases_{year}_{n}_uncleaned.tsv"
+        if writer.is_done(case_output_file.name):
+            existing_df = pd.read_csv(case_output_file, sep="\t", header=0)
+            # only the logs that were read again are replaced; promoted rows are added to their (older) log's rows
+            existing_df = existing_df[~existing_df['log_link'].isin(fetched)]
+            new_df = pd.concat([existing_df, new_df], ignore_index=True)
+            has_url = new_df['case_discussion_url'].notna()
+            new_df = new_df[~has_url | ~new_df.duplicated(subset=['log_link', 'case_discussion_url'], keep='last')]
+        writer.write_df(case_output_file.name, new_df)
+        print(f"Updated {case_output_file}")
+
+    for title in changed:
+        state['lastrevids'][title] = lastrevids[title]
+        state['high_water_mark'] = max(state['high_water_mark'], links[title].strftime("%Y-%m-%d"))
+    writer.close()
+    index.close()
+    # the state file is only replaced once the case files it describes are written
+    wikistore.atomic_write_bytes(state_file, json.dumps(state, indent = 4).encode("utf-8"))
+
+def collect_cases(daily_logs):
+    """
+    Reads the cases listed on each of the daily log links.
+
+    Returns:
+    cases_df - a DataFrame with the CASE_COLUMNS
+    """
+    cases = []
+    for link in daily_logs:
+        get_deletion_cases(link, cases)
+    return pd.DataFrame(cases,columns=CASE_COLUMNS)
+
 def main():
+    case_output_dir = Path.cwd().parent / 'deletion_cases'
+    shard = wiki.parse_shard(args.shard) if args.shard else None
+    if shard is not None:
+        if args.incremental:
+            raise ValueError("--shard is for the full crawl; --incremental reads few enough logs to run in one process")
+        case_output_dir = wiki.shard_dir(case_output_dir, shard)
+        case_output_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.export_index:
+        export_case_index(case_output_dir / CASE_INDEX_FILE, Path.cwd().parent / "deletion_cases_index.tsv")
+        return
+
+    if args.incremental:
+        refresh_recent_logs(case_output_dir, lookback_days=args.lookback_days)
+        return
+
+    # profile reading a random sample of daily logs instead of running everything
+    if args.profile:
+        days = pd.date_range("2005-01-01", pd.Timestamp.today().normalize(), freq='D')
+        sample = [daily_log_link(d) for d in wikiprofile.sample_items(days, args.profile_sample)]
+        output_prefix = Path.cwd().parent / "profiles" / f"0_get_deletion_cases_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        wikiprofile.profile_call(collect_cases, sample, output_prefix=output_prefix)
+        return
+
     archive_link = "Wikipedia:Archived_articles_for_deletion_discussions" #https://en.wikipedia.org/wiki/
     archive_home = wf.get_page_raw_content(archive_link)
 
@@ -111,26 +386,31 @@ def main():
     else:
         print("Using an existing list of daily log links.")
 
-    log_link_file = input("Enter the log link file to use: (e.g., ./../log_links_20250624_145626.tsv) ")
+    log_link_file = args.log_links
+    if log_link_file is None:
+        log_link_file = input("Enter the log link file to use: (e.g., ./../log_links_20250624_145626.tsv) ")
 
     # go to each daily log link and extract all the cases into a tsv
     log_link_df = pd.read_csv( log_link_file ,sep='\t')
-
-    months = ["January", "February", "March", "April", "May", "June","July", "August", "September", "October", "November", "December"]
-
-    months_to_numbers = {"January": "01", "February": "02", "March": "03", "April": "04", "May": "05", "June": "06", "July": "07", "August": "08", "September": "09", "October": "10", "November": "11", "December": "12"}
+    if shard is not None:
+        log_link_df = log_link_df[wiki.in_shard(log_link_df['log_link'], shard)]
+        print(f"Shard {shard[0]}/{shard[1]}: {len(log_link_df)} daily logs.")
 
     # let's do this by year and month, so that we can chunk it up a bit
     # 2003 and 2004 have to do with other script, format is different, so we will not collect those here.
     start_year = 2005
     end_year = 2025
-    case_output_dir = Path.cwd().parent / 'deletion_cases'
+
+    # monthly files go through a checksummed, atomic writer; files cut short by a crash are found here and redone
+    writer = wikistore.ResultWriter(case_output_dir, pattern="deletion_cases_*_uncleaned.tsv")
+    writer.verify(checksums=True)
+    index = open_case_index(case_output_dir / CASE_INDEX_FILE)
 
     for i in list(range(start_year,end_year+1)):
         subset_year_df = log_link_df[log_link_df['year']==i]
         for m in months:
             n = months_to_numbers[m]
-            if (case_output_dir / f"deletion_cases_{i}_{n}_uncleaned.tsv").exists():
+            if writer.is_done(f"deletion_cases_{i}_{n}_uncleaned.tsv"):
                 print(f"{i}, {m} has already been collected.")
                 continue
 
@@ -138,12 +418,9 @@ def main():
             subset_month_df = subset_year_df[subset_year_df['month']==m]
             print(subset_month_df.head())
             daily_logs = subset_month_df['log_link'].tolist()
-            cases = []
-            for link in daily_logs:
-                get_deletion_cases(link, cases)
 
-            # cases for this year and month should now be populated
-            cases_df = pd.DataFrame(cases,columns=["log_link", "case_title", "case_discussion_url", "multiple_noms"])
+            # cases for this year and month, without relists of discussions listed earlier
+            cases_df = record_listings(index, collect_cases(daily_logs))
             # add year, month, day columns from the log_link_file's df based on log_link shared column
             merged_df = pd.merge(cases_df, log_link_df, on='log_link', how='left')
             print(merged_df.head())
@@ -151,8 +428,16 @@ def main():
             # export
             # remember we need to correct the None cases...
             case_output_file = case_output_dir / f"deletion_cases_{i}_{n}_uncleaned.tsv"
-            merged_df.to_csv(case_output_file,sep="\t",index=False,header=True)
+            writer.write_df(case_output_file.name, merged_df)
             print(f"Created {case_output_file}")
 
+    writer.close()
+    index.close()
+
 if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.metrics:
+        wikimetrics.start_writer(Path.cwd().parent / args.metrics)
+
     main()
\ No newline at end of file
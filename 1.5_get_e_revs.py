@@ -2,6 +2,11 @@
 
 import pandas as pd
 import wikihelpers as wiki
+import wikimetrics
+import wikiprofile
+import wikiestimate
+import wikistore
+from datetime import datetime
 from pathlib import Path
 from tqdm import tqdm
 from urllib.parse import unquote, quote
@@ -12,8 +17,50 @@ import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument('--input', type=str, help='Path to the input JSON file containing case titles.')
 parser.add_argument('--type', type=str, help='`content` if the input file contains pages for content articles. `afd` if input file contains pages for deletion discussions.')
+parser.add_argument('--shard', type=str, default=None, help='Only process the pages in shard i/N (by a stable hash of case_title_cleaned, see wikihelpers.shard_of), writing to case_meta_data/shard_i_of_N; combine the shards with merge_shards.py.')
+parser.add_argument('--yes', action='store_true', help='Start without asking (for running from pipeline.py).')
+parser.add_argument('--profile', action='store_true', help='Process one random sample of pages (see --profile-sample) under cProfile and tracemalloc, write the report to ./../profiles, and stop. Not a dry run: the sample is fetched with live requests; its errors go to 1.5_errors_profile.log instead of 1.5_errors.log.')
+parser.add_argument('--profile-sample', type=int, default=100, help='How many pages --profile samples.')
+parser.add_argument('--estimate', action='store_true', help='Process one random sample of pages (see --estimate-sample), project the runtime and bytes of the full list under different concurrency and rate settings, write the estimate to ./../profiles, and stop. Not a dry run: the sample is fetched with live requests; its errors go to 1.5_errors_estimate.log instead of 1.5_errors.log.')
+parser.add_argument('--estimate-sample', type=int, default=50, help='How many pages --estimate samples.')
+parser.add_argument('--metrics', type=str, default=None, help='File (relative to the parent directory) to write request/parse metrics to every 30 seconds while running; JSON, or Prometheus text if it ends in .prom.')
+
+# the file in ./case_meta_data that failed pages are logged to (--profile and --estimate log their sample's errors separately)
+error_log_name = "1.5_errors.log"
+
+def process_chunk(chunk, i):
+    """
+    Gets the earliest revision of every page in one chunk.
+
+    Returns:
+    df_dates - page_title | earliest_revision_date, with None for pages that had errors
+    """
+    parent_dir = Path.cwd().parent
+    dates = []
+
+    for page_title in tqdm(chunk):
+
+        if args.type == "afd":
+            page_title = f"Wikipedia:Articles for deletion/{page_title}"
+
+        print(page_title)
+        # get earliest revision
+        try:
+            with wikimetrics.timer('stage1.5.get_earliest_revision'):
+                dates.append([page_title, wiki.get_earliest_revision(page_title)])
+        except Exception as e:
+            print(f"Error processing {page_title}: {e}")
+            traceback.print_exc()
+            dates.append([page_title, None])
+
+            with open(parent_dir / "case_meta_data" / error_log_name, "a") as f:
+                f.write(f"{i+1}\t{page_title}\t{e}\n")
+
+    # dates to dataframe
+    return pd.DataFrame(dates, columns=['page_title', 'earliest_revision_date'])
 
 def main():
+    global error_log_name
     # read in the input file
     parent_dir = Path.cwd().parent
     input_path = parent_dir / args.input
@@ -22,6 +69,16 @@ def main():
 
     df = pd.read_csv(input_path, header=0, sep="\t")
 
+    # the stage 1 metadata has case_title_cleaned as page_title
+    if args.shard:
+        shard = wiki.parse_shard(args.shard)
+        shard_key = df['page_title'] if args.type == "content" else df['case_title_cleaned']
+        df = df[wiki.in_shard(shard_key, shard)]
+        output_dir = wiki.shard_dir(parent_dir / "case_meta_data", shard)
+        output_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        output_dir = parent_dir / "case_meta_data"
+
     if args.type == "content":
         df = df[df['page_exists'] ==True]
         pages = df['returned_title'].tolist()
@@ -36,43 +93,52 @@ def main():
     print(f"Processing {len(page_titles_chunked)} chunks of cases, each with up to {chunk_size} cases.")
     print(f"The last chunk is smaller: {len(page_titles_chunked[-1])}")
 
-    input("Start?")
+    # profile one sampled chunk instead of running everything
+    if args.profile:
+        # the sample's failures shouldn't be rerun as if they were errors of the real run
+        error_log_name = "1.5_errors_profile.log"
+        sample = wikiprofile.sample_items(pages, args.profile_sample)
+        output_prefix = parent_dir / "profiles" / f"1.5_get_e_revs_{args.type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        wikiprofile.profile_call(process_chunk, sample, 0, output_prefix=output_prefix)
+        return
+
+    # estimate the runtime of everything from one sampled chunk
+    if args.estimate:
+        # the sample's failures shouldn't be rerun as if they were errors of the real run
+        error_log_name = "1.5_errors_estimate.log"
+        per_title, report = wikiestimate.estimate_run(lambda sample: process_chunk(sample, 0), pages, sample_size=args.estimate_sample)
+        (parent_dir / "profiles").mkdir(parents=True, exist_ok=True)
+        with open(parent_dir / "profiles" / f"1.5_get_e_revs_{args.type}_estimate_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt", "w") as f:
+            f.write(report)
+        return
+
+    if not args.yes:
+        input("Start?")
+
+    # chunk files go through a checksummed, atomic writer; files cut short by a crash are found here and redone
+    writer = wikistore.ResultWriter(output_dir, pattern="1.5_earliest_revisions_*.tsv")
+    writer.verify(checksums=True)
 
     for i, chunk in enumerate(page_titles_chunked):
 
         #print(chunk)
 
-        dates = []
-
-        output_path = parent_dir / "case_meta_data" / f"1.5_earliest_revisions_{args.type}_{i+1:04d}.tsv"
-        if output_path.exists():
+        output_path = output_dir / f"1.5_earliest_revisions_{args.type}_{i+1:04d}.tsv"
+        if writer.is_done(output_path.name):
             print(f"> Chunk {i+1} already processed into {output_path}, skipping.")
             continue
 
-        for page_title in tqdm(chunk):
-
-            if args.type == "afd":
-                page_title = f"Wikipedia:Articles for deletion/{page_title}"
-
-            print(page_title)
-            # get earliest revision
-            try:
-                dates.append([page_title, wiki.get_earliest_revision(page_title)])
-            except Exception as e:
-                print(f"Error processing {page_title}: {e}")
-                traceback.print_exc()
-                dates.append([page_title, None])
-
-                with open(parent_dir / "case_meta_data" / "1.5_errors.log", "a") as f:
-                    f.write(f"{i+1}\t{page_title}\t{e}\n")
-                        
-        # dates to dataframe
-        df_dates = pd.DataFrame(dates, columns=['page_title', 'earliest_revision_date'])
+        df_dates = process_chunk(chunk, i)
         
-        df_dates.to_csv(output_path, sep="\t", index=False)
+        writer.write_df(output_path.name, df_dates)
         print(f"Saved earliest revisions to {output_path}")
 
+    writer.close()
+
 if __name__ == "__main__":
     args = parser.parse_args()
 
+    if args.metrics:
+        wikimetrics.start_writer(Path.cwd().parent / args.metrics)
+
     main()
\ No newline at end of file
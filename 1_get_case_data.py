@@ -2,6 +2,12 @@
 
 import pandas as pd
 import wikihelpers as wiki
+import wikifunctions as wf
+import wikimetrics
+import wikiprofile
+import wikiestimate
+import wikistore
+from datetime import datetime
 from pathlib import Path
 import time
 from tqdm import tqdm
@@ -9,6 +15,30 @@ import concurrent.futures
 from urllib.parse import unquote, quote
 import json 
 import traceback
+import argparse
+import importlib
+import threading
+import queue
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mode', type=str, default='parse', choices=['parse', 'wikitext'], help='`parse` gets each discussion as HTML with one action=parse call. `wikitext` gets the wikitext of 50 discussions per request; HTML is rendered later, only if an extractor needs it.')
+parser.add_argument('--log-store', type=str, default=None, help='sqlite file (relative to the parent directory) with the deletion, move and creation logs (see wikihelpers.collect_log_events). Cases the logs settle skip the per-title existence check.')
+parser.add_argument('--refresh-logs', action='store_true', help='With --log-store, pull the deletion, move and creation logs into the store before processing.')
+parser.add_argument('--stream', action='store_true', help='Read the daily AfD logs and process their cases at the same time, instead of starting from deletion_cases_sorted_dedup.tsv (see stream_cases).')
+parser.add_argument('--log-links', type=str, default=None, help='With --stream, the log link file to read (e.g., ./../log_links_20250624_145626.tsv, as made by 0_get_deletion_cases.py); by default, every daily log from 2005 to today.')
+parser.add_argument('--workers', type=int, default=1, help='With --stream, how many threads process cases at the same time.')
+parser.add_argument('--shard', type=str, default=None, help='Only process the cases in shard i/N (by a stable hash of case_title_cleaned, see wikihelpers.shard_of), writing the chunk files to case_meta_data/shard_i_of_N; combine the shards with merge_shards.py.')
+parser.add_argument('--yes', action='store_true', help='Start without asking (for running from pipeline.py).')
+parser.add_argument('--profile', action='store_true', help='Process one random sample of cases (see --profile-sample) under cProfile and tracemalloc, write the report to ./../profiles, and stop. Not a dry run: the sample is fetched with live requests and its discussions are saved like a normal run; its errors go to 1_errors_profile.log instead of 1_errors.log.')
+parser.add_argument('--profile-sample', type=int, default=100, help='How many cases --profile samples.')
+parser.add_argument('--estimate', action='store_true', help='Process one random sample of cases (see --estimate-sample), project the runtime and bytes of the full list under different concurrency and rate settings, write the estimate to ./../profiles, and stop. Not a dry run: the sample is fetched with live requests and its discussions are saved like a normal run; its errors go to 1_errors_estimate.log instead of 1_errors.log.')
+parser.add_argument('--estimate-sample', type=int, default=50, help='How many cases --estimate samples.')
+parser.add_argument('--metrics', type=str, default=None, help='File (relative to the parent directory) to write request/parse metrics to every 30 seconds while running; JSON, or Prometheus text if it ends in .prom.')
+
+# the wikistore.ResultWriter for ./deletion_discussions, set in main
+discussion_writer = None
+# the file in ./case_meta_data that failed titles are logged to (--profile and --estimate log their sample's errors separately)
+error_log_name = "1_errors.log"
 
 def check_exists_and_title(page_title):
     """
@@ -82,6 +112,27 @@ def make_deletion_discussion_dict(page_title):
     }
     return deletion_discussion_dict
 
+def fetch_discussions_wikitext(page_titles):
+    """
+    Gets the wikitext of up to 50 deletion discussions in one request and writes each one to the discussion store
+    (through discussion_writer).
+    The stored JSON has `wikitext` (and the `revid` it came from) instead of the HTML `text`; see
+    discussion_corpus.ensure_discussion_html for rendering the HTML when it is needed.
+    """
+    case_titles = {f"Wikipedia:Articles_for_deletion/{unquote(t)}": t for t in page_titles}
+    pages = wiki.get_pages_wikitext(list(case_titles))
+
+    for case_title, page_title in case_titles.items():
+        page = pages[case_title]
+        deletion_discussion_dict = {
+            'case_title': case_title,
+            'url': f"https://en.wikipedia.org/wiki/{case_title.replace(' ', '_')}",
+            'format': 'wikitext',
+            'revid': page['revid'],
+            'wikitext': page['wikitext'] if not page['missing'] else "DISCUSSION_DOES_NOT_EXIST",
+        }
+        discussion_writer.put(f"{title_to_filename(page_title)}.json", json.dumps(deletion_discussion_dict, indent = 4))
+
 def title_to_filename(page_title):
     """
     Convert a page title to a filename-friendly format.
@@ -99,19 +150,53 @@ def filename_to_title(filename):
     title = unquote(filename)
     return title
 
-def process_case(page_title,i):
+def case_fates(df, log_store, fates_file):
+    """
+    Resolves the fate of every case article from the deletion, move and creation logs at once.
+    The AfD date is the day of the daily log the case was listed on; for cases listed more than once, the earliest.
+
+    Returns:
+    fates - a dictionary page_title -> [page_title, page_exists, returned_title, pageid] (the process_case row) for the
+        cases the logs settle: deleted pages don't exist, and moved pages are treated like redirects.
+        Restored and recreated pages, pages that exist again now, and pages with no log events after their AfD are
+        left out, to be checked per title.
+    """
+    months_to_numbers = {"January": 1, "February": 2, "March": 3, "April": 4, "May": 5, "June": 6, "July": 7, "August": 8, "September": 9, "October": 10, "November": 11, "December": 12}
+    dates = pd.to_datetime(dict(year=df['year'], month=df['month'].map(months_to_numbers), day=df['day']), errors='coerce')
+    afd_dates = dates.groupby(df['case_title_cleaned']).min()
+
+    fates_df = wiki.get_page_fates(afd_dates.index.tolist(), afd_dates.tolist(), log_store)
+    fates_df.to_csv(fates_file, sep="\t", index=False, header=True)
+    print(fates_df['fate'].value_counts(dropna=False))
+
+    fates = {}
+    # fates_df rows are in the same order as afd_dates
+    for page_title, fate, target in zip(afd_dates.index, fates_df['fate'], fates_df['fate_target']):
+        if fate == 'deleted':
+            fates[page_title] = [page_title, False, None, None]
+        elif fate == 'moved':
+            fates[page_title] = [page_title, False, target, "REDIRECTED"]
+    return fates
+
+@wikimetrics.timed('stage1.process_case')
+def process_case(page_title,i,fetch_discussion=True,fate=None):
     parent_dir=Path.cwd().parent
     #print(page_title)
     try:
-        deletion_discussion_dict = make_deletion_discussion_dict(page_title)
+        if fetch_discussion:
+            deletion_discussion_dict = make_deletion_discussion_dict(page_title)
 
         # get the returned_title for the actual article/page, which also checks if page_exists for the page_title
-        page_exists, returned_title, pageid = check_exists_and_title(page_title)
+        # (unless the deletion/move logs already settled it)
+        if fate is not None:
+            _, page_exists, returned_title, pageid = fate
+        else:
+            page_exists, returned_title, pageid = check_exists_and_title(page_title)
 
-        # exporting the deletion discussion dict to a json file
-        filename = title_to_filename(page_title)
-        with open(parent_dir / "deletion_discussions" / f"{filename}.json", "w") as f:
-            json.dump(deletion_discussion_dict, f, indent = 4)
+        # exporting the deletion discussion dict to a json file (buffered; see wikistore.ResultWriter)
+        if fetch_discussion:
+            filename = title_to_filename(page_title)
+            discussion_writer.put(f"{filename}.json", json.dumps(deletion_discussion_dict, indent = 4))
         
         return [page_title, page_exists, returned_title, pageid]
     except Exception as e:
@@ -120,11 +205,212 @@ def process_case(page_title,i):
 
         # log the page_title in a file that logs errors
         # afterwards, we will run the script on cases that had errors
-        with open(parent_dir / "case_meta_data" / "1_errors.log", "a") as f:
+        with open(parent_dir / "case_meta_data" / error_log_name, "a") as f:
             f.write(f"{i+1}\t{page_title}\t{e}\n")
 
         return None
 
+def fetch_chunk_discussions(chunk, i):
+    """
+    Wikitext mode: gets the discussions of a chunk of page titles 50 per request (see fetch_discussions_wikitext).
+    Titles in a batch that fails are logged to the error log, like the cases process_case fails on.
+    """
+    parent_dir = Path.cwd().parent
+    for batch in wf.chunks(list(chunk), 50):
+        try:
+            fetch_discussions_wikitext(batch)
+        except Exception as e:
+            print(f"In chunk {i+1}, exception for the batch starting with {batch[0]}: {e}")
+            with open(parent_dir / "case_meta_data" / error_log_name, "a") as f:
+                for page_title in batch:
+                    f.write(f"{i+1}\t{page_title}\t{e}\n")
+
+def process_chunk(chunk, i, fates):
+    """
+    Gets the discussions and page metadata for one chunk of page titles.
+
+    Returns:
+    meta_df - page_title | page_exists | returned_title | pageid for the cases without errors
+    """
+    meta_data = []
+
+    # in wikitext mode, the discussions for the whole chunk are fetched 50 at a time up front
+    if args.mode == "wikitext":
+        fetch_chunk_discussions(chunk, i)
+
+    for page_title in tqdm(chunk):
+        result = process_case(page_title,i,fetch_discussion=(args.mode == "parse"),fate=fates.get(page_title))
+        if result is not None:
+            meta_data.append(result)
+
+    # the discussions have to be on disk before the chunk file says the chunk is done
+    discussion_writer.flush()
+    return pd.DataFrame(meta_data, columns=['page_title', 'page_exists', 'returned_title', 'pageid'])
+
+"""
+streaming: cases are processed while the daily logs are still being read
+"""
+# stage 0's module name starts with a digit, so it can't be imported with a plain import statement
+stage0 = importlib.import_module("0_get_deletion_cases")
+
+STREAM_CASE_COLUMNS = stage0.CASE_COLUMNS + ['case_title_cleaned']
+
+def clean_case_title(case_title):
+    """
+    The case_title_cleaned for a case heading read off a daily log: surrounding and repeated whitespace removed.
+    """
+    if not isinstance(case_title, str):
+        return None
+    cleaned = ' '.join(case_title.split())
+    return cleaned or None
+
+def stream_log_filename(log_link):
+    """
+    The file the cases of one daily log are kept in (e.g., 2005_January_1.tsv).
+    """
+    return f"{quote(str(log_link).rstrip('/').rsplit('/', 1)[-1], safe='')}.tsv"
+
+def produce_cases(log_links, case_queue, cases_dir, n_consumers):
+    """
+    Reads each daily log and puts its cases on the queue as soon as the log is parsed.
+    The cases of every log are written to their own file in cases_dir (through a wikistore.ResultWriter), so logs
+    that were read in an earlier run are not fetched again; their cases are queued from the file instead (the
+    consumers drop the ones already processed).
+    Relists are recorded in stage 0's case index next to cases_dir and not queued again.
+    One None per consumer is queued at the end.
+    """
+    index = stage0.open_case_index(cases_dir.parent / stage0.CASE_INDEX_FILE)
+    writer = wikistore.ResultWriter(cases_dir, pattern="*.tsv")
+    writer.verify()
+
+    n_done = 0
+    for link in log_links:
+        filename = stream_log_filename(link)
+        if writer.is_done(filename):
+            found_df = pd.read_csv(cases_dir / filename, sep="\t", header=0)
+            for case_title in found_df['case_title_cleaned'].dropna():
+                case_queue.put(case_title)
+            n_done += 1
+            continue
+        try:
+            cases = []
+            stage0.get_deletion_cases(link, cases)
+        except Exception as e:
+            print(f"Could not read {link}: {e}")
+            continue
+        cases_df = stage0.record_listings(index, pd.DataFrame(cases, columns=stage0.CASE_COLUMNS))
+        cases_df['case_title_cleaned'] = cases_df['case_title'].map(clean_case_title)
+        # a log with no cases still gets a file, so that it counts as read
+        writer.write_df(filename, cases_df[STREAM_CASE_COLUMNS])
+        for case_title in cases_df['case_title_cleaned'].dropna():
+            case_queue.put(case_title)
+
+    print(f"{n_done} daily logs were read in an earlier run.")
+    writer.close()
+    index.close()
+    for _ in range(n_consumers):
+        case_queue.put(None)
+
+def stream_cases(log_links, n_workers=1, chunk_size=100, shard=None):
+    """
+    Runs the case discovery of stage 0 and process_case together: one thread reads the daily logs and queues the
+    cases it finds, and n_workers threads take cases off the queue, skip the ones already seen (in this run or in
+    earlier chunk files), and process the rest. Results are written to case_meta_data/chunk_stream_XXXXX.tsv every
+    chunk_size cases (named so that they are combined with the other chunk_*.tsv files), so the wall-clock time is
+    close to that of the slower stage rather than the sum of both. In wikitext mode, the discussions of each chunk
+    are fetched 50 per request before its chunk file is written.
+    All the workers' requests wait on the shared wikihelpers.api_limiter, so n_workers don't multiply the request rate.
+    With a shard (i, N), only the cases in that shard are processed, and the chunk files go to its shard directory.
+    """
+    # the plain request functions (call_parse, get_raw_html) go through wikimetrics.get; make them share the budget
+    wikimetrics.use_limiter(wiki.api_limiter)
+
+    parent_dir = Path.cwd().parent
+    meta_dir = parent_dir / "case_meta_data"
+    if shard is not None:
+        meta_dir = wiki.shard_dir(meta_dir, shard)
+        meta_dir.mkdir(parents=True, exist_ok=True)
+
+    meta_writer = wikistore.ResultWriter(meta_dir, pattern=wikistore.CHUNK_PATTERN)
+    meta_writer.verify(checksums=True)
+
+    # dedup on the fly, starting from everything already processed
+    seen = set()
+    chunk_files = sorted(meta_dir.glob(wikistore.CHUNK_PATTERN))
+    for chunk_file in [f for f in chunk_files if meta_writer.is_done(f.name)]:
+        seen.update(pd.read_csv(chunk_file, sep="\t", header=0, usecols=['page_title'])['page_title'])
+    print(f"{len(seen)} cases were already processed.")
+
+    lock = threading.Lock()
+    buffer = []
+    n_chunks = [len(list(meta_dir.glob("chunk_stream_*.tsv")))]
+
+    def take_chunk(force=False):
+        # called with the lock held: numbers the buffered rows as a chunk and swaps them out, so that fetching their
+        # discussions and writing the chunk file happen outside the lock and don't hold up the other workers
+        if not buffer or (len(buffer) < chunk_size and not force):
+            return None, []
+        n_chunks[0] += 1
+        rows = list(buffer)
+        buffer.clear()
+        return n_chunks[0], rows
+
+    def write_chunk(n, rows):
+        if not rows:
+            return
+        try:
+            if args.mode == "wikitext":
+                fetch_chunk_discussions([row[0] for row in rows], n - 1)
+            discussion_writer.flush()
+            meta_writer.write_df(f"chunk_stream_{n:05d}.tsv", pd.DataFrame(rows, columns=['page_title', 'page_exists', 'returned_title', 'pageid']))
+        except Exception as e:
+            print(f"Could not write stream chunk {n}: {e}")
+            traceback.print_exc()
+            with open(parent_dir / "case_meta_data" / error_log_name, "a") as f:
+                for row in rows:
+                    f.write(f"{n}\t{row[0]}\t{e}\n")
+
+    def consume():
+        while True:
+            page_title = case_queue.get()
+            if page_title is None:
+                return
+            # a worker that died would leave the log reader blocked on the full queue, so nothing may escape this loop
+            try:
+                with lock:
+                    if page_title in seen:
+                        continue
+                    seen.add(page_title)
+                if shard is not None and not wiki.in_shard([page_title], shard)[0]:
+                    continue
+                result = process_case(page_title, n_chunks[0], fetch_discussion=(args.mode == "parse"))
+                if result is None:
+                    continue
+                with lock:
+                    buffer.append(result)
+                    n, rows = take_chunk()
+                write_chunk(n, rows)
+            except Exception as e:
+                print(f"Stream worker exception for {page_title}: {e}")
+                traceback.print_exc()
+                with open(parent_dir / "case_meta_data" / error_log_name, "a") as f:
+                    f.write(f"{n_chunks[0] + 1}\t{page_title}\t{e}\n")
+
+    # bounded, so the log reader can't run arbitrarily far ahead of the case processing
+    case_queue = queue.Queue(maxsize=10 * chunk_size)
+    consumers = [threading.Thread(target=consume) for _ in range(n_workers)]
+    for consumer in consumers:
+        consumer.start()
+    produce_cases(log_links, case_queue, parent_dir / "deletion_cases" / "_stream_cases", n_workers)
+    for consumer in consumers:
+        consumer.join()
+
+    with lock:
+        n, rows = take_chunk(force=True)
+    write_chunk(n, rows)
+    meta_writer.close()
+    print(f"Done: {n_chunks[0]} stream chunk files in {meta_dir}")
+
 def main():
     # directory hygiene
     parent_dir = Path.cwd().parent
@@ -134,6 +420,32 @@ def main():
     if not (parent_dir / "deletion_discussions").exists():
         (parent_dir / "deletion_discussions").mkdir(parents=True, exist_ok=True)
 
+    # with --shard, this process only does its share of the cases, and writes its chunk files to its own directory
+    shard = wiki.parse_shard(args.shard) if args.shard else None
+    meta_dir = parent_dir / "case_meta_data"
+    if shard is not None:
+        meta_dir = wiki.shard_dir(meta_dir, shard)
+        meta_dir.mkdir(parents=True, exist_ok=True)
+
+    # writes go through checksummed, atomic writers; files cut short by a crash are found here and redone
+    global discussion_writer, error_log_name
+    discussion_writer = wikistore.ResultWriter(parent_dir / "deletion_discussions", pattern="*.json")
+    discussion_writer.verify()
+
+    if args.stream:
+        (parent_dir / "deletion_cases").mkdir(parents=True, exist_ok=True)
+        if args.log_links:
+            log_links = pd.read_csv(args.log_links, sep="\t", header=0)['log_link'].tolist()
+        else:
+            days = pd.date_range("2005-01-01", pd.Timestamp.today().normalize(), freq='D')
+            log_links = [stage0.daily_log_link(d) for d in days]
+        stream_cases(log_links, n_workers=args.workers, shard=shard)
+        discussion_writer.close()
+        return
+
+    meta_writer = wikistore.ResultWriter(meta_dir, pattern=wikistore.CHUNK_PATTERN)
+    meta_writer.verify(checksums=True)
+
     # load the deletion_cases, which should be: "deletion_cases_sorted_dedup.tsv"
     dedup_cases = parent_dir / "deletion_cases_sorted_dedup.tsv" 
     print(f"Loading the deletion cases from file: {dedup_cases}")
@@ -143,8 +455,20 @@ def main():
 
     # get the unique set of page_titles that are deletion_cases (case_title_cleaned)
     page_titles = df['case_title_cleaned'].drop_duplicates(keep='first').tolist()
+    if shard is not None:
+        page_titles = [t for t, keep in zip(page_titles, wiki.in_shard(page_titles, shard)) if keep]
+        print(f"Shard {shard[0]}/{shard[1]}:", end=" ")
     print(len(page_titles), "cases to process.")
 
+    # page fates from the deletion/move logs, so only the unsettled cases need check_exists_and_title
+    fates = {}
+    if args.log_store:
+        log_store = parent_dir / args.log_store
+        if args.refresh_logs:
+            wiki.collect_log_events(log_store)
+        fates = case_fates(df[df['case_title_cleaned'].isin(page_titles)], log_store, meta_dir / "page_fates.tsv")
+        print(f"{len(fates)} of {len(page_titles)} cases are settled by the deletion, move and creation logs.")
+
     # chunking so that we can process a bit smarter when dealing with errors
     chunk_size = 100
     page_titles_chunked = wiki.chunk_list(page_titles, chunk_size)
@@ -152,16 +476,37 @@ def main():
     print(f"Processing {len(page_titles_chunked)} chunks of cases, each with up to {chunk_size} cases.")
     print(f"The last chunk is smaller: {len(page_titles_chunked[-1])}")
 
-    input("Start?")
+    # profile one sampled chunk instead of running everything
+    if args.profile:
+        # the sample's failures shouldn't be rerun as if they were errors of the real run
+        error_log_name = "1_errors_profile.log"
+        sample = wikiprofile.sample_items(page_titles, args.profile_sample)
+        output_prefix = parent_dir / "profiles" / f"1_get_case_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        wikiprofile.profile_call(process_chunk, sample, 0, fates, output_prefix=output_prefix)
+        return
+
+    # estimate the runtime of everything from one sampled chunk
+    if args.estimate:
+        # the sample's failures shouldn't be rerun as if they were errors of the real run
+        error_log_name = "1_errors_estimate.log"
+        sleep_seconds = wikiestimate.chunk_sleep_seconds(len(page_titles), chunk_size)
+        per_title, report = wikiestimate.estimate_run(lambda sample: process_chunk(sample, 0, fates), page_titles, sample_size=args.estimate_sample, sleep_seconds=sleep_seconds)
+        (parent_dir / "profiles").mkdir(parents=True, exist_ok=True)
+        with open(parent_dir / "profiles" / f"1_get_case_data_estimate_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt", "w") as f:
+            f.write(report)
+        return
+
+    if not args.yes:
+        input("Start?")
 
     for i, chunk in enumerate(page_titles_chunked):
         # start timer 
-        chunk_outfile = parent_dir / "case_meta_data" / f"chunk_{i+1:04d}.tsv"
+        chunk_outfile = meta_dir / f"chunk_{i+1:04d}.tsv"
 
         print(f"Processing chunk {i+1}/{len(page_titles_chunked)} with {len(chunk)} cases, into {chunk_outfile}")
 
-        # if the chunk_outfile already exists, we skip this chunk
-        if chunk_outfile.exists():
+        # if the chunk_outfile was already written (completely), we skip this chunk
+        if meta_writer.is_done(chunk_outfile.name):
             print(f"> Chunk {i+1} already processed into {chunk_outfile}, skipping.")
             continue
 
@@ -171,17 +516,10 @@ def main():
         #    chunk_results = list(tqdm(executor.map(process_case, chunk), total=len(chunk)))
         #meta_data = [r for r in chunk_results if r is not None]
 
-        meta_data = []
-
-        for page_title in tqdm(chunk):
-            result = process_case(page_title,i)
-            if result is not None:
-                meta_data.append(result)
-        
         # make into df and export
         # note: page_title == case_title_cleaned
-        meta_df = pd.DataFrame(meta_data, columns=['page_title', 'page_exists', 'returned_title', 'pageid'])
-        meta_df.to_csv(chunk_outfile, sep="\t", index=False, header=True)
+        meta_df = process_chunk(chunk, i, fates)
+        meta_writer.write_df(chunk_outfile.name, meta_df)
 
         # for every 1000 chunks (100,000 pages), we wait a while to avoid hitting API litmits.
         if (i + 1) % 1000 == 0:
@@ -192,6 +530,9 @@ def main():
             print(f"\nProcessed {i + 1} chunks of 100 cases each. Waiting for 10 minutes to avoid barraging the API.\n")
             time.sleep(10 * 60)
     
+    meta_writer.close()
+    discussion_writer.close()
+
     # open 1_errors.log and count how many lines there are
     error_log_file = parent_dir / "case_meta_data" / "1_errors.log"
     if error_log_file.exists(): 
@@ -200,4 +541,9 @@ def main():
         print(f"Number of errors to redo: {len(error_lines)}")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.metrics:
+        wikimetrics.start_writer(Path.cwd().parent / args.metrics)
+
     main()
\ No newline at end of file
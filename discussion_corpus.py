@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+from bs4 import BeautifulSoup, NavigableString
+from urllib.parse import unquote
+from pathlib import Path
+from tqdm import tqdm
+import concurrent.futures
+import sqlite3
+import json
+import re
+import argparse
+import wikiparse
+import wikimetrics
+
+# pyahocorasick is optional; without it, the policy scanner uses one combined regex instead of an automaton
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+"""
+Tools over the stored deletion discussions (../deletion_discussions/*.json, written by 1_get_case_data.py).
+The plain text of each discussion is extracted from the stored HTML once and kept in a local SQLite FTS5 index,
+so that searching for policy shortcuts, usernames or phrases doesn't mean re-reading and re-souping every file.
+"""
+
+def discussion_files(discussion_dir):
+    """
+    All the stored discussion JSON files, sorted by name.
+    """
+    return sorted(Path(discussion_dir).glob("*.json"))
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+@wikimetrics.timed('parse.html_to_text')
+def html_to_text(html):
+    """
+    Plain text of a discussion's HTML, with whitespace collapsed.
+    """
+    if not html or html == "DISCUSSION_DOES_NOT_EXIST":
+        return str()
+    soup = BeautifulSoup(html, 'lxml')
+    return WHITESPACE_RE.sub(' ', soup.get_text(' ')).strip()
+
+def read_discussion_text(path):
+    """
+    Reads one stored discussion and returns [case_title, text].
+    Discussions stored as wikitext (1_get_case_data.py --mode wikitext) are converted locally, without rendering.
+    """
+    with open(path, "r") as f:
+        discussion = json.load(f)
+    if discussion.get('text') is None and discussion.get('wikitext') is not None:
+        if discussion['wikitext'] == "DISCUSSION_DOES_NOT_EXIST":
+            return [discussion['case_title'], str()]
+        return [discussion['case_title'], wikiparse.wikitext_to_text(discussion['wikitext'])]
+    return [discussion['case_title'], html_to_text(discussion.get('text'))]
+
+def ensure_discussion_html(paths, max_workers=4):
+    """
+    For the discussions that were stored as wikitext only, renders the HTML (action=parse of the stored revid)
+    and adds it to the stored JSON as `text`, so extractors that need the HTML can use it.
+    Rendering happens only once per discussion. The updated files are written through a wikistore.ResultWriter for
+    their directory (atomically, and recorded in its manifest).
+
+    Returns:
+    n - the number of discussions rendered
+    """
+    import wikihelpers as wiki
+    import wikistore
+
+    def needs_html(path):
+        with open(path, "r") as f:
+            discussion = json.load(f)
+        return discussion.get('text') is None and discussion.get('wikitext') not in (None, "DISCUSSION_DOES_NOT_EXIST")
+    todo = [Path(path) for path in paths if needs_html(path)]
+    writers = {directory: wikistore.ResultWriter(directory, pattern="*.json") for directory in {path.parent for path in todo}}
+
+    def render(path):
+        with open(path, "r") as f:
+            discussion = json.load(f)
+        discussion['text'] = wiki.render_wikitext_page(discussion['case_title'], revid=discussion.get('revid'))
+        writers[path.parent].put(path.name, json.dumps(discussion, indent = 4))
+
+    n = 0
+    for path, _, e in wiki.run_concurrently(render, todo, max_workers=max_workers, desc="rendering discussions"):
+        if e is not None:
+            print(f"Could not render {path.name}: {e}")
+        else:
+            n += 1
+    for writer in writers.values():
+        writer.close()
+    return n
+
+"""
+full-text index
+"""
+def open_index(index_file):
+    conn = sqlite3.connect(str(index_file))
+    # indexes built with ':' and '/' kept inside tokens stored "Delete:" as the token `delete:`, so a search for
+    # delete missed it; those are dropped and rebuilt with the default tokenizer
+    table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'discussions'").fetchone()
+    if table_sql is not None and 'tokenchars' in table_sql[0]:
+        print("Rebuilding the full-text index with the default tokenizer.")
+        conn.execute("DROP TABLE discussions")
+        conn.execute("DROP TABLE IF EXISTS indexed_files")
+        conn.commit()
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS discussions USING fts5(case_title UNINDEXED, text, tokenize='unicode61')")
+    # which files have been indexed, and at what modification time, so that updates are incremental
+    conn.execute("CREATE TABLE IF NOT EXISTS indexed_files (filename TEXT PRIMARY KEY, mtime REAL, doc_rowid INTEGER)")
+    return conn
+
+def build_index(discussion_dir, index_file, max_workers=None, batch_size=500):
+    """
+    Adds the discussions that are new (or changed) since the last run to the full-text index.
+    Text extraction runs across a process pool; inserts are committed in batches.
+
+    Returns:
+    n - the number of discussions (re-)indexed
+    """
+    conn = open_index(index_file)
+    indexed = {filename: (mtime, rowid) for filename, mtime, rowid in conn.execute("SELECT filename, mtime, doc_rowid FROM indexed_files")}
+
+    to_index = []
+    for path in discussion_files(discussion_dir):
+        mtime = path.stat().st_mtime
+        if path.name not in indexed or indexed[path.name][0] < mtime:
+            to_index.append((path, mtime))
+    print(f"{len(to_index)} discussions to index.")
+
+    n = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        texts = executor.map(read_discussion_text, [path for path, _ in to_index], chunksize=32)
+        for (path, mtime), (case_title, text) in tqdm(zip(to_index, texts), total=len(to_index), desc="indexing"):
+            if path.name in indexed:
+                conn.execute("DELETE FROM discussions WHERE rowid = ?", (indexed[path.name][1],))
+            cursor = conn.execute("INSERT INTO discussions (case_title, text) VALUES (?, ?)", (case_title, text))
+            conn.execute("INSERT OR REPLACE INTO indexed_files (filename, mtime, doc_rowid) VALUES (?, ?, ?)", (path.name, mtime, cursor.lastrowid))
+            n += 1
+            if n % batch_size == 0:
+                conn.commit()
+
+    conn.commit()
+    conn.close()
+    return n
+
+def search(index_file, query, limit=100):
+    """
+    Searches the index with an FTS5 query, e.g. '"WP:GNG"', 'notability AND "WP:NOTNEWS"', 'delete', or 'Username'.
+    Shortcuts like WP:GNG are indexed as separate words (wp, gng), so quote them to match them as a phrase.
+
+    Returns:
+    df - a DataFrame with case_title | snippet, best matches first
+    """
+    conn = open_index(index_file)
+    rows = conn.execute(
+        "SELECT case_title, snippet(discussions, 1, '[', ']', '...', 16) FROM discussions WHERE discussions MATCH ? ORDER BY rank LIMIT ?",
+        (query, limit)).fetchall()
+    conn.close()
+    return pd.DataFrame(rows, columns=['case_title', 'snippet'])
+
+"""
+policy citations
+"""
+def load_shortcuts(shortcut_file):
+    """
+    Reads the policy shortcut list: a TSV with a `shortcut` column (e.g. WP:GNG) and optionally a `policy` column,
+    so that several shortcuts (WP:N, WP:NOTE, Wikipedia:Notability) can be counted as one policy.
+
+    Returns:
+    shortcuts - a dictionary of upper-cased shortcut -> policy
+    """
+    df = pd.read_csv(shortcut_file, sep="\t", header=0, dtype=str)
+    if 'policy' not in df.columns:
+        df['policy'] = df['shortcut']
+    df = df.dropna(subset=['shortcut'])
+    df['shortcut'] = df['shortcut'].str.strip()
+    # a shortcut with an empty policy cell is its own policy
+    df['policy'] = df['policy'].str.strip().replace('', None).fillna(df['shortcut'])
+    return dict(zip(df['shortcut'].str.upper(), df['policy']))
+
+def _is_boundary(text, start, end):
+    # a shortcut only counts if it isn't part of a longer one (WP:N inside WP:NOT) or a longer word
+    before = text[start - 1] if start > 0 else ' '
+    after = text[end] if end < len(text) else ' '
+    return not (before.isalnum() or before in ':_') and not (after.isalnum() or after == '_')
+
+class PolicyScanner:
+    """
+    Counts every shortcut in a text in one pass: an Aho-Corasick automaton over all the shortcuts if pyahocorasick
+    is installed, otherwise one combined (longest-first) regex, instead of one regex per policy.
+    """
+    def __init__(self, shortcuts):
+        self.shortcuts = shortcuts
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for shortcut in shortcuts:
+                self.automaton.add_word(shortcut, shortcut)
+            self.automaton.make_automaton()
+        else:
+            self.automaton = None
+            alternation = '|'.join(re.escape(s) for s in sorted(shortcuts, key=len, reverse=True))
+            self.pattern = re.compile(f"(?<![\\w:])(?:{alternation})(?!\\w)")
+
+    def count(self, text):
+        """
+        Returns a dictionary of policy -> number of citations in the text (case-insensitive).
+        """
+        text = text.upper()
+        counts = {}
+        if self.automaton is not None:
+            for end, shortcut in self.automaton.iter(text):
+                start = end - len(shortcut) + 1
+                if _is_boundary(text, start, end + 1):
+                    policy = self.shortcuts[shortcut]
+                    counts[policy] = counts.get(policy, 0) + 1
+        else:
+            for match in self.pattern.finditer(text):
+                policy = self.shortcuts[match.group(0)]
+                counts[policy] = counts.get(policy, 0) + 1
+        return counts
+
+# built once per worker process
+_scanner = None
+
+def _init_scanner(shortcuts):
+    global _scanner
+    _scanner = PolicyScanner(shortcuts)
+
+def _scan_discussion(path):
+    case_title, text = read_discussion_text(path)
+    return case_title, _scanner.count(text)
+
+def scan_policies(discussion_dir, shortcuts, output_file, max_workers=None):
+    """
+    Streams every stored discussion through the policy scanner across a process pool and saves the
+    sparse case x policy count matrix in long form (only the non-zero cells) as parquet.
+
+    shortcuts - the output of load_shortcuts
+
+    Returns:
+    counts_df - a DataFrame with case_title | policy | count (categorical case_title and policy),
+        see to_sparse_matrix for a scipy matrix
+    """
+    files = discussion_files(discussion_dir)
+    case_titles = []
+    policies = []
+    counts = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_scanner, initargs=(shortcuts,)) as executor:
+        for case_title, case_counts in tqdm(executor.map(_scan_discussion, files, chunksize=32), total=len(files), desc="scanning"):
+            for policy, count in case_counts.items():
+                case_titles.append(case_title)
+                policies.append(policy)
+                counts.append(count)
+
+    counts_df = pd.DataFrame({'case_title': case_titles, 'policy': policies, 'count': counts})
+    counts_df['case_title'] = counts_df['case_title'].astype('category')
+    counts_df['policy'] = pd.Categorical(counts_df['policy'], categories=sorted(set(shortcuts.values())))
+    counts_df['count'] = counts_df['count'].astype('int32')
+    counts_df.to_parquet(output_file, index=False)
+    print(f"Saved {len(counts_df)} non-zero (case, policy) counts for {counts_df['case_title'].nunique()} cases to {output_file}")
+    return counts_df
+
+def to_sparse_matrix(counts_df):
+    """
+    Turns the long policy counts into a scipy.sparse CSR matrix (cases x policies).
+
+    Returns:
+    matrix, case_titles, policies
+    """
+    from scipy import sparse
+    rows = counts_df['case_title'].cat.codes.to_numpy()
+    cols = counts_df['policy'].cat.codes.to_numpy()
+    matrix = sparse.csr_matrix((counts_df['count'].to_numpy(), (rows, cols)),
+                               shape=(len(counts_df['case_title'].cat.categories), len(counts_df['policy'].cat.categories)))
+    return matrix, list(counts_df['case_title'].cat.categories), list(counts_df['policy'].cat.categories)
+
+"""
+participants and comments
+"""
+SIGNATURE_TIME_RE = re.compile(r'(\d{1,2}:\d{2}, \d{1,2} [A-Z][a-z]+ \d{4}) \(UTC\)')
+USER_LINK_RE = re.compile(r'(?:title=|/wiki/)(?:User_talk:|User talk:|User:|Special:Contributions/)([^/#?&]+)')
+COMMENT_COLUMNS = ['case_title', 'position', 'user', 'timestamp', 'vote', 'source_file']
+
+def _link_user(href):
+    match = USER_LINK_RE.search(unquote(href))
+    if match:
+        return match.group(1).replace('_', ' ')
+    return None
+
+@wikimetrics.timed('parse.extract_comments')
+def extract_comments(html):
+    """
+    Walks a discussion's HTML once, in document order, and pulls out the signed comments.
+    A comment ends at a signature timestamp ("12:00, 1 January 2020 (UTC)"); its author is the last user link
+    (User:, User talk:, Special:Contributions/) before the timestamp, and its !vote is the first bolded text in it.
+    The first comment is usually the nomination, and the closer's comment carries the bolded result.
+
+    Returns:
+    comments - a list of [position, user, timestamp string, vote]
+    """
+    if not html or html == "DISCUSSION_DOES_NOT_EXIST":
+        return list()
+    soup = BeautifulSoup(html, 'lxml')
+
+    comments = []
+    last_user = None
+    vote = None
+    for node in soup.descendants:
+        if isinstance(node, NavigableString):
+            for match in SIGNATURE_TIME_RE.finditer(str(node)):
+                if last_user is not None:
+                    comments.append([len(comments), last_user, match.group(1), vote])
+                last_user = None
+                vote = None
+        elif node.name == 'a' and node.has_attr('href'):
+            user = _link_user(node['href'])
+            if user is not None:
+                last_user = user
+        elif node.name == 'b' and vote is None:
+            bolded = node.get_text().strip()
+            if bolded:
+                vote = bolded[:50]
+    return comments
+
+def _extract_discussion_comments(path):
+    with open(path, "r") as f:
+        discussion = json.load(f)
+    return [[discussion['case_title'], *comment, path.name] for comment in extract_comments(discussion.get('text'))]
+
+def _comments_to_df(rows):
+    df = pd.DataFrame(rows, columns=COMMENT_COLUMNS)
+    df['position'] = df['position'].astype('int32')
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%H:%M, %d %B %Y', errors='coerce')
+    df['vote'] = df['vote'].str.lower()
+    return df
+
+def extract_participants(discussion_dir, output_dir, max_workers=None, batch_size=5000):
+    """
+    Turns the discussion corpus into a comment edge list (case_title | position | user | timestamp | vote | source_file),
+    written as parquet part files every `batch_size` discussions, so memory stays bounded.
+    Runs are incremental: discussions already in a part file (or recorded as having no comments) are skipped.
+    Read the result with pd.read_parquet(output_dir).
+
+    Returns:
+    n - the number of discussions processed in this run
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    empty_log = output_dir / "_no_comments.txt"
+
+    parts = sorted(output_dir.glob("part_*.parquet"))
+    done = set()
+    for part in parts:
+        done.update(pd.read_parquet(part, columns=['source_file'])['source_file'].unique())
+    if empty_log.exists():
+        done.update(line for line in empty_log.read_text().split('\n') if line)
+
+    files = [path for path in discussion_files(discussion_dir) if path.name not in done]
+    print(f"{len(files)} discussions to extract, {len(done)} already done.")
+
+    # signatures and bolded !votes are read from the HTML, so wikitext-only discussions are rendered first
+    ensure_discussion_html(files)
+    next_part = len(parts) + 1
+
+    rows = []
+    empty = []
+    def flush():
+        nonlocal rows, empty, next_part
+        if rows:
+            _comments_to_df(rows).to_parquet(output_dir / f"part_{next_part:05d}.parquet", index=False)
+            next_part += 1
+        if empty:
+            with open(empty_log, "a") as f:
+                f.write('\n'.join(empty) + '\n')
+        rows = []
+        empty = []
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_extract_discussion_comments, files, chunksize=32)
+        for i, (path, comments) in enumerate(tqdm(zip(files, results), total=len(files), desc="extracting")):
+            if comments:
+                rows += comments
+            else:
+                empty.append(path.name)
+            if (i + 1) % batch_size == 0:
+                flush()
+    flush()
+
+    return len(files)
+
+def main():
+    parent_dir = Path.cwd().parent
+    index_file = parent_dir / args.index
+
+    if args.command == "index":
+        n = build_index(parent_dir / "deletion_discussions", index_file, max_workers=args.workers)
+        print(f"Indexed {n} discussions into {index_file}")
+    elif args.command == "search":
+        results = search(index_file, args.query, limit=args.limit)
+        print(results.to_string(index=False))
+    elif args.command == "policies":
+        shortcuts = load_shortcuts(parent_dir / args.shortcuts)
+        print(f"Scanning for {len(shortcuts)} shortcuts of {len(set(shortcuts.values()))} policies.")
+        scan_policies(parent_dir / "deletion_discussions", shortcuts, parent_dir / args.output, max_workers=args.workers)
+    elif args.command == "participants":
+        n = extract_participants(parent_dir / "deletion_discussions", parent_dir / "participants", max_workers=args.workers)
+        print(f"Extracted comments from {n} discussions into {parent_dir / 'participants'}")
+    elif args.command == "users":
+        import wikihelpers as wiki
+        usernames = pd.read_parquet(parent_dir / "participants", columns=['user'])['user'].unique()
+        df = wiki.collect_user_info(usernames, parent_dir / args.users, max_age_days=args.max_age_days)
+        print(f"{len(df)} of {len(usernames)} participants have user metadata in {parent_dir / args.users}")
+
+parser = argparse.ArgumentParser()
+parser.add_argument('command', choices=['index', 'search', 'policies', 'participants', 'users'], help='`index` to add new discussions to the index, `search` to query it, `policies` to count policy shortcut citations, `participants` to extract the signed comments, `users` to collect metadata for the participants.')
+parser.add_argument('--query', type=str, help='FTS5 query for `search`, e.g. \'"WP:GNG"\'.')
+parser.add_argument('--limit', type=int, default=100, help='Maximum number of search results.')
+parser.add_argument('--index', type=str, default='discussions_index.sqlite', help='Index file, relative to the parent directory.')
+parser.add_argument('--shortcuts', type=str, default='policy_shortcuts.tsv', help='TSV of policy shortcuts (`shortcut`, optional `policy` columns), relative to the parent directory.')
+parser.add_argument('--output', type=str, default='policy_counts.parquet', help='Output file for `policies`, relative to the parent directory.')
+parser.add_argument('--users', type=str, default='users.sqlite', help='User metadata table for `users`, relative to the parent directory.')
+parser.add_argument('--max-age-days', type=int, default=30, help='Refresh user metadata older than this many days.')
+parser.add_argument('--workers', type=int, default=None, help='Number of processes for text extraction.')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import wikihelpers as wiki
+import wikistore
+from pathlib import Path
+import sqlite3
+import argparse
+import importlib
+
+"""
+Combines the outputs of sharded runs (--shard i/N, each written to a shard_i_of_N directory) into the canonical
+outputs, and checks that every item is in exactly one shard, in the shard its hash puts it in, and that nothing
+is missing.
+
+cases - the monthly deletion_cases/deletion_cases_YYYY_MM_uncleaned.tsv files of 0_get_deletion_cases.py, and the
+    shards' case indexes (relists are only dropped once every shard's listings are in one index)
+case_data - the case_meta_data/chunk_XXXX.tsv files of 1_get_case_data.py (including --stream chunks), renumbered
+    into the same chunks of 100 that an unsharded run would have written
+earliest - the 1.5_earliest_revisions_{type}_XXXX.tsv files of 1.5_get_e_revs.py
+stores - sqlite stores (redirects, users, logs, caches) from each machine, merged table by table
+"""
+
+def shard_dirs(base_dir, n_shards):
+    """
+    Returns:
+    the shard directories of base_dir, in shard order. Raises a ValueError if any of them is missing.
+    """
+    dirs = [wiki.shard_dir(base_dir, (i, n_shards)) for i in range(n_shards)]
+    missing = [str(d) for d in dirs if not d.exists()]
+    if missing:
+        raise ValueError(f"Missing shard directories: {missing}")
+    return dirs
+
+def check_shards(df, key_col, n_shards):
+    """
+    Checks a combined table with a `shard` column (the shard each row came from).
+
+    Returns:
+    df - without duplicate keys (the row from the key's own shard is kept, otherwise the first)
+    problems - a dictionary with the duplicated and misplaced keys
+    """
+    expected = wiki.shard_of(df[key_col], n_shards)
+    misplaced = df.loc[df['shard'] != expected, key_col].drop_duplicates().tolist()
+    duplicated = df.loc[df.duplicated(subset=[key_col], keep=False), key_col].drop_duplicates().tolist()
+    # of duplicated rows, keep the one from the shard the key belongs to
+    placed_first = df.assign(_misplaced=(df['shard'] != expected)).sort_values('_misplaced', kind='stable')
+    df = placed_first.drop_duplicates(subset=[key_col], keep='first').drop(columns=['_misplaced']).sort_index()
+    return df, {'duplicated': duplicated, 'misplaced': misplaced}
+
+def report(problems, missing=None):
+    for kind, keys in problems.items():
+        print(f"{len(keys)} {kind}" + (f", e.g. {keys[:5]}" if keys else ""))
+    if missing is not None:
+        print(f"{len(missing)} missing" + (f", e.g. {missing[:5]}" if missing else ""))
+
+def write_output(df, path, writer, overwrite=False):
+    """
+    Writes a merged file through the directory's wikistore.ResultWriter (atomically, and recorded in its manifest,
+    so the stage scripts count it as done).
+    """
+    if path.exists() and not overwrite:
+        raise FileExistsError(f"{path} already exists; use --overwrite to replace it")
+    writer.write_df(path.name, df)
+
+def merge_cases(case_dir, n_shards, overwrite=False):
+    """
+    Combines the shards' monthly case files. Every shard writes a file for every month it ran (even with no cases),
+    so a month missing from any shard means that shard didn't finish.
+    The shards' case indexes are merged into case_dir's, and a discussion listed on logs of several shards keeps
+    only its first listing, as in an unsharded run.
+    """
+    stage0 = importlib.import_module("0_get_deletion_cases")
+    dirs = shard_dirs(case_dir, n_shards)
+    index_file = case_dir / stage0.CASE_INDEX_FILE
+    stage0.open_case_index(index_file).close()
+    merge_stores([d / stage0.CASE_INDEX_FILE for d in dirs if (d / stage0.CASE_INDEX_FILE).exists()], index_file)
+    index = stage0.open_case_index(index_file)
+    names = sorted({f.name for d in dirs for f in d.glob("deletion_cases_*_uncleaned.tsv")})
+
+    incomplete = [f"{name} (shard {i})" for name in names for i, d in enumerate(dirs) if not (d / name).exists()]
+    all_problems = {'duplicated': [], 'misplaced': []}
+    writer = wikistore.ResultWriter(case_dir, pattern="deletion_cases_*_uncleaned.tsv")
+    for name in names:
+        frames = []
+        for i, d in enumerate(dirs):
+            if (d / name).exists():
+                shard_df = pd.read_csv(d / name, sep="\t", header=0)
+                shard_df['shard'] = i
+                frames.append(shard_df)
+        df = pd.concat(frames, ignore_index=True)
+
+        # a case is a heading on a daily log, and the logs are what is sharded
+        df['case_key'] = df['log_link'].astype(str) + '\t' + df['case_title'].astype(str)
+        df, problems = check_shards(df, 'case_key', n_shards)
+        # the shard is decided by the log link, not the case key
+        problems['misplaced'] = df.loc[df['shard'] != wiki.shard_of(df['log_link'], n_shards), 'log_link'].drop_duplicates().tolist()
+        for kind in all_problems:
+            all_problems[kind] += problems[kind]
+        # each shard only knew the listings on its own logs
+        df = stage0.record_listings(index, df)
+
+        write_output(df.drop(columns=['shard', 'case_key']), case_dir / name, writer, overwrite=overwrite)
+
+    writer.close()
+    index.close()
+    print(f"Merged {len(names)} monthly case files from {n_shards} shards.")
+    report(all_problems, missing=incomplete)
+
+def merge_case_data(meta_dir, dedup_file, n_shards, chunk_size=100, overwrite=False):
+    """
+    Combines the shards' stage 1 chunk files and writes them back as the chunks an unsharded run would have written
+    (the sorted unique case_title_cleaned of dedup_file, 100 per chunk), so an unsharded rerun skips them.
+    Titles with no row in any shard are listed in case_meta_data/_merge_missing.txt (like the errors of 1_errors.log,
+    they need to be run again).
+    """
+    dirs = shard_dirs(meta_dir, n_shards)
+    frames = []
+    for i, d in enumerate(dirs):
+        for chunk_file in sorted(d.glob(wikistore.CHUNK_PATTERN)):
+            shard_df = pd.read_csv(chunk_file, sep="\t", header=0)
+            shard_df['shard'] = i
+            frames.append(shard_df)
+    df = pd.concat(frames, ignore_index=True)
+    df, problems = check_shards(df, 'page_title', n_shards)
+
+    # the same order and chunking as 1_get_case_data.main
+    cases_df = pd.read_csv(dedup_file, sep="\t", header=0)
+    cases_df.sort_values(by='case_title_cleaned', inplace=True)
+    page_titles = cases_df['case_title_cleaned'].drop_duplicates(keep='first').tolist()
+
+    missing = sorted(set(page_titles) - set(df['page_title']))
+    unexpected = sorted(set(df['page_title']) - set(page_titles))
+    problems['not in the dedup file'] = unexpected
+
+    df = df.set_index('page_title')
+    writer = wikistore.ResultWriter(meta_dir, pattern=wikistore.CHUNK_PATTERN)
+    for i, chunk in enumerate(wiki.chunk_list(page_titles, chunk_size)):
+        # only the titles that have a row (reindexing the missing ones in would turn the int and bool columns into floats)
+        chunk_df = df.loc[[title for title in chunk if title in df.index]].reset_index()
+        write_output(chunk_df[['page_title', 'page_exists', 'returned_title', 'pageid']], meta_dir / f"chunk_{i+1:04d}.tsv", writer, overwrite=overwrite)
+    writer.close()
+
+    wikistore.atomic_write_bytes(meta_dir / "_merge_missing.txt", '\n'.join(missing).encode("utf-8"))
+    print(f"Merged {len(df)} cases from {n_shards} shards into {len(wiki.chunk_list(page_titles, chunk_size))} chunk files.")
+    report(problems, missing=missing)
+
+def merge_earliest(meta_dir, input_file, revision_type, n_shards, overwrite=False):
+    """
+    Combines the shards' earliest revision files into one 1.5_earliest_revisions_{type}_merged.tsv.
+    """
+    dirs = shard_dirs(meta_dir, n_shards)
+    frames = []
+    for i, d in enumerate(dirs):
+        for chunk_file in sorted(d.glob(f"1.5_earliest_revisions_{revision_type}_*.tsv")):
+            shard_df = pd.read_csv(chunk_file, sep="\t", header=0)
+            shard_df['shard'] = i
+            frames.append(shard_df)
+    df = pd.concat(frames, ignore_index=True)
+
+    # shards are by case_title_cleaned; for afd pages that is the page title without the AfD prefix,
+    # and for content pages the stage 1 page_title of the returned_title
+    input_df = pd.read_csv(input_file, sep="\t", header=0)
+    if revision_type == "afd":
+        expected = ("Wikipedia:Articles for deletion/" + input_df['case_title_cleaned'].astype(str)).tolist()
+        df['case_title_cleaned'] = df['page_title'].str.replace("Wikipedia:Articles for deletion/", "", n=1, regex=False)
+    else:
+        input_df = input_df[input_df['page_exists'] == True]
+        expected = input_df['returned_title'].tolist()
+        df['case_title_cleaned'] = df['page_title'].map(dict(zip(input_df['returned_title'], input_df['page_title'])))
+
+    df, problems = check_shards(df.dropna(subset=['case_title_cleaned']), 'page_title', n_shards)
+    misplaced = df['shard'] != wiki.shard_of(df['case_title_cleaned'], n_shards)
+    problems['misplaced'] = df.loc[misplaced, 'page_title'].tolist()
+    missing = sorted(set(expected) - set(df['page_title']))
+
+    with wikistore.ResultWriter(meta_dir, pattern="1.5_earliest_revisions_*.tsv") as writer:
+        write_output(df[['page_title', 'earliest_revision_date']], meta_dir / f"1.5_earliest_revisions_{revision_type}_merged.tsv", writer, overwrite=overwrite)
+    print(f"Merged {len(df)} {revision_type} pages from {n_shards} shards.")
+    report(problems, missing=missing)
+
+def merge_stores(store_files, output_file):
+    """
+    Merges sqlite stores with the same tables (e.g., one redirect store per machine) into output_file.
+    Rows are copied with INSERT OR REPLACE, so a key that several stores have ends up once, from the last store.
+    """
+    conn = sqlite3.connect(str(output_file))
+    for store_file in store_files:
+        conn.execute("ATTACH DATABASE ? AS shard", (str(store_file),))
+        tables = conn.execute("SELECT name, sql FROM shard.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+        for table, sql in tables:
+            # virtual tables (the FTS index) can't be copied like this; rebuild those from the merged files instead
+            if sql.upper().startswith("CREATE VIRTUAL"):
+                print(f"Skipping the virtual table {table} in {store_file}")
+                continue
+            conn.execute(sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+            before = conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+            conn.execute(f"INSERT OR REPLACE INTO main.{table} SELECT * FROM shard.{table}")
+            after = conn.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+            print(f"{store_file}: {table} +{after - before} rows")
+        conn.commit()
+        conn.execute("DETACH DATABASE shard")
+    conn.close()
+
+def main():
+    parent_dir = Path.cwd().parent
+    if args.command == "cases":
+        merge_cases(parent_dir / "deletion_cases", args.shards, overwrite=args.overwrite)
+    elif args.command == "case_data":
+        merge_case_data(parent_dir / "case_meta_data", parent_dir / args.input, args.shards, overwrite=args.overwrite)
+    elif args.command == "earliest":
+        merge_earliest(parent_dir / "case_meta_data", parent_dir / args.input, args.type, args.shards, overwrite=args.overwrite)
+    elif args.command == "stores":
+        merge_stores([parent_dir / f for f in args.stores], parent_dir / args.output)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('command', choices=['cases', 'case_data', 'earliest', 'stores'], help='Which outputs to merge.')
+parser.add_argument('--shards', type=int, help='N, the number of shards the run was split into.')
+parser.add_argument('--input', type=str, default='deletion_cases_sorted_dedup.tsv', help='For case_data and earliest, the input file the stage ran on, relative to the parent directory (for earliest --type content, the combined stage 1 metadata).')
+parser.add_argument('--type', type=str, default='afd', choices=['afd', 'content'], help='For earliest, which earliest revisions to merge.')
+parser.add_argument('--stores', type=str, nargs='+', default=[], help='For stores, the sqlite files to merge, relative to the parent directory.')
+parser.add_argument('--output', type=str, default=None, help='For stores, the merged sqlite file, relative to the parent directory.')
+parser.add_argument('--overwrite', action='store_true', help='Replace canonical files that already exist.')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    main()
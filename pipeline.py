@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+from pathlib import Path
+from datetime import datetime
+import concurrent.futures
+import subprocess
+import hashlib
+import json
+import sys
+import argparse
+import wikistore
+
+"""
+Non-interactive runner for the stage scripts.
+
+Each stage declares its inputs and outputs as glob patterns relative to the data directory (the parent of this
+repo, which is where the stage scripts read and write through Path.cwd().parent). The runner keeps a content hash
+of every stage's inputs in _pipeline_state.json and only reruns a stage when its inputs or its command changed,
+or when its outputs are missing. A stage runs after the stages whose outputs it reads; stages that don't depend
+on each other (e.g., the earliest revisions of the `content` and `afd` pages) run at the same time.
+
+Stages with no inputs (the crawl of the AfD logs) only run when their outputs are missing or they are forced.
+
+Stages 1 and 1.5 skip the chunk files that already exist, and the chunk boundaries move when their input changes,
+so for those stages ('invalidate': True) a change of inputs or command deletes their outputs (and their manifest
+entries) before the rerun. An interrupted run on the same inputs keeps its outputs, so it resumes.
+deletion_cases_sorted_dedup.tsv is built by hand from ./deletion_cases, so it is a source input, not a stage.
+"""
+
+REPO_DIR = Path(__file__).resolve().parent
+DATA_DIR = REPO_DIR.parent
+STATE_FILE = DATA_DIR / "_pipeline_state.json"
+
+def combine_case_meta():
+    """
+    Combines the stage 1 chunk files (including the chunk_stream_*.tsv files of --stream) into one case_meta_data.tsv
+    (the --input of the `content` earliest revisions). A title in more than one chunk file is kept once.
+    """
+    chunks = [pd.read_csv(f, sep="\t", header=0) for f in sorted((DATA_DIR / "case_meta_data").glob(wikistore.CHUNK_PATTERN))]
+    meta_df = pd.concat(chunks, ignore_index=True).drop_duplicates(subset=['page_title'], keep='last')
+    meta_df.to_csv(DATA_DIR / "case_meta_data.tsv", sep="\t", index=False, header=True)
+    print(f"Combined {len(chunks)} chunks ({len(meta_df)} cases) into {DATA_DIR / 'case_meta_data.tsv'}")
+
+# a stage's `run` is either a script and its arguments (run from the repo directory) or a python function;
+# 'invalidate' marks the stages whose old outputs have to go when their inputs change (see needs_fresh_outputs)
+STAGES = [
+    {
+        'name': 'deletion_cases',
+        'run': ['0_get_deletion_cases.py', '--incremental'],
+        'inputs': [],
+        'outputs': ['deletion_cases/deletion_cases_*_uncleaned.tsv'],
+    },
+    {
+        'name': 'case_data',
+        'run': ['1_get_case_data.py', '--yes'],
+        'inputs': ['deletion_cases_sorted_dedup.tsv'],
+        'outputs': [f'case_meta_data/{wikistore.CHUNK_PATTERN}'],
+        'invalidate': True,
+    },
+    {
+        'name': 'case_meta_data',
+        'run': combine_case_meta,
+        'inputs': [f'case_meta_data/{wikistore.CHUNK_PATTERN}'],
+        'outputs': ['case_meta_data.tsv'],
+    },
+    {
+        'name': 'earliest_revisions_afd',
+        'run': ['1.5_get_e_revs.py', '--yes', '--input', 'deletion_cases_sorted_dedup.tsv', '--type', 'afd'],
+        'inputs': ['deletion_cases_sorted_dedup.tsv'],
+        'outputs': ['case_meta_data/1.5_earliest_revisions_afd_*.tsv'],
+        'invalidate': True,
+    },
+    {
+        'name': 'earliest_revisions_content',
+        'run': ['1.5_get_e_revs.py', '--yes', '--input', 'case_meta_data.tsv', '--type', 'content'],
+        'inputs': ['case_meta_data.tsv'],
+        'outputs': ['case_meta_data/1.5_earliest_revisions_content_*.tsv'],
+        'invalidate': True,
+    },
+]
+
+def stage_dependencies(stages):
+    """
+    Returns:
+    a dictionary stage name -> the names of the stages that produce one of its inputs
+    """
+    producers = {}
+    for stage in stages:
+        for pattern in stage['outputs']:
+            producers.setdefault(pattern, []).append(stage['name'])
+    return {stage['name']: sorted({p for pattern in stage['inputs'] for p in producers.get(pattern, []) if p != stage['name']}) for stage in stages}
+
+def file_hash(path, memo):
+    """
+    The sha1 of a file's contents. memo maps paths to [size, mtime_ns, sha1] from earlier runs, so unchanged files
+    aren't read again.
+    """
+    stat = path.stat()
+    known = memo.get(str(path))
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    memo[str(path)] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+    return memo[str(path)][2]
+
+def patterns_hash(patterns, memo):
+    """
+    One hash over the names and contents of every file matching the patterns.
+
+    Returns:
+    digest - the hex digest
+    n - how many files matched
+    """
+    sha = hashlib.sha1()
+    n = 0
+    for pattern in patterns:
+        sha.update(pattern.encode("utf-8"))
+        for path in sorted(DATA_DIR.glob(pattern)):
+            if path.is_file():
+                sha.update(str(path.relative_to(DATA_DIR)).encode("utf-8"))
+                sha.update(file_hash(path, memo).encode("utf-8"))
+                n += 1
+    return sha.hexdigest(), n
+
+def describe_run(stage):
+    return stage['run'].__name__ if callable(stage['run']) else ' '.join(stage['run'])
+
+def stale_reason(stage, state, memo, force=False):
+    """
+    Returns:
+    why the stage needs to run, or None if it is up to date
+    """
+    if force:
+        return "forced"
+    previous = state['stages'].get(stage['name'])
+    if previous is None:
+        return "never run"
+    if previous['run'] != describe_run(stage):
+        return "command changed"
+    if patterns_hash(stage['outputs'], memo)[1] == 0:
+        return "outputs missing"
+    if previous['inputs_hash'] != patterns_hash(stage['inputs'], memo)[0]:
+        return "inputs changed"
+    return None
+
+def needs_fresh_outputs(stage, reason, state, inputs_hash):
+    """
+    True if the stage's existing outputs were made from other inputs (or by another command) and have to be deleted
+    before it runs. Outputs of an earlier, interrupted run on the same inputs and command are kept.
+    """
+    if not stage.get('invalidate') or reason not in ("inputs changed", "command changed"):
+        return False
+    started = state.get('started', {}).get(stage['name'])
+    return started is None or started['run'] != describe_run(stage) or started['inputs_hash'] != inputs_hash
+
+def discard_stage_outputs(stage):
+    """
+    Deletes the stage's outputs and drops them from their directories' manifests (see wikistore.discard_outputs).
+    """
+    n = 0
+    for pattern in stage['outputs']:
+        n += wikistore.discard_outputs(DATA_DIR / Path(pattern).parent, Path(pattern).name)
+    return n
+
+def run_stage(stage):
+    """
+    Runs one stage to completion: scripts as a subprocess from the repo directory, functions in this process.
+    Raises if the stage fails.
+    """
+    if callable(stage['run']):
+        stage['run']()
+        return
+    log_file = DATA_DIR / "pipeline_logs" / f"{stage['name']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, "w") as log:
+        subprocess.run([sys.executable] + stage['run'], cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, check=True)
+
+def load_state():
+    if STATE_FILE.exists():
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    return {'stages': {}, 'file_hashes': {}}
+
+def save_state(state):
+    tmp_file = STATE_FILE.with_name(f".{STATE_FILE.name}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent = 4)
+    tmp_file.replace(STATE_FILE)
+
+def run_pipeline(stages=STAGES, only=None, force=(), dry_run=False, max_workers=4):
+    """
+    Runs every stage that is out of date, in dependency order, with independent stages in parallel.
+
+    only - stage names to consider (their dependencies are still waited on, but not run); None for all stages
+    force - stage names to run even if they are up to date
+    dry_run - print what would run and why, without running anything
+
+    Returns:
+    results - a dictionary stage name -> 'ran', 'up to date', 'failed', 'skipped' (a dependency failed) or 'not selected'
+    """
+    state = load_state()
+    memo = state['file_hashes']
+    dependencies = stage_dependencies(stages)
+    by_name = {stage['name']: stage for stage in stages}
+    results = {}
+
+    # a dry run can't know what upstream stages will change, so it only reports each stage's current state
+    if dry_run:
+        for stage in stages:
+            if only is not None and stage['name'] not in only:
+                continue
+            reason = stale_reason(stage, state, memo, force=stage['name'] in force)
+            fresh = reason is not None and needs_fresh_outputs(stage, reason, state, patterns_hash(stage['inputs'], memo)[0])
+            print(f"{stage['name']}: {'would run (' + reason + ')' if reason else 'up to date'}{', deleting its old outputs first' if fresh else ''}; after {dependencies[stage['name']] or 'nothing'}")
+        return results
+
+    pending = [stage['name'] for stage in stages]
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            n_pending = len(pending)
+            for name in list(pending):
+                if any(results.get(d) in ('failed', 'skipped') for d in dependencies[name]):
+                    results[name] = 'skipped'
+                    pending.remove(name)
+                    print(f"{name}: skipped, a stage it depends on failed")
+                    continue
+                if any(d not in results for d in dependencies[name]):
+                    continue
+                pending.remove(name)
+                stage = by_name[name]
+                if only is not None and name not in only:
+                    results[name] = 'not selected'
+                    continue
+                reason = stale_reason(stage, state, memo, force=name in force)
+                if reason is None:
+                    results[name] = 'up to date'
+                    print(f"{name}: up to date")
+                    continue
+                # hash the inputs as they are when the stage starts
+                inputs_hash = patterns_hash(stage['inputs'], memo)[0]
+                if needs_fresh_outputs(stage, reason, state, inputs_hash):
+                    print(f"{name}: deleted {discard_stage_outputs(stage)} outputs made from the old inputs")
+                state.setdefault('started', {})[name] = {'run': describe_run(stage), 'inputs_hash': inputs_hash}
+                save_state(state)
+                print(f"{name}: running ({reason}): {describe_run(stage)}")
+                running[executor.submit(run_stage, stage)] = (name, inputs_hash)
+
+            if not running:
+                if pending and len(pending) == n_pending:
+                    raise ValueError(f"The stages {pending} depend on each other")
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, inputs_hash = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    results[name] = 'failed'
+                    print(f"{name}: failed: {e}")
+                    continue
+                results[name] = 'ran'
+                state['stages'][name] = {'run': describe_run(by_name[name]), 'inputs_hash': inputs_hash, 'finished': datetime.now().isoformat()}
+                save_state(state)
+                print(f"{name}: finished")
+
+    save_state(state)
+    return results
+
+def main():
+    names = [stage['name'] for stage in STAGES]
+    for name in (args.stages or []) + (args.force or []):
+        if name not in names:
+            raise ValueError(f"There is no stage {name}; the stages are {names}")
+    results = run_pipeline(only=args.stages, force=args.force or (), dry_run=args.dry_run, max_workers=args.workers)
+    if 'failed' in results.values():
+        sys.exit(1)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--stages', type=str, nargs='+', default=None, help='Only consider these stages (default: all).')
+parser.add_argument('--force', type=str, nargs='+', default=None, help='Run these stages even if they are up to date.')
+parser.add_argument('--dry-run', action='store_true', help='Print which stages are out of date and why, without running them.')
+parser.add_argument('--workers', type=int, default=4, help='How many independent stages can run at the same time.')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    main()
@@ -0,0 +1,81 @@
+import importlib
+import json
+import pandas as pd
+import pytest
+
+# the stage 0 module name starts with a digit
+stage0 = importlib.import_module("0_get_deletion_cases")
+
+def log(day):
+    return f"/wiki/Wikipedia:Articles_for_deletion/Log/2020_January_{day}"
+
+def case(day, title, multiple_noms=False):
+    return [log(day), title, f"Wikipedia:Articles_for_deletion/{title}", multiple_noms]
+
+def cases(rows):
+    return pd.DataFrame(rows, columns=stage0.CASE_COLUMNS)
+
+@pytest.fixture
+def index(tmp_path):
+    conn = stage0.open_case_index(tmp_path / stage0.CASE_INDEX_FILE)
+    yield conn
+    conn.close()
+
+def test_relist_on_a_later_log_is_dropped(index):
+    first = stage0.record_listings(index, cases([case(1, "Foo"), case(1, "Bar"), [log(1), None, None, False]]))
+    # rows with no discussion url are kept for correcting in post
+    assert first['case_title'].tolist()[:2] == ["Foo", "Bar"]
+    assert len(first) == 3
+
+    # Foo is relisted on the 8th; the 8th is read again later and Foo still isn't kept there
+    for _ in range(2):
+        later = stage0.record_listings(index, cases([case(8, "Foo"), case(8, "Baz")]))
+        assert later['case_title'].tolist() == ["Baz"]
+
+    discussions = dict(index.execute("SELECT case_title, relists FROM discussions").fetchall())
+    assert discussions == {"Foo": 1, "Bar": 0, "Baz": 0}
+
+def test_relist_read_before_its_first_listing(index):
+    # logs can be read out of order (e.g., across shards): the earlier log wins once it is recorded
+    assert stage0.record_listings(index, cases([case(8, "Foo")]))['case_title'].tolist() == ["Foo"]
+    assert stage0.record_listings(index, cases([case(1, "Foo")]))['case_title'].tolist() == ["Foo"]
+    assert stage0.record_listings(index, cases([case(8, "Foo")]))['case_title'].tolist() == []
+
+def test_discussion_gone_from_its_first_log_falls_back_to_its_next_listing(index):
+    stage0.record_listings(index, cases([case(1, "Foo"), case(1, "Bar")]))
+    stage0.record_listings(index, cases([case(8, "Foo", multiple_noms=True)]))
+
+    # the 1st is read again without Foo (moved to the 8th) or Bar (no other listing)
+    gone = stage0.drop_missing_listings(index, log(1), cases([]))
+    assert sorted(gone) == ["Wikipedia:Articles_for_deletion/Bar", "Wikipedia:Articles_for_deletion/Foo"]
+
+    promoted = stage0.first_listing_rows(index, sorted(gone))
+    assert promoted[['case_title', 'log_link', 'multiple_noms', 'year', 'month', 'day']].values.tolist() == [
+        ["Bar", log(1), False, 2020, "January", 1],
+        ["Foo", log(8), True, 2020, "January", 8],
+    ]
+    # Foo's listing on the 8th now counts as its first
+    assert stage0.record_listings(index, cases([case(8, "Foo")]))['case_title'].tolist() == ["Foo"]
+
+def test_incremental_refresh_keeps_discussions_that_left_their_first_log(tmp_path, monkeypatch):
+    case_dir = tmp_path / "deletion_cases"
+    case_dir.mkdir()
+    index = stage0.open_case_index(case_dir / stage0.CASE_INDEX_FILE)
+    month_df = stage0.record_listings(index, cases([case(1, "Foo"), case(1, "Bar"), case(1, "Qux"), case(8, "Foo"), case(8, "Baz")]))
+    index.close()
+    month_df['year'] = 2020
+    month_df['month'] = "January"
+    month_df['day'] = [1, 1, 1, 8]
+    with stage0.wikistore.ResultWriter(case_dir, pattern="deletion_cases_*_uncleaned.tsv") as writer:
+        writer.write_df("deletion_cases_2020_01_uncleaned.tsv", month_df)
+    with open(case_dir / "_log_state.json", "w") as f:
+        json.dump({'high_water_mark': '2020-01-10', 'lastrevids': {}}, f)
+
+    # only the 1st was edited: Foo was moved to the 8th and Bar was removed; Qux is still there
+    monkeypatch.setattr(stage0.wiki, 'get_last_revids', lambda titles: {t: (5 if t.endswith("2020_January_1") else None) for t in titles})
+    monkeypatch.setattr(stage0, 'get_deletion_cases', lambda log_link, output: output.append(case(1, "Qux")))
+    monkeypatch.setattr(pd.Timestamp, 'today', classmethod(lambda cls: pd.Timestamp("2020-01-12")))
+    stage0.refresh_recent_logs(case_dir, lookback_days=14)
+
+    refreshed = pd.read_csv(case_dir / "deletion_cases_2020_01_uncleaned.tsv", sep="\t", header=0)
+    assert sorted(zip(refreshed['case_title'], refreshed['day'])) == [("Bar", 1), ("Baz", 8), ("Foo", 8), ("Qux", 1)]
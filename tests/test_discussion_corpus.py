@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import pytest
+import discussion_corpus
+
+def write_discussion(discussion_dir, name, case_title, html):
+    with open(discussion_dir / f"{name}.json", "w") as f:
+        json.dump({'case_title': case_title, 'url': '', 'text': html}, f)
+
+def make_index(tmp_path):
+    discussion_dir = tmp_path / "deletion_discussions"
+    discussion_dir.mkdir()
+    write_discussion(discussion_dir, "Foo", "Wikipedia:Articles_for_deletion/Foo",
+                     "<p><b>Delete:</b> fails WP:GNG. --Alice</p>")
+    write_discussion(discussion_dir, "Bar", "Wikipedia:Articles_for_deletion/Bar",
+                     "<p><b>Keep:</b> meets notability. --Bob</p><p><b>Comment:</b> see WP:NOTNEWS</p>")
+    index_file = tmp_path / "index.sqlite"
+    assert discussion_corpus.build_index(discussion_dir, index_file, max_workers=1) == 2
+    return discussion_dir, index_file
+
+def test_search_finds_plain_vote_words(tmp_path):
+    _, index_file = make_index(tmp_path)
+
+    assert discussion_corpus.search(index_file, "delete")['case_title'].tolist() == ["Wikipedia:Articles_for_deletion/Foo"]
+    assert discussion_corpus.search(index_file, "comment")['case_title'].tolist() == ["Wikipedia:Articles_for_deletion/Bar"]
+    assert discussion_corpus.search(index_file, "keep")['case_title'].tolist() == ["Wikipedia:Articles_for_deletion/Bar"]
+
+def test_search_matches_shortcuts_as_phrases(tmp_path):
+    _, index_file = make_index(tmp_path)
+
+    assert discussion_corpus.search(index_file, '"WP:GNG"')['case_title'].tolist() == ["Wikipedia:Articles_for_deletion/Foo"]
+    assert discussion_corpus.search(index_file, '"WP:NOTNEWS"')['case_title'].tolist() == ["Wikipedia:Articles_for_deletion/Bar"]
+
+def test_index_with_old_tokenizer_is_rebuilt(tmp_path):
+    discussion_dir, index_file = make_index(tmp_path)
+    index_file.unlink()
+    conn = sqlite3.connect(str(index_file))
+    conn.execute("CREATE VIRTUAL TABLE discussions USING fts5(case_title UNINDEXED, text, tokenize='unicode61 tokenchars '':/''')")
+    conn.execute("CREATE TABLE indexed_files (filename TEXT PRIMARY KEY, mtime REAL, doc_rowid INTEGER)")
+    conn.close()
+
+    assert discussion_corpus.build_index(discussion_dir, index_file, max_workers=1) == 2
+    assert len(discussion_corpus.search(index_file, "delete")) == 1
+
+def test_load_shortcuts_fills_missing_policies(tmp_path):
+    shortcut_file = tmp_path / "shortcuts.tsv"
+    shortcut_file.write_text("shortcut\tpolicy\nWP:GNG\tNotability\nWP:N\t\n wp:note \tNotability\n")
+
+    assert discussion_corpus.load_shortcuts(shortcut_file) == {'WP:GNG': 'Notability', 'WP:N': 'WP:N', 'WP:NOTE': 'Notability'}
+
+def test_load_shortcuts_without_policy_column(tmp_path):
+    shortcut_file = tmp_path / "shortcuts.tsv"
+    shortcut_file.write_text("shortcut\nWP:GNG\nWP:NOTNEWS\n")
+
+    assert discussion_corpus.load_shortcuts(shortcut_file) == {'WP:GNG': 'WP:GNG', 'WP:NOTNEWS': 'WP:NOTNEWS'}
+
+SHORTCUTS = {'WP:N': 'Notability', 'WP:NOT': 'What Wikipedia is not', 'WP:NOTNEWS': 'Not news', 'WP:GNG': 'Notability'}
+SCANNED_TEXT = "Delete per wp:notnews and WP:NOT. Fails WP:GNG, WP:N (see WP:NOTE, XWP:GNG and WP:GNGX)."
+SCANNED_COUNTS = {'Not news': 1, 'What Wikipedia is not': 1, 'Notability': 2}
+
+def test_scanner_regex_matches_whole_shortcuts_longest_first(monkeypatch):
+    monkeypatch.setattr(discussion_corpus, 'ahocorasick', None)
+
+    assert discussion_corpus.PolicyScanner(SHORTCUTS).count(SCANNED_TEXT) == SCANNED_COUNTS
+
+def test_scanner_automaton_matches_whole_shortcuts_longest_first():
+    pytest.importorskip("ahocorasick")
+    scanner = discussion_corpus.PolicyScanner(SHORTCUTS)
+    assert scanner.automaton is not None
+
+    assert scanner.count(SCANNED_TEXT) == SCANNED_COUNTS
+
+def test_boundary_check_of_automaton_matches():
+    text = "WP:NOT, XWP:N WP:N_X WP:N."
+    assert not discussion_corpus._is_boundary(text, 0, 4)  # WP:N inside WP:NOT
+    assert discussion_corpus._is_boundary(text, 0, 6)
+    assert not discussion_corpus._is_boundary(text, 9, 13)  # inside XWP:N
+    assert not discussion_corpus._is_boundary(text, 14, 18)  # followed by _
+    assert discussion_corpus._is_boundary(text, 21, 25)
+
+def test_scan_policies_with_empty_policy_cell(tmp_path):
+    discussion_dir, _ = make_index(tmp_path)
+    shortcut_file = tmp_path / "shortcuts.tsv"
+    shortcut_file.write_text("shortcut\tpolicy\nWP:GNG\tNotability\nWP:N\t\n")
+
+    counts_df = discussion_corpus.scan_policies(discussion_dir, discussion_corpus.load_shortcuts(shortcut_file), tmp_path / "counts.parquet", max_workers=1)
+
+    assert list(counts_df['policy'].cat.categories) == ['Notability', 'WP:N']
+    assert counts_df[['case_title', 'policy', 'count']].astype(str).values.tolist() == [["Wikipedia:Articles_for_deletion/Foo", "Notability", "1"]]
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+import merge_shards
+
+META_COLUMNS = ['page_title', 'page_exists', 'returned_title', 'pageid']
+
+@pytest.fixture(autouse=True)
+def plain_chunk_list(monkeypatch):
+    # wikihelpers.chunk_list needs itertools.batched (Python 3.12)
+    monkeypatch.setattr(merge_shards.wiki, 'chunk_list', lambda items, n: [items[i:i + n] for i in range(0, len(items), n)])
+
+def write_chunk(path, rows):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(rows, columns=META_COLUMNS).to_csv(path, sep="\t", index=False)
+
+def test_check_shards_keeps_the_row_from_the_keys_own_shard():
+    # with 2 shards, Beta belongs to shard 1 and Gamma to shard 0
+    df = pd.DataFrame({'page_title': ['Beta', 'Gamma', 'Beta'], 'pageid': [99, 3, 2], 'shard': [0, 0, 1]})
+
+    df, problems = merge_shards.check_shards(df, 'page_title', 2)
+
+    assert df[['page_title', 'pageid']].values.tolist() == [['Gamma', 3], ['Beta', 2]]
+    assert problems == {'duplicated': ['Beta'], 'misplaced': ['Beta']}
+
+def test_merge_case_data_rechunks_like_an_unsharded_run(tmp_path):
+    meta_dir = tmp_path / "case_meta_data"
+    dedup_file = tmp_path / "deletion_cases_sorted_dedup.tsv"
+    pd.DataFrame({'case_title_cleaned': ['Zeta', 'Alpha', 'Gamma', 'Beta', 'Epsilon', 'Delta', 'Alpha']}).to_csv(dedup_file, sep="\t", index=False)
+
+    # shard 0 owns Epsilon and Gamma; it also has a stray copy of Beta, and Zeta, which belongs to shard 1
+    write_chunk(meta_dir / "shard_0_of_2" / "chunk_0001.tsv", [['Epsilon', True, 'Epsilon', 5], ['Gamma', False, None, None], ['Beta', True, 'Beta', 99]])
+    write_chunk(meta_dir / "shard_0_of_2" / "chunk_stream_00001.tsv", [['Zeta', True, 'Zeta (film)', 6]])
+    # shard 1 never got to Delta
+    write_chunk(meta_dir / "shard_1_of_2" / "chunk_0001.tsv", [['Alpha', True, 'Alpha', 1], ['Beta', True, 'Beta', 2]])
+
+    merge_shards.merge_case_data(meta_dir, dedup_file, 2, chunk_size=2)
+
+    chunks = {f.name: pd.read_csv(f, sep="\t", header=0) for f in sorted(meta_dir.glob("chunk_*.tsv"))}
+    assert list(chunks) == ['chunk_0001.tsv', 'chunk_0002.tsv', 'chunk_0003.tsv']
+    assert chunks['chunk_0001.tsv'][['page_title', 'pageid']].values.tolist() == [['Alpha', 1], ['Beta', 2]]
+    assert chunks['chunk_0002.tsv']['page_title'].tolist() == ['Epsilon']
+    assert chunks['chunk_0003.tsv']['page_title'].tolist() == ['Gamma', 'Zeta']
+    assert chunks['chunk_0003.tsv']['returned_title'].tolist()[1] == 'Zeta (film)'
+    assert (meta_dir / "_merge_missing.txt").read_text() == "Delta"
+
+    # the merged chunks count as done for an unsharded rerun
+    writer = merge_shards.wikistore.ResultWriter(meta_dir, pattern=merge_shards.wikistore.CHUNK_PATTERN)
+    assert all(writer.is_done(name) for name in chunks)
+    writer.close()
+
+def test_merge_case_data_refuses_to_overwrite(tmp_path):
+    meta_dir = tmp_path / "case_meta_data"
+    dedup_file = tmp_path / "deletion_cases_sorted_dedup.tsv"
+    pd.DataFrame({'case_title_cleaned': ['Alpha']}).to_csv(dedup_file, sep="\t", index=False)
+    write_chunk(meta_dir / "shard_0_of_2" / "chunk_0001.tsv", [])
+    write_chunk(meta_dir / "shard_1_of_2" / "chunk_0001.tsv", [['Alpha', True, 'Alpha', 1]])
+    write_chunk(meta_dir / "chunk_0001.tsv", [['Alpha', True, 'Alpha', 1]])
+
+    with pytest.raises(FileExistsError):
+        merge_shards.merge_case_data(meta_dir, dedup_file, 2, chunk_size=2)
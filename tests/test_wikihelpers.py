@@ -0,0 +1,49 @@
+import pandas as pd
+
+import wikihelpers as wiki
+
+
+CONTRIBUTIONS = pd.DataFrame({
+    'revid': [1, 2, 3, 4, 5],
+    'timestamp': pd.to_datetime(['2020-01-10 00:00', '2020-02-05 00:00', '2020-03-01 08:00', '2020-03-15 20:00', '2020-04-01 09:00']),
+})
+
+def fake_fetch(username, start, stop, endpoint=None):
+    in_window = (CONTRIBUTIONS['timestamp'] >= start) & (CONTRIBUTIONS['timestamp'] <= stop)
+    return CONTRIBUTIONS[in_window].reset_index(drop=True)
+
+def test_contribution_windows_cut_at_boundaries():
+    windows = wiki.contribution_windows('2020-01-15', '2020-03-10', freq='MS')
+    assert [(str(a), str(b)) for a, b in windows] == [
+        ('2020-01-15 00:00:00', '2020-01-31 23:59:59'),
+        ('2020-02-01 00:00:00', '2020-02-29 23:59:59'),
+        ('2020-03-01 00:00:00', '2020-03-10 00:00:00'),
+    ]
+    assert [wiki.window_is_open(w, freq='MS') for w in windows] == [False, False, True]
+
+def test_rerun_does_not_duplicate_contributions(tmp_path, monkeypatch):
+    monkeypatch.setattr(wiki, 'fetch_user_contributions', fake_fetch)
+
+    # the open last window moves on between runs, and is closed by the third
+    for stop in ['2020-03-10 12:00:00', '2020-03-20 12:00:00', '2020-04-02 00:00:00']:
+        user_dir = wiki.get_user_contributions('Example', tmp_path, start='2020-01-01', stop=stop, freq='MS', max_workers=2)
+
+    df = pd.read_parquet(user_dir)
+    assert sorted(df['revid']) == [1, 2, 3, 4, 5]
+    names = sorted(p.name for p in user_dir.glob("*.parquet"))
+    assert names == ['20200101000000_20200131235959.parquet', '20200201000000_20200229235959.parquet',
+                     '20200301000000_20200331235959.parquet', '20200401000000_open.parquet']
+
+def test_get_revisions_html_leaves_failed_requests_out(monkeypatch, capsys):
+    def fake_api_get(query_url, query_params, cache=None):
+        if query_params['oldid'] == 2:
+            raise TimeoutError("timed out")
+        if query_params['oldid'] == 3:
+            return {'error': {'code': 'nosuchrevid'}}
+        return {'parse': {'text': f"<p>revision {query_params['oldid']}</p>"}}
+    monkeypatch.setattr(wiki, 'api_get', fake_api_get)
+
+    htmls = wiki.get_revisions_html([1, 2, 3, 1], max_workers=2)
+
+    assert htmls == {1: "<p>revision 1</p>", 3: ""}
+    assert "Could not render revision 2: timed out" in capsys.readouterr().out
@@ -0,0 +1,53 @@
+import gzip
+import bz2
+import pandas as pd
+import pytest
+import wikipageviews
+
+def write_hourly(path, lines):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+def test_aggregate_pageview_dumps_sums_hours_into_days(tmp_path):
+    # day 1: two hourly files (desktop and mobile), day 2: one daily pageview_complete file
+    write_hourly(tmp_path / "pageviews-20200101-000000.gz", [
+        "en Foo_bar 3 0",
+        "en.m Foo_bar 2 0",
+        "en Baz 1 0",
+        "de Foo_bar 100 0",
+        "en Not_wanted 50 0",
+    ])
+    write_hourly(tmp_path / "pageviews-20200101-010000.gz", [
+        "en Foo_bar 4 0",
+        "en Baz 6 0",
+    ])
+    with bz2.open(tmp_path / "pageviews-20200102-user.bz2", "wt", encoding="utf-8") as f:
+        f.write("en.wikipedia Foo_bar 123 desktop 10 A5J5\n")
+        f.write("en.wikipedia Foo_bar 123 mobile-web 5 A5\n")
+        f.write("fr.wikipedia Baz 9 desktop 7 A7\n")
+
+    dump_files = sorted(tmp_path.iterdir())
+    views_df = wikipageviews.aggregate_pageview_dumps(dump_files, ["Foo bar", "Baz"], max_workers=2)
+
+    expected = pd.DataFrame({
+        'page_title': ["Baz", "Foo bar", "Foo bar"],
+        'timestamp': pd.to_datetime(["2020-01-01", "2020-01-01", "2020-01-02"]),
+        'views': [7, 9, 15],
+    })
+    pd.testing.assert_frame_equal(views_df, expected, check_dtype=False)
+    assert views_df['views'].dtype == 'int64'
+
+def test_days_with_both_dump_families_are_refused(tmp_path):
+    write_hourly(tmp_path / "pageviews-20200101-000000.gz", ["en Foo_bar 3 0"])
+    with bz2.open(tmp_path / "pageviews-20200101-user.bz2", "wt", encoding="utf-8") as f:
+        f.write("en.wikipedia Foo_bar 123 desktop 3 C3\n")
+    (tmp_path / "pageviews-20200101-000000.gz.md5").write_text("")
+
+    with pytest.raises(ValueError):
+        wikipageviews.aggregate_pageview_dumps(sorted(tmp_path.iterdir()), ["Foo bar"], max_workers=1)
+
+    for dump_type in ['hourly', 'daily']:
+        dump_files = wikipageviews.select_dump_files(tmp_path.iterdir(), dump_type=dump_type)
+        assert [wikipageviews.dump_family(path) for path in dump_files] == [dump_type]
+        views_df = wikipageviews.aggregate_pageview_dumps(dump_files, ["Foo bar"], max_workers=1)
+        assert views_df['views'].tolist() == [3]
@@ -0,0 +1,34 @@
+import wikifunctions as wf
+import wikiparse
+
+PAGE_HTML = """<div class="mw-parser-output">
+<p>The <a href="/wiki/Foo" title="Foo">Foo</a> is a <a href="/wiki/Bar_(band)" title="Bar (band)">band</a>.[1]
+See <a href="/w/index.php?title=Nowhere&amp;action=edit&amp;redlink=1" class="new" title="Nowhere (page does not exist)">Nowhere</a>
+and <a href="/wiki/Help:Contents" title="Help:Contents">help</a>.</p>
+<table><tr><td><a href="/wiki/Infobox_link" title="Infobox link">Infobox link</a></td></tr></table>
+<h2><span class="mw-headline" id="History">History</span></h2>
+<p>Formed in 1999,[2] with <a class="external text" href="https://example.org/press">a press release</a>.</p>
+<ul><li><a href="/wiki/First_album" title="First album">First album</a></li><li><a href="/wiki/Second_album" title="Second album">Second album</a></li></ul>
+<h2><span class="mw-headline" id="References">References</span></h2>
+<div class="reflist"><ol><li><a class="external text" href="https://example.org/source">Source</a></li></ol></div>
+<h2><span class="mw-headline" id="External_links">External links</span></h2>
+<ul><li><a class="external text" href="https://foo.example.com">Official site</a></li><li><a href="/wiki/Related" title="Related">Related</a></li></ul>
+</div>"""
+
+def test_extract_page_matches_the_separate_passes():
+    page = wikiparse.extract_page(PAGE_HTML)
+
+    assert page['text'] == wf.parse_to_text(PAGE_HTML, is_json=False)
+    assert page['links'] == wf.parse_to_links(PAGE_HTML, is_json=False)
+    assert page['links'] == ['Foo', 'Bar (band)', 'First album', 'Second album']
+
+def test_extract_page_html_paragraphs_match_parse_to_text():
+    page = wikiparse.extract_page(PAGE_HTML, parse_text=False)
+
+    assert page['text'] == wf.parse_to_text(PAGE_HTML, is_json=False, parse_text=False)
+
+def test_extract_page_keeps_external_links_of_end_sections():
+    page = wikiparse.extract_page(PAGE_HTML)
+
+    assert page['external_links'] == ['https://example.org/press', 'https://example.org/source', 'https://foo.example.com']
+    assert page['sections'] == [[2, 'History', 'History'], [2, 'References', 'References'], [2, 'External_links', 'External links']]
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import wikistore
+
+def write_store(path, revisions):
+    df = pd.DataFrame(revisions, columns=wikistore.REVISION_COLUMNS + ['rev_count', 'editor_count'])
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    for column in ['pageid', 'revid', 'size', 'rev_count', 'editor_count']:
+        df[column] = df[column].astype('int64')
+    df.to_parquet(path, index=False)
+    return wikistore.RevisionStore(path)
+
+def test_as_of_finds_the_revision_in_effect(tmp_path):
+    store = write_store(tmp_path / "store.parquet", [
+        [1, "Foo", 10, "2010-01-01", "a", 100, 1, 1],
+        [1, "Foo", 11, "2011-01-01", "b", 150, 2, 2],
+        [2, "Bar", 20, "2012-06-01", "a", 50, 1, 1],
+    ])
+    result = store.as_of([1, 1, 1, 2, 3], ["2009-12-31", "2010-06-01", "2020-01-01", "2012-06-01", "2015-01-01"])
+
+    assert result['revid'].tolist() == [pd.NA, 10, 11, 20, pd.NA]
+    assert result['size'].tolist() == [pd.NA, 100, 150, 50, pd.NA]
+    assert result['rev_timestamp'].isna().tolist() == [True, False, False, False, True]
+
+def test_as_of_on_an_empty_store(tmp_path):
+    store = write_store(tmp_path / "empty.parquet", [])
+    result = store.as_of([1, 2], ["2010-01-01", "2020-01-01"])
+
+    assert len(result) == 2
+    assert result['revid'].isna().all()
+    assert result['rev_timestamp'].isna().all()
+    assert result['editor_count'].isna().all()
+
+def test_result_writer_adopts_only_complete_files(tmp_path):
+    (tmp_path / "chunk_0001.tsv").write_text("page_title\tpageid\nFoo\t1\nBar\t2\n")
+    (tmp_path / "chunk_0002.tsv").write_text("page_title\tpageid\nFoo\t1\nBa")
+    (tmp_path / "chunk_0003.tsv").write_text("page_title\tpageid\nFoo\t1\tx\n")
+
+    writer = wikistore.ResultWriter(tmp_path, pattern="chunk_*.tsv")
+    assert writer.is_done("chunk_0001.tsv")
+    assert not writer.is_done("chunk_0002.tsv")
+    assert not writer.is_done("chunk_0003.tsv")
+    writer.close()
+
+def test_result_writer_redoes_files_cut_short_or_not_in_manifest(tmp_path):
+    with wikistore.ResultWriter(tmp_path, pattern="chunk_*.tsv") as writer:
+        writer.write_df("chunk_0001.tsv", pd.DataFrame({'page_title': ['Foo', 'Bar']}))
+        assert writer.is_done("chunk_0001.tsv")
+
+    # cut short after it was written
+    with open(tmp_path / "chunk_0001.tsv", "r+b") as f:
+        f.truncate(10)
+    # written, but the run stopped before the manifest was committed (the pattern was already adopted)
+    (tmp_path / "chunk_0002.tsv").write_text("page_title\nBaz\n")
+
+    writer = wikistore.ResultWriter(tmp_path, pattern="chunk_*.tsv")
+    assert not writer.is_done("chunk_0001.tsv")
+    assert not writer.is_done("chunk_0002.tsv")
+    assert writer.verify() == ["chunk_0001.tsv"]
+    writer.write_df("chunk_0001.tsv", pd.DataFrame({'page_title': ['Foo', 'Bar']}))
+    assert writer.is_done("chunk_0001.tsv")
+    writer.close()
+
+def test_result_writer_verify_checksums_drops_changed_files(tmp_path):
+    with wikistore.ResultWriter(tmp_path, pattern="*.json") as writer:
+        writer.put("Foo.json", '{"text": "abc"}')
+        writer.put("Bar.json", '{"text": "def"}')
+
+    # same size, different content
+    (tmp_path / "Foo.json").write_text('{"text": "xyz"}')
+
+    writer = wikistore.ResultWriter(tmp_path, pattern="*.json")
+    assert writer.verify() == []
+    assert writer.verify(checksums=True) == ["Foo.json"]
+    assert not writer.is_done("Foo.json")
+    assert writer.is_done("Bar.json")
+    writer.close()
+
+def test_result_writers_with_different_patterns_share_the_manifest(tmp_path):
+    (tmp_path / "chunk_0001.tsv").write_text("page_title\nFoo\n")
+    (tmp_path / "1.5_earliest_revisions_afd_0001.tsv").write_text("page_title\tearliest_revision_date\nFoo\t2020-01-01\n")
+
+    chunk_writer = wikistore.ResultWriter(tmp_path, pattern="chunk_*.tsv")
+    assert chunk_writer.is_done("chunk_0001.tsv")
+    assert not chunk_writer.is_done("1.5_earliest_revisions_afd_0001.tsv")
+
+    # the second writer adopts its own files without touching the first writer's
+    revision_writer = wikistore.ResultWriter(tmp_path, pattern="1.5_earliest_revisions_*.tsv")
+    assert revision_writer.is_done("1.5_earliest_revisions_afd_0001.tsv")
+    assert revision_writer.is_done("chunk_0001.tsv")
+    revision_writer.write_df("1.5_earliest_revisions_afd_0002.tsv", pd.DataFrame({'page_title': ['Bar']}))
+    revision_writer.close()
+    chunk_writer.write_df("chunk_0002.tsv", pd.DataFrame({'page_title': ['Bar']}))
+    chunk_writer.close()
+
+    reopened = wikistore.ResultWriter(tmp_path, pattern="chunk_*.tsv")
+    assert all(reopened.is_done(name) for name in ["chunk_0001.tsv", "chunk_0002.tsv", "1.5_earliest_revisions_afd_0001.tsv", "1.5_earliest_revisions_afd_0002.tsv"])
+    assert reopened.verify(checksums=True) == []
+    reopened.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import wikimetrics
+import wikiprofile
+
+"""
+Runtime and ETA estimates for a stage before committing to a multi-week crawl.
+
+estimate_run processes a random sample of the titles and reads the wikimetrics counters before and after, which gives
+requests, bytes, request latency and throttle time per title. From those it projects the full run as the stage runs
+it now (one title at a time, plus the fixed sleeps between chunks), and for other settings:
+
+    titles per second = min(workers / seconds per title,        (latency-bound)
+                            rate / requests per title,          (rate-limit-bound)
+                            1 / local seconds per title)        (CPU-bound: parsing runs on one core under the GIL)
+
+where the local seconds are the part of a title's time that isn't spent waiting on requests or the rate limiter.
+"""
+
+def _request_totals(snapshot):
+    totals = {'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0, 'cache_hits': 0}
+    for entry in snapshot['requests'].values():
+        totals['requests'] += entry['count']
+        totals['errors'] += entry['errors']
+        totals['retries'] += entry['retries']
+        totals['bytes'] += entry['bytes']
+        totals['seconds'] += entry['seconds']
+        totals['cache_hits'] += entry['cache_hits']
+    totals['throttle_seconds'] = snapshot['throttle']['seconds']
+    return totals
+
+def chunk_sleep_seconds(n_titles, chunk_size=100):
+    """
+    The fixed sleeps of 1_get_case_data.main for n_titles: 10 minutes after every 50th chunk, an hour instead after
+    every 1000th.
+    """
+    n_chunks = math.ceil(n_titles / chunk_size)
+    n_hours = n_chunks // 1000
+    n_ten_minutes = n_chunks // 50 - n_hours
+    return n_hours * 60 * 60 + n_ten_minutes * 10 * 60
+
+def format_duration(seconds):
+    days, rest = divmod(int(seconds), 24 * 60 * 60)
+    hours, rest = divmod(rest, 60 * 60)
+    minutes = rest // 60
+    return f"{days}d {hours:02d}h {minutes:02d}m" if days else f"{hours}h {minutes:02d}m"
+
+def project(per_title, n_titles, workers, rate, sleep_seconds=0):
+    """
+    The projected wall-clock seconds for n_titles with `workers` at the same time and at most `rate` requests
+    per second (None for no limit).
+    """
+    throughputs = [workers / per_title['seconds']] if per_title['seconds'] > 0 else []
+    if rate and per_title['requests'] > 0:
+        throughputs.append(rate / per_title['requests'])
+    if per_title['local_seconds'] > 0:
+        throughputs.append(1 / per_title['local_seconds'])
+    titles_per_second = min(throughputs) if throughputs else float('inf')
+    return n_titles / titles_per_second + sleep_seconds
+
+def estimate_run(func, titles, sample_size=50, sleep_seconds=0, workers=(1, 2, 4, 8), rates=(None, 5, 10, 20), seed=0):
+    """
+    Runs func(sample) on a random sample of titles and projects the runtime and bytes of the full list.
+
+    func - the stage's work for a list of titles (e.g., a process_chunk)
+    titles - the full list the stage would run on
+    sleep_seconds - fixed waits the stage adds on top of the work (see chunk_sleep_seconds)
+    workers, rates - the settings to project
+
+    Returns:
+    per_title - requests, bytes, seconds, request_seconds, throttle_seconds and local_seconds per title
+    report - the estimate as text (also printed)
+    """
+    sample = wikiprofile.sample_items(titles, sample_size, seed=seed)
+    before = _request_totals(wikimetrics.metrics.snapshot())
+    start = time.perf_counter()
+    func(sample)
+    wall = time.perf_counter() - start
+    after = _request_totals(wikimetrics.metrics.snapshot())
+
+    n = max(len(sample), 1)
+    delta = {key: after[key] - before[key] for key in after}
+    per_title = {
+        'requests': delta['requests'] / n,
+        'bytes': delta['bytes'] / n,
+        'seconds': wall / n,
+        'request_seconds': delta['seconds'] / n,
+        'throttle_seconds': delta['throttle_seconds'] / n,
+    }
+    per_title['local_seconds'] = max(per_title['seconds'] - per_title['request_seconds'] - per_title['throttle_seconds'], 0.0)
+
+    n_titles = len(titles)
+    lines = []
+    lines.append(f"Sample: {len(sample)} of {n_titles} titles in {wall:.1f}s ({delta['errors']} request errors, {delta['retries']} retries, {delta['cache_hits']} cache hits)")
+    lines.append(f"Per title: {per_title['requests']:.2f} requests, {per_title['bytes'] / 1024:.1f} KiB, {per_title['seconds']:.2f}s "
+                 f"({per_title['request_seconds']:.2f}s waiting on requests, {per_title['throttle_seconds']:.2f}s throttled, {per_title['local_seconds']:.2f}s local)")
+    if delta['requests']:
+        lines.append(f"Mean request latency: {delta['seconds'] / delta['requests']:.3f}s")
+    lines.append(f"Full list: {n_titles * per_title['requests']:,.0f} requests, {n_titles * per_title['bytes'] / 2**30:.2f} GiB")
+    lines.append(f"As the stage runs now (1 at a time, {format_duration(sleep_seconds)} of fixed sleeps): {format_duration(project(per_title, n_titles, 1, None, sleep_seconds))}")
+    lines.append("")
+    lines.append("Projected runtime without the fixed sleeps (rows: workers, columns: max requests per second):")
+    lines.append("workers  " + "".join(f"{('no limit' if r is None else f'{r}/s'):>16}" for r in rates))
+    for w in workers:
+        lines.append(f"{w:>7}  " + "".join(f"{format_duration(project(per_title, n_titles, w, r)):>16}" for r in rates))
+
+    report = '\n'.join(lines)
+    print(report)
+    return per_title, report
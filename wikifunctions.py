@@ -4,11 +4,14 @@ from bs4 import BeautifulSoup
 from urllib.parse import unquote, quote
 from copy import deepcopy
 import requests, re
+import wikimetrics
 
 """
 This script is made by Brian Keegan: https://github.com/brianckeegan/wikifunctions
 I've just copied it over here for ease of use in my scripts for now.
-Only modification is removing userid from the returned data in the revisions df.
+Modifications: removing userid from the returned data in the revisions df, following continuations / not
+revisiting categories in the category functions, the redirect functions using wikihelpers.resolve_titles, and
+requests going through wikimetrics.get so that they are counted.
 """
 
 def response_to_revisions(json_response):
@@ -55,7 +58,7 @@ def get_all_page_revisions(page_title, endpoint='en.wikipedia.org/w/api.php', re
     query_params['formatversion'] = 2
     
     # Make the query
-    json_response = requests.get(url = query_url, params = query_params, headers=useragent).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params, headers=useragent).json()
 
     # Add the temporary list to the parent list
     revision_list += response_to_revisions(json_response)
@@ -67,14 +70,14 @@ def get_all_page_revisions(page_title, endpoint='en.wikipedia.org/w/api.php', re
         if 'continue' in json_response:
             query_continue_params = deepcopy(query_params)
             query_continue_params['rvcontinue'] = json_response['continue']['rvcontinue']
-            json_response = requests.get(url = query_url, params = query_continue_params).json()
+            json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
             revision_list += response_to_revisions(json_response)
         
         # Older versions of the API return paginated results this way
         elif 'query-continue' in json_response:
             query_continue_params = deepcopy(query_params)
             query_continue_params['rvstartid'] = json_response['query-continue']['revisions']['rvstartid']
-            json_response = requests.get(url = query_url, params = query_continue_params).json()
+            json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
             revision_list += response_to_revisions(json_response)
         
         # If there are no more revisions, stop
@@ -136,7 +139,7 @@ def get_page_revisions_from_date(page_title, endpoint='en.wikipedia.org/w/api.ph
     query_params['formatversion'] = 2
     
     # Make the query
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
 
     # Add the temporary list to the parent list
     revision_list += response_to_revisions(json_response)
@@ -148,14 +151,14 @@ def get_page_revisions_from_date(page_title, endpoint='en.wikipedia.org/w/api.ph
         if 'continue' in json_response:
             query_continue_params = deepcopy(query_params)
             query_continue_params['rvcontinue'] = json_response['continue']['rvcontinue']
-            json_response = requests.get(url = query_url, params = query_continue_params).json()
+            json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
             revision_list += response_to_revisions(json_response)
         
         # Older versions of the API return paginated results this way
         elif 'query-continue' in json_response:
             query_continue_params = deepcopy(query_params)
             query_continue_params['rvstartid'] = json_response['query-continue']['revisions']['rvstartid']
-            json_response = requests.get(url = query_url, params = query_continue_params).json()
+            json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
             revision_list += response_to_revisions(json_response)
         
         # If there are no more revisions, stop
@@ -217,7 +220,7 @@ def get_redirects_linking_here(page_title, endpoint="en.wikipedia.org/w/api.php"
     query_params['formatversion'] = 2
     
     # Make the query
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'linkshere' in json_response['query']['pages'][0]:
         subquery_lh_list = json_response['query']['pages'][0]['linkshere']
@@ -231,56 +234,31 @@ def get_redirects_linking_here(page_title, endpoint="en.wikipedia.org/w/api.php"
             else:
                 query_continue_params = deepcopy(query_params)
                 query_continue_params['lhcontinue'] = json_response['continue']['lhcontinue']
-                json_response = requests.get(url = query_url, params = query_continue_params).json()
+                json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
                 subquery_lh_list = json_response['query']['pages'][0]['linkshere']
                 lh_list += subquery_lh_list
     
     return [i['title'] for i in lh_list]
 
-def get_redirects_map(page_list, endpoint="en.wikipedia.org/w/api.php"):
-    redirects_d = {}
-    
-    chunked = list(chunks(page_list,50))
-    
-    for chunk in chunked:
-        query_url = "https://{0}".format(endpoint)
-        query_params = {}
-        query_params['action'] = 'query'
-        query_params['prop'] = 'info'
-        query_params['titles'] = '|'.join(chunk)
-        query_params['redirects'] = 1
-        query_params['format'] = 'json'
-        query_params['formatversion'] = 2
-        json_response = requests.get(url=query_url,params=query_params).json()
-        
-        if 'redirects' in json_response['query']:
-            mapping = {redir['from']:redir['to'] for redir in json_response['query']['redirects']}
-            redirects_d.update(mapping)
-            
-    return redirects_d
+def get_redirects_map(page_list, endpoint="en.wikipedia.org/w/api.php", store_file=None):
+    """Takes a list of page titles and returns a dictionary of the ones that redirect, keyed by title with the
+    final target as the value. Uses wikihelpers.resolve_titles (batched, concurrent, normalization and
+    continuations handled, optionally memoized in store_file).
+    """
+    import wikihelpers
+    df = wikihelpers.resolve_titles(page_list, store_file=store_file, endpoint=endpoint)
+    df = df[df['is_redirect']]
+    return dict(zip(df['title'], df['target']))
         
 
-def resolve_redirects(page_list,endpoint="en.wikipedia.org/w/api.php"):
-    resolved_page_list = []
-    
-    chunked = list(chunks(page_list,50))
-    
-    for chunk in chunked:
-        query_url = "https://{0}".format(endpoint)
-        query_params = {}
-        query_params['action'] = 'query'
-        query_params['prop'] = 'info'
-        query_params['titles'] = '|'.join(chunk)
-        query_params['redirects'] = 1
-        query_params['format'] = 'json'
-        query_params['formatversion'] = 2
-        json_response = requests.get(url=query_url,params=query_params).json()
-        
-        if 'pages' in json_response['query']:
-            pages = [page['title'] for page in json_response['query']['pages']]
-            resolved_page_list += pages
-            
-    return resolved_page_list
+def resolve_redirects(page_list,endpoint="en.wikipedia.org/w/api.php", store_file=None):
+    """Takes a list of page titles and returns the list of the (unique) pages they resolve to.
+    Uses wikihelpers.resolve_titles, like get_redirects_map.
+    Pages that don't exist are kept in the list, as the API returns them; use resolve_titles for the `missing` flag.
+    """
+    import wikihelpers
+    df = wikihelpers.resolve_titles(page_list, store_file=store_file, endpoint=endpoint)
+    return list(dict.fromkeys(df['target']))
 
 def get_page_raw_content(page_title, endpoint='en.wikipedia.org/w/api.php', redirects=1, useragent='sohyeon@princeton.edu'):
     """Takes a page title and returns the raw HTML.
@@ -311,7 +289,7 @@ def get_page_raw_content(page_title, endpoint='en.wikipedia.org/w/api.php', redi
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params, headers=useragent).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params, headers=useragent).json()
     
     if 'parse' in json_response.keys():
         markup = json_response['parse']['text']
@@ -322,6 +300,7 @@ def get_page_raw_content(page_title, endpoint='en.wikipedia.org/w/api.php', redi
     
     return markup
 
+@wikimetrics.timed('parse.parse_to_links')
 def parse_to_links(input,is_json=True):
     # Initialize an empty list to store the links
     outlinks_list = []
@@ -405,7 +384,7 @@ def get_revision_raw_content(revid, endpoint='en.wikipedia.org/w/api.php', redir
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         markup = json_response['parse']['text']
@@ -447,7 +426,7 @@ def get_page_outlinks(page_title, endpoint='en.wikipedia.org/w/api.php', redirec
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         links = parse_to_links(json_response)
@@ -488,7 +467,7 @@ def get_revision_outlinks(revid, endpoint='en.wikipedia.org/w/api.php'):
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         return parse_to_links(json_response)
@@ -527,7 +506,7 @@ def get_page_externallinks(page_title, endpoint='en.wikipedia.org/w/api.php', re
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         if 'externallinks' in json_response['parse']:
@@ -568,7 +547,7 @@ def get_revision_externallinks(revid, endpoint='en.wikipedia.org/w/api.php', red
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         if 'externallinks' in json_response['parse']:
@@ -580,6 +559,7 @@ def get_revision_externallinks(revid, endpoint='en.wikipedia.org/w/api.php', red
         
     return links
         
+@wikimetrics.timed('parse.parse_to_text')
 def parse_to_text(input,is_json=True,parse_text=True):
     if is_json:
         page_html = input['parse']['text']#['*']
@@ -650,7 +630,7 @@ def get_page_content(page_title, endpoint='en.wikipedia.org/w/api.php', redirect
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         return parse_to_text(json_response,parsed_text)
@@ -684,38 +664,18 @@ def get_revision_content(revid,endpoint='en.wikipedia.org/w/api.php',parsed_text
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'parse' in json_response.keys():
         return parse_to_text(json_response,parsed_text)
     
-def get_page_redirects(page_list,endpoint='en.wikipedia.org/w/api.php'):
-
-    chunked_page_list = list(chunks(page_list))
-    
-    page_redirects = {}
-    
-    for chunk in chunked_page_list:
-        page_titles = '|'.join(chunk)
-        
-        # Set up the query
-        query_url = "https://{0}".format(endpoint)
-        query_params = {}
-        query_params['action'] = 'query'
-        query_params['titles'] = page_titles
-        query_params['prop'] = 'info'
-        query_params['format'] = 'json'
-        query_params['redirects'] = 1
-        query_params['formatversion'] = 2
-        
-        # Make the query
-        json_response = requests.get(url = query_url, params = query_params).json()
-
-        # Add the redirects to the dictionary
-        if 'redirects' in json_response['query']:
-
-            for _rd in json_response['query']['redirects']:
-                page_redirects[_rd['from']] = _rd['to']
+def get_page_redirects(page_list,endpoint='en.wikipedia.org/w/api.php', store_file=None):
+    """Takes a list of page titles and returns a dictionary of title -> final target, including the
+    non-redirects (mapped to themselves) for the sake of completeness. Uses wikihelpers.resolve_titles.
+    """
+    import wikihelpers
+    df = wikihelpers.resolve_titles(page_list, store_file=store_file, endpoint=endpoint)
+    page_redirects = dict(zip(df['title'], df['target']))
             
     # Include the non-redirects for the sake of completeness
     for page in page_list:
@@ -750,7 +710,7 @@ def get_interlanguage_links(page_title, endpoint='en.wikipedia.org/w/api.php', r
     query_params['lllimit'] = 500
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
-    json_response = requests.get(url=query_url,params=query_params).json()
+    json_response = wikimetrics.get(url=query_url,params=query_params).json()
     
     interlanguage_link_dict = dict()
     start_lang = endpoint.split('.')[0]
@@ -794,7 +754,7 @@ def get_pageviews(page_title,endpoint='en.wikipedia.org',start='20150701',stop='
     #for agent in ['all-agents','user','spider','bot']:
     s = "https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/{1}/{2}/{3}/{0}/daily/{4}/{5}".format(quoted_page_title,endpoint,'all-access','user',date_from,date_to)
     headers = {'User-Agent':useragent}
-    json_response = requests.get(s,headers=headers).json()
+    json_response = wikimetrics.get(s,headers=headers).json()
     
     if 'items' in json_response:
         df = pd.DataFrame(json_response['items'])
@@ -828,7 +788,7 @@ def get_category_memberships(page_title,endpoint='en.wikipedia.org/w/api.php'):
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    json_response = requests.get(url=query_url,params=query_params).json()
+    json_response = wikimetrics.get(url=query_url,params=query_params).json()
 
     categories = list()
 
@@ -873,7 +833,7 @@ def get_category_subcategories(category_title,endpoint='en.wikipedia.org/w/api.p
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
         
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     members = list()
     
@@ -881,9 +841,18 @@ def get_category_subcategories(category_title,endpoint='en.wikipedia.org/w/api.p
         for member in json_response['query']['categorymembers']:
             members.append(member['title'])
             
+    # Categories with more than 500 sub-categories are paginated
+    while 'continue' in json_response:
+        query_continue_params = deepcopy(query_params)
+        query_continue_params['cmcontinue'] = json_response['continue']['cmcontinue']
+        json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
+        if 'categorymembers' in json_response['query']:
+            for member in json_response['query']['categorymembers']:
+                members.append(member['title'])
+            
     return members
 
-def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api.php',namespace=0,prepend=True):
+def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api.php',namespace=0,prepend=True,visited=None):
     """The function accepts a category_title and returns a list of category members
     
     category_title - a string (including "Category:" prefix) of the category named
@@ -893,6 +862,8 @@ def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api
         Changing the two letter language code will return a different language edition
         The Wikia endpoints are slightly different, e.g. 'starwars.wikia.com/api.php'
     namespace - namespaces to include (multiple namespaces separated by pipes, e.g. "0|1|2")
+    visited - a set of categories already crawled, so that category cycles don't recurse forever
+        (see wikihelpers.crawl_category for a breadth-first, concurrent version)
     
     Returns:
     members - a list containing strings of the page titles in the category
@@ -905,6 +876,12 @@ def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api
     if prepend and 'Category:' not in category_title:
         category_title = 'Category:' + category_title
     
+    if visited is None:
+        visited = set()
+    if category_title in visited:
+        return list()
+    visited.add(category_title)
+    
     query_url = "https://{0}".format(endpoint)
     query_params = {}
     query_params['action'] = 'query'
@@ -916,7 +893,7 @@ def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
         
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
 
     members = list()
     
@@ -931,7 +908,7 @@ def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api
         if 'continue' in json_response:
             query_continue_params = deepcopy(query_params)
             query_continue_params['cmcontinue'] = json_response['continue']['cmcontinue']
-            json_response = requests.get(url = query_url, params = query_continue_params).json()
+            json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
             if 'categorymembers' in json_response['query']:
                 for member in json_response['query']['categorymembers']:
                     members.append(member['title'])
@@ -941,7 +918,7 @@ def get_category_members(category_title,depth=1,endpoint='en.wikipedia.org/w/api
     subcats = get_category_subcategories(category_title,endpoint=endpoint)
     
     for subcat in subcats:
-        members += get_category_members(subcat,depth=depth-1,endpoint=endpoint,namespace=namespace)
+        members += get_category_members(subcat,depth=depth-1,endpoint=endpoint,namespace=namespace,visited=visited)
             
     return members
 
@@ -975,7 +952,7 @@ def get_user_info(username_list,endpoint='en.wikipedia.org/w/api.php'):
         query_params['format'] = 'json'
         query_params['formatversion'] = 2
         
-        json_response = requests.get(url = query_url, params = query_params).json()
+        json_response = wikimetrics.get(url = query_url, params = query_params).json()
         if 'query' in json_response:
             users_info += json_response['query']['users']
     
@@ -1019,7 +996,7 @@ def get_user_contributions(username,endpoint='en.wikipedia.org/w/api.php', redir
     query_params['formatversion'] = 2
     
     # Make the query
-    json_response = requests.get(url = query_url, params = query_params).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params).json()
     
     if 'query' in json_response:
         
@@ -1035,7 +1012,7 @@ def get_user_contributions(username,endpoint='en.wikipedia.org/w/api.php', redir
             else:
                 query_continue_params = deepcopy(query_params)
                 query_continue_params['uccontinue'] = json_response['continue']['uccontinue']
-                json_response = requests.get(url = query_url, params = query_continue_params).json()
+                json_response = wikimetrics.get(url = query_url, params = query_continue_params).json()
                 subquery_revision_list = json_response['query']['usercontribs']
                 revision_list += subquery_revision_list
                 #time.sleep(1)
@@ -1044,7 +1021,7 @@ def get_user_contributions(username,endpoint='en.wikipedia.org/w/api.php', redir
     
     if len(df.columns) > 0:
         df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df['date'] = df['timestamp'].apply(lambda x:x.date())
-        df['userid'] = df['userid'].fillna(0).apply(lambda x:str(int(x)))
+        df['date'] = df['timestamp'].dt.date
+        df['userid'] = df['userid'].fillna(0).astype('int64').astype(str)
 
     return df
\ No newline at end of file
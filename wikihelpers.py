@@ -7,8 +7,16 @@ from urllib.parse import unquote, quote
 from copy import deepcopy
 import requests, re
 import wikifunctions as wf
+import wikimetrics
 from pathlib import Path
 import itertools
+import concurrent.futures
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+from tqdm import tqdm
 
 useragent={'User-Agent': "[[m:Research:Disparities in Online Rule Enforcement]] sohyeon@princeton.edu"}
 
@@ -32,7 +40,7 @@ def call_query(page_title, endpoint='en.wikipedia.org/w/api.php', redirects=1):
     query_params['ppprop'] ='wikibase_item'
     query_params['format'] = 'json'
 
-    response = requests.get(url = query_url, params = query_params, headers = useragent)
+    response = wikimetrics.get(url = query_url, params = query_params, headers = useragent)
 
     json_response = response.json()
     
@@ -50,7 +58,7 @@ def call_parse(page_title, endpoint='en.wikipedia.org/w/api.php', redirects=1):
     query_params['format'] = 'json'
     query_params['formatversion'] = 2
     
-    response = requests.get(url = query_url, params = query_params, headers = useragent)
+    response = wikimetrics.get(url = query_url, params = query_params, headers = useragent)
     json_response = response.json()
     
     return json_response
@@ -195,6 +203,1176 @@ def get_earliest_revision(page_title, endpoint='en.wikipedia.org/w/api.php', red
     query_params['redirects'] = redirects
     query_params['formatversion'] = 2
 
-    json_response = requests.get(url = query_url, params = query_params, headers = useragent).json()
+    json_response = wikimetrics.get(url = query_url, params = query_params, headers = useragent).json()
 
-    return json_response['query']['pages'][0]['revisions'][0]
\ No newline at end of file
+    return json_response['query']['pages'][0]['revisions'][0]
+
+"""
+shared plumbing for the bulk collectors: per-thread sessions, a rate budget, a response cache and a bounded thread pool
+"""
+_thread_local = threading.local()
+
+def get_session():
+    """
+    Each worker thread gets its own requests.Session (sessions aren't guaranteed to be thread-safe), with our User-Agent set.
+    """
+    if not hasattr(_thread_local, 'session'):
+        session = requests.Session()
+        session.headers.update(useragent)
+        _thread_local.session = session
+    return _thread_local.session
+
+class RateLimiter:
+    """
+    Spaces requests out so that all threads together stay under `rate` requests per second.
+    """
+    def __init__(self, rate=10):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            wikimetrics.metrics.record_throttle(delay)
+            time.sleep(delay)
+        return delay
+
+# MediaWiki asks for reasonable request rates; this is shared by everything that goes through api_get
+api_limiter = RateLimiter(rate=10)
+
+class ResponseCache:
+    """
+    A sqlite key -> JSON table of API responses, so that reruns don't hit the API again.
+    One connection is shared across threads behind a lock.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, fetched REAL)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(url, params=None):
+        params = params or {}
+        raw = url + "?" + json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key, max_age=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value, fetched FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if max_age is not None and time.time() - row[1] > max_age:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, value, fetched) VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def api_get(url, params=None, cache=None, limiter=api_limiter, max_retries=5, timeout=60):
+    """
+    GET a JSON response with the thread's session, waiting on the rate limiter first.
+    Throttling (429, maxlag) and server errors are retried with backoff; other HTTP errors (e.g., 404) are raised.
+    If a ResponseCache is passed, a cached response is returned without making a request.
+    """
+    label = wikimetrics.request_label(url, params)
+    if cache is not None:
+        key = cache.make_key(url, params)
+        cached = cache.get(key)
+        wikimetrics.metrics.record_cache(label, cached is not None)
+        if cached is not None:
+            return cached
+
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            wikimetrics.metrics.record_retry(label)
+        if limiter is not None:
+            limiter.wait()
+        start = time.perf_counter()
+        try:
+            response = get_session().get(url=url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            wikimetrics.metrics.record_request(label, time.perf_counter() - start, error=True)
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+            continue
+        wikimetrics.metrics.record_request(label, time.perf_counter() - start, len(response.content), error=response.status_code >= 400)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            if attempt == max_retries:
+                response.raise_for_status()
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt)
+            continue
+        response.raise_for_status()
+
+        json_response = response.json()
+        if 'error' in json_response and json_response['error'].get('code') == 'maxlag' and attempt < max_retries:
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(int(retry_after) if retry_after.isdigit() else 5)
+            continue
+        break
+
+    if cache is not None and 'error' not in json_response:
+        cache.put(key, json_response)
+    return json_response
+
+def run_concurrently(func, items, max_workers=4, desc=None):
+    """
+    Runs func(item) for each item on a bounded thread pool and yields (item, result, exception) as each one finishes.
+    Exceptions are handed back rather than raised, so one bad item doesn't abort the run.
+    """
+    items = list(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=desc):
+            item = futures[future]
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+def api_query_continued(query_params, endpoint='en.wikipedia.org/w/api.php', cache=None):
+    """
+    Yields every response of an action=query request, following 'continue' until there is nothing left.
+    Raises a ValueError if the API returns an error.
+    """
+    query_url = f"https://{endpoint}"
+    params = deepcopy(query_params)
+    while True:
+        json_response = api_get(query_url, params, cache=cache)
+        if 'error' in json_response:
+            raise ValueError(f"API error {json_response['error'].get('code')}: {json_response['error'].get('info')}")
+        yield json_response
+
+        if 'continue' not in json_response:
+            break
+        params = deepcopy(query_params)
+        params.update(json_response['continue'])
+
+"""
+categories
+"""
+def get_category_level(category_title, namespace=0, endpoint='en.wikipedia.org/w/api.php', cache=None):
+    """
+    Gets every page (in the given namespace) and every sub-category directly in a category, following continuations.
+
+    Returns:
+    pages, subcats - two lists of titles
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['list'] = 'categorymembers'
+    query_params['cmtitle'] = category_title
+    query_params['cmprop'] = 'title|ns'
+    query_params['cmtype'] = 'page|subcat'
+    query_params['cmnamespace'] = f"{namespace}|14"
+    query_params['cmlimit'] = 500
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    pages = []
+    subcats = []
+    for json_response in api_query_continued(query_params, endpoint=endpoint, cache=cache):
+        for member in json_response.get('query', {}).get('categorymembers', []):
+            if member['ns'] == 14:
+                subcats.append(member['title'])
+            if str(member['ns']) in str(namespace).split('|'):
+                pages.append(member['title'])
+    return pages, subcats
+
+def crawl_category(category_title, depth=1, namespace=0, endpoint='en.wikipedia.org/w/api.php', max_workers=4, cache_file=None):
+    """
+    Breadth-first crawl of a category and its sub-categories, down to `depth` levels of sub-categories
+    (depth=0 is just the category itself, like wikifunctions.get_category_members).
+    A visited set means category cycles and diamond-shaped hierarchies only get fetched once.
+    Each level's categories are fetched concurrently, and responses can be cached in a sqlite file.
+
+    Returns:
+    members - a DataFrame with page_title | category | depth, one row per page
+        (the first, shallowest category a page was found in)
+    """
+    cache = ResponseCache(cache_file) if cache_file is not None else None
+
+    category_title = category_title.replace('_', ' ')
+    if not category_title.startswith('Category:'):
+        category_title = 'Category:' + category_title
+
+    visited = {category_title}
+    frontier = [category_title]
+    members = {}
+    errors = []
+
+    for level in range(depth + 1):
+        if not frontier:
+            break
+        fetch = lambda c: get_category_level(c, namespace=namespace, endpoint=endpoint, cache=cache)
+        level_results = {}
+        for category, result, e in run_concurrently(fetch, frontier, max_workers=max_workers, desc=f"depth {level}"):
+            if e is not None:
+                errors.append([category, str(e)])
+            else:
+                level_results[category] = result
+
+        # go through the level in frontier order, so the category a page gets attributed to doesn't depend on timing
+        next_frontier = []
+        for category in frontier:
+            if category not in level_results:
+                continue
+            pages, subcats = level_results[category]
+            for page in pages:
+                if page not in members:
+                    members[page] = [page, category, level]
+            for subcat in subcats:
+                if subcat not in visited:
+                    visited.add(subcat)
+                    next_frontier.append(subcat)
+        frontier = next_frontier
+
+    if cache is not None:
+        cache.close()
+    if errors:
+        print(f"Could not crawl {len(errors)} categories: {errors[:5]}")
+
+    return pd.DataFrame(list(members.values()), columns=['page_title', 'category', 'depth'])
+
+"""
+revision content
+"""
+def _wikitext_cache_key(endpoint, revid):
+    return f"wikitext:{endpoint}:{revid}"
+
+def fetch_revisions_wikitext(revids, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Gets the wikitext of up to 50 revisions in one prop=revisions request.
+
+    Returns:
+    records - a list of dictionaries with revid | pageid | title | timestamp | wikitext,
+        with wikitext None for revisions that are deleted, hidden or don't exist
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['prop'] = 'revisions'
+    query_params['revids'] = '|'.join(str(r) for r in revids)
+    query_params['rvprop'] = 'ids|timestamp|content'
+    query_params['rvslots'] = 'main'
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    records = {}
+    for json_response in api_query_continued(query_params, endpoint=endpoint):
+        query = json_response.get('query', {})
+        for page in query.get('pages', []):
+            for rev in page.get('revisions', []):
+                main = rev.get('slots', {}).get('main', {})
+                records[rev['revid']] = {
+                    'revid': rev['revid'],
+                    'pageid': page.get('pageid'),
+                    'title': page.get('title'),
+                    'timestamp': rev.get('timestamp'),
+                    'wikitext': main.get('content'),
+                }
+        for bad in query.get('badrevids', {}).values():
+            records[bad['revid']] = {'revid': bad['revid'], 'pageid': None, 'title': None, 'timestamp': None, 'wikitext': None}
+
+    return list(records.values())
+
+def get_revisions_wikitext(revids, endpoint='en.wikipedia.org/w/api.php', to_text=False, max_workers=4, cache_file=None):
+    """
+    Gets the wikitext of many revisions, 50 per request (instead of one action=parse call per revision),
+    with the batches fetched concurrently. Revisions already in the cache are not requested again.
+
+    revids - a list of revision ids
+    to_text - also add a `text` column converted locally with wikiparse.wikitext_to_text
+    cache_file - a sqlite file keeping revid -> wikitext
+
+    Returns:
+    df - a DataFrame with revid | pageid | title | timestamp | wikitext (| text), in the order of revids
+    """
+    cache = ResponseCache(cache_file) if cache_file is not None else None
+
+    revids = list(dict.fromkeys(int(r) for r in revids))
+    records = {}
+    missing = []
+    for revid in revids:
+        cached = cache.get(_wikitext_cache_key(endpoint, revid)) if cache is not None else None
+        if cached is not None:
+            records[revid] = cached
+        else:
+            missing.append(revid)
+
+    fetch = lambda batch: fetch_revisions_wikitext(batch, endpoint=endpoint)
+    for batch, result, e in run_concurrently(fetch, list(wf.chunks(missing, 50)), max_workers=max_workers, desc="revision batches"):
+        if e is not None:
+            print(f"Could not get revisions {batch[0]}..{batch[-1]}: {e}")
+            continue
+        for record in result:
+            records[record['revid']] = record
+            if cache is not None and record['wikitext'] is not None:
+                cache.put(_wikitext_cache_key(endpoint, record['revid']), record)
+
+    if cache is not None:
+        cache.close()
+
+    df = pd.DataFrame([records[r] for r in revids if r in records], columns=['revid', 'pageid', 'title', 'timestamp', 'wikitext'])
+    if to_text:
+        import wikiparse
+        df['text'] = df['wikitext'].apply(wikiparse.wikitext_to_text)
+    return df
+
+def get_revisions_html(revids, endpoint='en.wikipedia.org/w/api.php', max_workers=4, cache_file=None):
+    """
+    Renders revisions through action=parse (one request per revision), for the ones that really need the HTML.
+    Responses are cached, so a revision is only rendered once.
+    Revisions whose request failed (e.g., a timeout) are printed and left out of htmls, so they can be retried.
+
+    Returns:
+    htmls - a dictionary of revid -> HTML string (empty if the API couldn't parse the revision, e.g. it was deleted)
+    """
+    cache = ResponseCache(cache_file) if cache_file is not None else None
+    query_url = f"https://{endpoint}"
+
+    def fetch(revid):
+        query_params = {}
+        query_params['action'] = 'parse'
+        query_params['oldid'] = revid
+        query_params['prop'] = 'text'
+        query_params['disableeditsection'] = 1
+        query_params['disabletoc'] = 1
+        query_params['format'] = 'json'
+        query_params['formatversion'] = 2
+        json_response = api_get(query_url, query_params, cache=cache)
+        if 'parse' in json_response:
+            return json_response['parse']['text']
+        return str()
+
+    htmls = {}
+    for revid, html, e in run_concurrently(fetch, list(dict.fromkeys(revids)), max_workers=max_workers, desc="rendering revisions"):
+        if e is not None:
+            print(f"Could not render revision {revid}: {e}")
+            continue
+        htmls[revid] = html
+
+    if cache is not None:
+        cache.close()
+    return htmls
+
+"""
+users
+"""
+USER_COLUMNS = ['username', 'userid', 'editcount', 'registration', 'gender', 'groups', 'blocked', 'missing', 'invalid', 'fetched']
+
+def normalize_username(username):
+    """
+    The username as the API returns it: underscores as spaces, whitespace collapsed, first letter upper case.
+    Returns None for missing or empty usernames.
+    """
+    if not isinstance(username, str):
+        return None
+    username = ' '.join(username.replace('_', ' ').split())
+    return username[:1].upper() + username[1:] if username else None
+
+def fetch_user_info(usernames, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Gets list=users information for up to 50 usernames in one request.
+
+    Returns:
+    users - a list of rows in the USER_COLUMNS order
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['list'] = 'users'
+    query_params['ususers'] = '|'.join(usernames)
+    query_params['usprop'] = 'blockinfo|groups|editcount|registration|gender'
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    json_response = api_get(f"https://{endpoint}", query_params)
+    if 'query' not in json_response:
+        raise ValueError(f"No query in the response: {json_response.get('error')}")
+
+    fetched = time.time()
+    users = []
+    for user in json_response['query']['users']:
+        users.append([user['name'], user.get('userid'), user.get('editcount'), user.get('registration'), user.get('gender'),
+                      json.dumps(user.get('groups', [])), 'blockid' in user, user.get('missing', False), user.get('invalid', False), fetched])
+    return users
+
+def collect_user_info(usernames, store_file, max_age_days=30, endpoint='en.wikipedia.org/w/api.php', max_workers=4):
+    """
+    Keeps a local sqlite table of user metadata for a (deduplicated) list of usernames, e.g., every AfD participant.
+    Only users who aren't in the table yet, or whose data is older than max_age_days, are fetched,
+    50 per request, with the batches run concurrently under the shared rate limiter.
+    Failed batches are reported and left for the next run instead of being dropped.
+    Usernames are stored (and looked up) in their normalized form (see normalize_username), which is the name the API
+    returns, so "foo_bar" and "Foo bar" are one user.
+
+    Returns:
+    df - a DataFrame of the stored rows for the requested usernames, by their normalized names
+    """
+    usernames = sorted(set(u for u in map(normalize_username, usernames) if u))
+
+    conn = sqlite3.connect(str(store_file), check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, userid INTEGER, editcount INTEGER, registration TEXT, gender TEXT, groups TEXT, blocked INTEGER, missing INTEGER, invalid INTEGER, fetched REAL)")
+    fresh_after = time.time() - max_age_days * 24 * 60 * 60
+    fresh = {row[0] for row in conn.execute("SELECT username FROM users WHERE fetched >= ?", (fresh_after,))}
+    stale = [u for u in usernames if u not in fresh]
+    print(f"{len(usernames)} users, {len(stale)} to fetch or refresh.")
+
+    fetch = lambda batch: fetch_user_info(batch, endpoint=endpoint)
+    failed = []
+    for batch, users, e in run_concurrently(fetch, list(wf.chunks(stale, 50)), max_workers=max_workers, desc="users"):
+        if e is not None:
+            failed += list(batch)
+            continue
+        conn.executemany(f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) VALUES ({', '.join('?' * len(USER_COLUMNS))})", users)
+        conn.commit()
+    if failed:
+        print(f"Could not fetch {len(failed)} users; they will be retried on the next run.")
+
+    df = pd.read_sql_query("SELECT * FROM users", conn)
+    conn.close()
+    df = df[df['username'].isin(usernames)].reset_index(drop=True)
+    df['registration'] = pd.to_datetime(df['registration'], utc=True)
+    df['fetched'] = pd.to_datetime(df['fetched'], unit='s', utc=True)
+    for column in ['blocked', 'missing', 'invalid']:
+        df[column] = df[column].astype(bool)
+    for column in ['userid', 'editcount']:
+        df[column] = df[column].astype('Int64')
+    return df
+
+"""
+user contributions
+"""
+CONTRIBUTION_DTYPES = {'userid': 'Int64', 'user': 'string', 'pageid': 'Int64', 'revid': 'Int64', 'parentid': 'Int64', 'ns': 'Int64',
+                       'title': 'string', 'timestamp': 'object', 'new': 'bool', 'minor': 'bool', 'top': 'bool',
+                       'comment': 'string', 'size': 'Int64', 'sizediff': 'Int64', 'date': 'object'}
+
+def contribution_windows(start='2001-01-01', stop='today', freq='YS'):
+    """
+    Splits [start, stop] into consecutive, non-overlapping windows (yearly by default), cut at the freq boundaries.
+    Times are UTC, like the API's; stop='today' is the current UTC time (so the last window is still open).
+
+    Returns:
+    windows - a list of [window_start, window_end] Timestamps, where each end is one second before the next start
+    """
+    start = pd.to_datetime(start)
+    stop = pd.Timestamp.now(tz='UTC').tz_localize(None).floor('s') if stop == 'today' else pd.to_datetime(stop)
+    edges = [start] + [t for t in pd.date_range(start, stop, freq=freq) if start < t < stop] + [stop + pd.Timedelta(seconds=1)]
+    return [[edges[i], edges[i + 1] - pd.Timedelta(seconds=1)] for i in range(len(edges) - 1)]
+
+def window_is_open(window, freq='YS'):
+    """
+    Whether a window from contribution_windows ends before its freq boundary, i.e., it was cut at stop
+    (e.g., the current year with stop='today') and can still get new items.
+    """
+    return window[1] + pd.Timedelta(seconds=1) < window[0] + pd.tseries.frequencies.to_offset(freq)
+
+def fetch_user_contributions(username, start, stop, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Gets a user's contributions between start and stop (inclusive), following continuations.
+
+    Returns:
+    df - a DataFrame of contributions, with timestamp as datetimes, a date column and userid as a string
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['list'] = 'usercontribs'
+    query_params['ucuser'] = username
+    query_params['ucprop'] = 'ids|title|comment|timestamp|flags|size|sizediff'
+    query_params['ucstart'] = datetime.strftime(pd.to_datetime(start), '%Y-%m-%dT%H:%M:%SZ')
+    query_params['ucend'] = datetime.strftime(pd.to_datetime(stop), '%Y-%m-%dT%H:%M:%SZ')
+    query_params['uclimit'] = 500
+    query_params['ucdir'] = 'newer'
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    frames = [pd.DataFrame(columns=list(CONTRIBUTION_DTYPES))]
+    for json_response in api_query_continued(query_params, endpoint=endpoint):
+        contribs = json_response.get('query', {}).get('usercontribs', [])
+        if contribs:
+            frames.append(pd.DataFrame(contribs))
+    df = pd.concat(frames, ignore_index=True)[list(CONTRIBUTION_DTYPES)]
+
+    # fixed columns and types, so every window's partition has the same schema (including empty ones);
+    # these are also vectorized versions of wikifunctions' apply(lambda x: x.date()) and apply(lambda x: str(int(x)))
+    for column in ['new', 'minor', 'top']:
+        df[column] = df[column].fillna(False).astype(bool)
+    df = df.astype({column: dtype for column, dtype in CONTRIBUTION_DTYPES.items() if column not in ['timestamp', 'date']})
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    df['date'] = df['timestamp'].dt.normalize()
+    df['userid'] = df['userid'].fillna(0).astype('int64').astype(str)
+    return df
+
+def get_user_contributions(username, output_dir, start='2001-01-01', stop='today', freq='YS', endpoint='en.wikipedia.org/w/api.php', max_workers=4):
+    """
+    Gets a user's whole contribution history by splitting [start, stop] into windows that are fetched concurrently.
+    Each window is written as its own parquet partition in output_dir/{username} as soon as it is done,
+    so only one window per worker is held in memory, and windows that are already written are skipped on a rerun.
+    The last window, while it is still open (see window_is_open), is written as {start}_open and fetched again on
+    every run; once a window is written, any other partition with the same start (its old open version) is removed,
+    so no contribution is in two partitions.
+
+    Returns:
+    user_dir - the directory with the user's partitions (read with pd.read_parquet(user_dir))
+    """
+    import wikistore
+    user_dir = Path(output_dir) / title_to_filename(username)
+
+    windows = contribution_windows(start, stop, freq=freq)
+    is_open = lambda window: window_is_open(window, freq=freq)
+    name = lambda window: f"{window[0]:%Y%m%d%H%M%S}_" + ("open" if is_open(window) else f"{window[1]:%Y%m%d%H%M%S}")
+
+    def drop_other_partitions(window):
+        for path in user_dir.glob(f"{window[0]:%Y%m%d%H%M%S}_*.parquet"):
+            if path.name != f"{name(window)}.parquet":
+                path.unlink()
+
+    todo = []
+    for window in windows:
+        if is_open(window) or not wikistore.partition_exists(user_dir, name(window)):
+            todo.append(window)
+        else:
+            drop_other_partitions(window)
+
+    def fetch(window):
+        df = fetch_user_contributions(username, window[0], window[1], endpoint=endpoint)
+        # empty windows are written too, so they aren't fetched again
+        wikistore.write_partition(df, user_dir, name(window))
+        drop_other_partitions(window)
+        return len(df)
+
+    for window, n, e in run_concurrently(fetch, todo, max_workers=max_workers, desc=username):
+        if e is not None:
+            print(f"Could not get contributions of {username} for {window[0]:%Y-%m-%d} to {window[1]:%Y-%m-%d}: {e}")
+
+    return user_dir
+
+"""
+redirects
+"""
+REDIRECT_COLUMNS = ['title', 'target', 'is_redirect', 'missing', 'fetched']
+
+def fetch_redirect_targets(titles, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Resolves up to 50 titles in one prop=info&redirects=1 request (following continuations):
+    title -> normalized title -> redirect target.
+
+    Returns:
+    resolved - a dictionary of title -> [target, is_redirect, missing, target_is_redirect], where target_is_redirect
+        means the target is itself a redirect (a double redirect) and needs another round
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['prop'] = 'info'
+    query_params['titles'] = '|'.join(titles)
+    query_params['redirects'] = 1
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    normalized = {}
+    redirects = {}
+    pages = {}
+    for json_response in api_query_continued(query_params, endpoint=endpoint):
+        query = json_response.get('query', {})
+        normalized.update({n['from']: n['to'] for n in query.get('normalized', [])})
+        redirects.update({r['from']: r['to'] for r in query.get('redirects', [])})
+        for page in query.get('pages', []):
+            pages[page['title']] = page
+
+    resolved = {}
+    for title in titles:
+        target = normalized.get(title, title)
+        is_redirect = target in redirects
+        seen = {target}
+        while target in redirects and redirects[target] not in seen:
+            target = redirects[target]
+            seen.add(target)
+        page = pages.get(target, {})
+        resolved[title] = [target, is_redirect, bool(page.get('missing', False) or page.get('invalid', False)), bool(page.get('redirect', False))]
+    return resolved
+
+def _open_redirect_store(store_file):
+    conn = sqlite3.connect(str(store_file), check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS redirects (title TEXT PRIMARY KEY, target TEXT, is_redirect INTEGER, missing INTEGER, fetched REAL)")
+    return conn
+
+def resolve_titles(titles, store_file=None, endpoint='en.wikipedia.org/w/api.php', max_workers=4, max_rounds=3):
+    """
+    Resolves many titles to their final pages: normalization, then redirect chains (double redirects get another
+    round, up to max_rounds). Titles are sent 50 per request, with the chunks run concurrently.
+    If store_file is given, title -> target is memoized in a sqlite table, and titles already in it aren't requested.
+
+    Returns:
+    df - a DataFrame with title | target | is_redirect | missing, one row per unique title
+    """
+    titles = list(dict.fromkeys(t for t in titles if isinstance(t, str) and t))
+
+    conn = _open_redirect_store(store_file) if store_file is not None else None
+    known = {}
+    if conn is not None:
+        for row in conn.execute("SELECT title, target, is_redirect, missing FROM redirects"):
+            known[row[0]] = [row[1], bool(row[2]), bool(row[3])]
+
+    # each title we still need, pointed at the title to look up next (itself, then intermediate targets of double redirects)
+    pending = {t: t for t in titles if t not in known}
+    resolved = {}
+    fetch = lambda chunk: fetch_redirect_targets(list(chunk), endpoint=endpoint)
+    for round_number in range(max_rounds):
+        if not pending:
+            break
+        lookups = {}
+        for chunk, result, e in run_concurrently(fetch, list(wf.chunks(list(dict.fromkeys(pending.values())), 50)), max_workers=max_workers, desc=f"redirects (round {round_number + 1})"):
+            if e is not None:
+                print(f"Could not resolve {len(chunk)} titles starting with {chunk[0]}: {e}")
+                continue
+            lookups.update(result)
+
+        next_pending = {}
+        for title, current in pending.items():
+            if current not in lookups:
+                continue
+            target, is_redirect, missing, target_is_redirect = lookups[current]
+            resolved[title] = [target, is_redirect or current != title, missing]
+            if target_is_redirect and round_number + 1 < max_rounds:
+                next_pending[title] = target
+        pending = next_pending
+
+    fetched = time.time()
+    if conn is not None:
+        conn.executemany("INSERT OR REPLACE INTO redirects (title, target, is_redirect, missing, fetched) VALUES (?, ?, ?, ?, ?)",
+                         [[title, *values, fetched] for title, values in resolved.items()])
+        conn.commit()
+        conn.close()
+
+    known.update(resolved)
+    rows = [[title, *known[title]] for title in titles if title in known]
+    return pd.DataFrame(rows, columns=['title', 'target', 'is_redirect', 'missing'])
+
+def load_redirect_map(store_file):
+    """
+    The memoized title -> target dictionary from a resolve_titles store, for joins that don't need the API at all.
+    """
+    conn = _open_redirect_store(store_file)
+    redirect_map = dict(conn.execute("SELECT title, target FROM redirects"))
+    conn.close()
+    return redirect_map
+
+"""
+batched pageids, QIDs and Wikidata covariates
+"""
+WIKIDATA_ENDPOINT = 'www.wikidata.org/w/api.php'
+
+def fetch_ids(titles, endpoint='en.wikipedia.org/w/api.php', redirects=1):
+    """
+    Gets the pageid and QID (wikibase_item) of up to 50 titles in one request, mapped back to the titles as given
+    (through normalization and redirects).
+
+    Returns:
+    ids - a dictionary of title -> {'title', 'returned_title', 'pageid', 'qid', 'missing'}
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['titles'] = '|'.join(titles)
+    query_params['redirects'] = redirects
+    query_params['prop'] = 'pageprops'
+    query_params['ppprop'] = 'wikibase_item'
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    normalized = {}
+    redirect_map = {}
+    pages = {}
+    for json_response in api_query_continued(query_params, endpoint=endpoint):
+        query = json_response.get('query', {})
+        normalized.update({n['from']: n['to'] for n in query.get('normalized', [])})
+        redirect_map.update({r['from']: r['to'] for r in query.get('redirects', [])})
+        for page in query.get('pages', []):
+            pages.setdefault(page['title'], {}).update(page)
+
+    ids = {}
+    for title in titles:
+        returned_title = normalized.get(title, title)
+        returned_title = redirect_map.get(returned_title, returned_title)
+        page = pages.get(returned_title, {})
+        ids[title] = {
+            'title': title,
+            'returned_title': returned_title,
+            'pageid': page.get('pageid'),
+            'qid': page.get('pageprops', {}).get('wikibase_item'),
+            'missing': bool(page.get('missing', False) or page.get('invalid', False) or not page),
+        }
+    return ids
+
+def get_ids(titles, endpoint='en.wikipedia.org/w/api.php', max_workers=4, cache_file=None):
+    """
+    Batched version of get_pageid / get_qid: 50 titles per request instead of one action=query per title,
+    with the batches run concurrently. Results can be cached per title in a sqlite file.
+
+    Returns:
+    df - a DataFrame with title | returned_title | pageid (Int64) | qid | missing, one row per unique title
+    """
+    cache = ResponseCache(cache_file) if cache_file is not None else None
+    key = lambda title: f"ids:{endpoint}:{title}"
+
+    titles = list(dict.fromkeys(unquote(t) for t in titles if isinstance(t, str) and t))
+    ids = {}
+    for title in titles:
+        cached = cache.get(key(title)) if cache is not None else None
+        if cached is not None:
+            ids[title] = cached
+    missing = [t for t in titles if t not in ids]
+
+    fetch = lambda chunk: fetch_ids(list(chunk), endpoint=endpoint)
+    for chunk, result, e in run_concurrently(fetch, list(wf.chunks(missing, 50)), max_workers=max_workers, desc="pageids and qids"):
+        if e is not None:
+            print(f"Could not get ids for {len(chunk)} titles starting with {chunk[0]}: {e}")
+            continue
+        for title, record in result.items():
+            ids[title] = record
+            if cache is not None:
+                cache.put(key(title), record)
+
+    if cache is not None:
+        cache.close()
+
+    df = pd.DataFrame([ids[t] for t in titles if t in ids], columns=['title', 'returned_title', 'pageid', 'qid', 'missing'])
+    df['pageid'] = df['pageid'].astype('Int64')
+    df['qid'] = df['qid'].astype('string')
+    df['missing'] = df['missing'].astype(bool)
+    return df
+
+def _claim_value(claims, prop):
+    # the first (preferred-or-normal rank) value of a property, as an entity id, time, quantity or string
+    statements = [c for c in claims.get(prop, []) if c.get('rank') != 'deprecated']
+    statements.sort(key=lambda c: c.get('rank') != 'preferred')
+    for statement in statements:
+        datavalue = statement.get('mainsnak', {}).get('datavalue')
+        if datavalue is None:
+            continue
+        value = datavalue['value']
+        if datavalue['type'] == 'wikibase-entityid':
+            return value['id']
+        if datavalue['type'] == 'time':
+            return value['time']
+        if datavalue['type'] == 'quantity':
+            return float(value['amount'])
+        if datavalue['type'] == 'monolingualtext':
+            return value['text']
+        return value if isinstance(value, str) else json.dumps(value)
+    return None
+
+def fetch_entities(qids, properties, endpoint=WIKIDATA_ENDPOINT, cache=None):
+    """
+    Gets up to 50 Wikidata entities in one wbgetentities request.
+
+    Returns:
+    records - a list of dictionaries with qid | label | sitelinks | claims | one key per property
+    """
+    query_params = {}
+    query_params['action'] = 'wbgetentities'
+    query_params['ids'] = '|'.join(qids)
+    query_params['props'] = 'labels|claims|sitelinks'
+    query_params['languages'] = 'en'
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    json_response = api_get(f"https://{endpoint}", query_params, cache=cache)
+    if 'entities' not in json_response:
+        raise ValueError(f"No entities in the response: {json_response.get('error')}")
+
+    records = []
+    for qid, entity in json_response['entities'].items():
+        if 'missing' in entity:
+            continue
+        claims = entity.get('claims', {})
+        record = {
+            'qid': qid,
+            'label': entity.get('labels', {}).get('en', {}).get('value'),
+            'sitelinks': len(entity.get('sitelinks', {})),
+            'claims': len(claims),
+        }
+        for prop in properties:
+            record[prop] = _claim_value(claims, prop)
+        records.append(record)
+    return records
+
+def get_wikidata_covariates(qids, properties=('P31', 'P17', 'P27', 'P569', 'P571', 'P577'), max_workers=4, cache_file=None):
+    """
+    Gets a few Wikidata covariates for many QIDs, 50 entities per wbgetentities request, with the batches run
+    concurrently and the responses cached.
+
+    properties - the property ids to pull out (the first preferred/normal value of each):
+        e.g. P31 instance of, P17 country, P27 citizenship, P569 date of birth, P571 inception, P577 publication date
+
+    Returns:
+    df - a typed DataFrame: qid | label | sitelinks | claims | one column per property
+        (time values as UTC datetimes, quantities as floats, entity ids and strings as strings)
+    """
+    cache = ResponseCache(cache_file) if cache_file is not None else None
+    qids = sorted(set(q for q in qids if isinstance(q, str) and q.startswith('Q')))
+    properties = list(properties)
+
+    records = []
+    fetch = lambda chunk: fetch_entities(list(chunk), properties, cache=cache)
+    for chunk, result, e in run_concurrently(fetch, list(wf.chunks(qids, 50)), max_workers=max_workers, desc="wikidata entities"):
+        if e is not None:
+            print(f"Could not get {len(chunk)} entities starting with {chunk[0]}: {e}")
+            continue
+        records += result
+
+    if cache is not None:
+        cache.close()
+
+    df = pd.DataFrame(records, columns=['qid', 'label', 'sitelinks', 'claims'] + properties)
+    df['qid'] = df['qid'].astype('string')
+    df['label'] = df['label'].astype('string')
+    df['sitelinks'] = df['sitelinks'].astype('Int64')
+    df['claims'] = df['claims'].astype('Int64')
+    for prop in properties:
+        values = df[prop].dropna()
+        if len(values) > 0 and values.map(lambda v: isinstance(v, float)).all():
+            df[prop] = df[prop].astype('Float64')
+        elif len(values) > 0 and values.map(lambda v: isinstance(v, str) and v[:1] in '+-' and 'T' in v).all():
+            # Wikidata times look like +2001-01-15T00:00:00Z (and can be year-only, with -00-00)
+            df[prop] = pd.to_datetime(df[prop].str.lstrip('+').str.replace('-00', '-01'), utc=True, errors='coerce')
+        else:
+            df[prop] = df[prop].astype('string')
+    return df.sort_values('qid').reset_index(drop=True)
+
+"""
+batched page wikitext
+"""
+def get_pages_wikitext(titles, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Gets the current wikitext of up to 50 pages in one prop=revisions&rvprop=content&rvslots=main request
+    (action=parse only takes one page per request). Redirects are followed, like action=parse&redirects=1 does, and
+    titles are mapped back through normalization and redirects (as in fetch_redirect_targets).
+
+    Returns:
+    pages - a dictionary of title -> {'returned_title', 'pageid', 'revid', 'timestamp', 'wikitext', 'missing', 'redirected'},
+        where returned_title is the page the wikitext is from
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['titles'] = '|'.join(titles)
+    query_params['prop'] = 'revisions'
+    query_params['rvprop'] = 'ids|timestamp|content'
+    query_params['rvslots'] = 'main'
+    query_params['redirects'] = 1
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    normalized = {}
+    redirects = {}
+    found = {}
+    for json_response in api_query_continued(query_params, endpoint=endpoint):
+        query = json_response.get('query', {})
+        normalized.update({n['from']: n['to'] for n in query.get('normalized', [])})
+        redirects.update({r['from']: r['to'] for r in query.get('redirects', [])})
+        for page in query.get('pages', []):
+            record = found.setdefault(page['title'], {'returned_title': page['title'], 'pageid': page.get('pageid'), 'revid': None,
+                                                      'timestamp': None, 'wikitext': None, 'missing': 'missing' in page or 'invalid' in page,
+                                                      'redirected': False})
+            for rev in page.get('revisions', []):
+                record['revid'] = rev.get('revid')
+                record['timestamp'] = rev.get('timestamp')
+                record['wikitext'] = rev.get('slots', {}).get('main', {}).get('content')
+
+    pages = {}
+    for title in titles:
+        returned_title = normalized.get(title, title)
+        seen = {returned_title}
+        while returned_title in redirects and redirects[returned_title] not in seen:
+            returned_title = redirects[returned_title]
+            seen.add(returned_title)
+        page = found.get(returned_title, {'returned_title': returned_title, 'pageid': None, 'revid': None,
+                                          'timestamp': None, 'wikitext': None, 'missing': True})
+        pages[title] = dict(page, redirected=len(seen) > 1)
+    return pages
+
+def render_wikitext_page(page_title, revid=None, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Renders a page (or a specific revision of it) to HTML through action=parse, for when a wikitext-only copy
+    needs HTML after all.
+    """
+    query_params = {}
+    query_params['action'] = 'parse'
+    if revid is not None:
+        query_params['oldid'] = revid
+    else:
+        query_params['page'] = page_title
+        query_params['redirects'] = 1
+    query_params['prop'] = 'text'
+    query_params['disableeditsection'] = 1
+    query_params['disabletoc'] = 1
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    json_response = api_get(f"https://{endpoint}", query_params)
+    if 'parse' in json_response:
+        return json_response['parse']['text']
+    return str()
+
+def get_last_revids(titles, endpoint='en.wikipedia.org/w/api.php', max_workers=4):
+    """
+    Gets the lastrevid of many pages, 50 per prop=info request, so callers can tell which pages changed
+    without fetching them.
+
+    Returns:
+    lastrevids - a dictionary of title -> lastrevid (None for pages that don't exist)
+    """
+    def fetch(chunk):
+        query_params = {}
+        query_params['action'] = 'query'
+        query_params['prop'] = 'info'
+        query_params['titles'] = '|'.join(chunk)
+        query_params['format'] = 'json'
+        query_params['formatversion'] = 2
+
+        normalized = {}
+        found = {}
+        for json_response in api_query_continued(query_params, endpoint=endpoint):
+            query = json_response.get('query', {})
+            normalized.update({n['from']: n['to'] for n in query.get('normalized', [])})
+            for page in query.get('pages', []):
+                found[page['title']] = page.get('lastrevid')
+        return {title: found.get(normalized.get(title, title)) for title in chunk}
+
+    lastrevids = {}
+    for chunk, result, e in run_concurrently(fetch, list(wf.chunks(list(titles), 50)), max_workers=max_workers, desc="lastrevids"):
+        if e is not None:
+            print(f"Could not get lastrevids for {len(chunk)} pages starting with {chunk[0]}: {e}")
+            continue
+        lastrevids.update(result)
+    return lastrevids
+
+"""
+deletion, move and creation logs
+"""
+LOG_EVENT_COLUMNS = ['logid', 'type', 'action', 'title', 'ns', 'timestamp', 'user', 'comment', 'target_title']
+
+def fetch_log_events(letype, start, stop, namespace=0, endpoint='en.wikipedia.org/w/api.php'):
+    """
+    Gets every list=logevents event of one type (e.g. delete, move) between start and stop, following continuations.
+
+    Returns:
+    events - a list of rows in the LOG_EVENT_COLUMNS order (target_title is the new title for moves)
+    """
+    query_params = {}
+    query_params['action'] = 'query'
+    query_params['list'] = 'logevents'
+    query_params['letype'] = letype
+    query_params['lenamespace'] = namespace
+    query_params['leprop'] = 'ids|title|type|user|timestamp|comment|details'
+    query_params['lestart'] = datetime.strftime(pd.to_datetime(start), '%Y-%m-%dT%H:%M:%SZ')
+    query_params['leend'] = datetime.strftime(pd.to_datetime(stop), '%Y-%m-%dT%H:%M:%SZ')
+    query_params['ledir'] = 'newer'
+    query_params['lelimit'] = 500
+    query_params['format'] = 'json'
+    query_params['formatversion'] = 2
+
+    events = []
+    for json_response in api_query_continued(query_params, endpoint=endpoint):
+        for event in json_response.get('query', {}).get('logevents', []):
+            target_title = event.get('params', {}).get('target_title')
+            events.append([event.get('logid'), event.get('type'), event.get('action'), event.get('title'), event.get('ns'),
+                           event.get('timestamp'), event.get('user'), event.get('comment'), target_title])
+    return events
+
+def collect_log_events(store_file, start='2005-01-01', stop='today', letypes=('delete', 'move', 'create'), freq='MS', namespace=0, endpoint='en.wikipedia.org/w/api.php', max_workers=4):
+    """
+    Pulls the deletion (including restores), move and creation logs over the AfD time range once and keeps them in a
+    local sqlite table, indexed by title and by move target.
+    The range is split into windows (monthly by default) that are fetched concurrently; windows already in the
+    store are skipped on a rerun.
+
+    Returns:
+    n - the number of events added
+    """
+    conn = sqlite3.connect(str(store_file), check_same_thread=False)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS logevents (logid INTEGER PRIMARY KEY, type TEXT, action TEXT, title TEXT, ns INTEGER, timestamp TEXT, user TEXT, comment TEXT, target_title TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS logevents_title ON logevents (title)")
+    conn.execute("CREATE INDEX IF NOT EXISTS logevents_target ON logevents (target_title)")
+    conn.execute("CREATE TABLE IF NOT EXISTS collected_windows (letype TEXT, start TEXT, stop TEXT, PRIMARY KEY (letype, start, stop))")
+    done = set(conn.execute("SELECT letype, start, stop FROM collected_windows"))
+
+    windows = []
+    for letype in letypes:
+        for window_start, window_stop in contribution_windows(start, stop, freq=freq):
+            window = (letype, window_start.strftime('%Y-%m-%dT%H:%M:%S'), window_stop.strftime('%Y-%m-%dT%H:%M:%S'))
+            # the last window is still open, so it is always fetched again
+            if window not in done or window_is_open([window_start, window_stop], freq=freq):
+                windows.append(window)
+
+    fetch = lambda window: fetch_log_events(window[0], window[1], window[2], namespace=namespace, endpoint=endpoint)
+    n = 0
+    for window, events, e in run_concurrently(fetch, windows, max_workers=max_workers, desc="log windows"):
+        if e is not None:
+            print(f"Could not get {window[0]} events for {window[1]} to {window[2]}: {e}")
+            continue
+        conn.executemany(f"INSERT OR REPLACE INTO logevents ({', '.join(LOG_EVENT_COLUMNS)}) VALUES ({', '.join('?' * len(LOG_EVENT_COLUMNS))})", events)
+        conn.execute("INSERT OR REPLACE INTO collected_windows (letype, start, stop) VALUES (?, ?, ?)", window)
+        conn.commit()
+        n += len(events)
+
+    conn.close()
+    return n
+
+def get_page_fates(titles, afd_dates, store_file, check_current=True, endpoint='en.wikipedia.org/w/api.php', max_workers=4):
+    """
+    Joins case titles against the stored deletion/move/creation log to get each page's fate after its AfD, for every
+    case at once. Events on the title itself count, and so do moves whose target is the title (a page moved back in).
+
+    titles - the page titles (e.g. case_title_cleaned)
+    afd_dates - the AfD date of each title (events before it are ignored)
+    check_current - confirm the terminal fates (deleted, moved) against the current state of the title with one
+        prop=info request per 50 titles; a title that exists now (and isn't a redirect) was brought back after its
+        last logged event, so its fate is set back to None
+
+    Returns:
+    df - a DataFrame with title | afd_date | fate | fate_timestamp | fate_user | fate_target | fate_comment, where fate is
+        'deleted', 'moved' (target in fate_target), 'restored' (deleted then undeleted), 'recreated' (created again,
+        or another page moved into the title), or None when the log has nothing for the title after its AfD or the
+        current state contradicts it (those are the ones left for per-title probes, like check_exists_and_title)
+    """
+    cases = pd.DataFrame({'title': canonical_titles(titles).astype(object),
+                          'afd_date': pd.to_datetime(pd.Series(afd_dates).reset_index(drop=True), utc=True)})
+
+    conn = sqlite3.connect(str(store_file))
+    conn.execute("CREATE INDEX IF NOT EXISTS logevents_target ON logevents (target_title)")
+    conn.execute("CREATE TEMP TABLE case_titles (title TEXT PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO case_titles (title) VALUES (?)", [[str(t)] for t in cases['title'].dropna().unique()])
+    on_title = pd.read_sql_query("SELECT e.* FROM logevents e JOIN case_titles c ON e.title = c.title", conn)
+    into_title = pd.read_sql_query("SELECT e.* FROM logevents e JOIN case_titles c ON e.target_title = c.title WHERE e.type = 'move'", conn)
+    conn.close()
+
+    # a move into the title is an event of the title it was moved to
+    into_title['action'] = 'move_in'
+    into_title['title'] = into_title['target_title']
+    events = pd.concat([on_title, into_title], ignore_index=True)
+
+    events['timestamp'] = pd.to_datetime(events['timestamp'], utc=True)
+    events = events.merge(cases.drop_duplicates(), on='title')
+    events = events[events['timestamp'] >= events['afd_date']]
+    events = events.sort_values(['timestamp', 'logid'])
+
+    # the latest deletion/restore/move/creation event after the AfD decides the fate
+    fate_map = {('delete', 'delete'): 'deleted', ('delete', 'delete_redir'): 'deleted', ('delete', 'restore'): 'restored',
+                ('move', 'move'): 'moved', ('move', 'move_redir'): 'moved', ('move', 'move_in'): 'recreated',
+                ('create', 'create'): 'recreated'}
+    events['fate'] = [fate_map.get((t, a)) for t, a in zip(events['type'], events['action'])]
+    events = events.dropna(subset=['fate'])
+    latest = events.drop_duplicates(subset=['title', 'afd_date'], keep='last')
+    latest = latest.rename(columns={'timestamp': 'fate_timestamp', 'user': 'fate_user', 'target_title': 'fate_target', 'comment': 'fate_comment'})
+    latest.loc[latest['fate'] != 'moved', 'fate_target'] = None
+
+    if check_current:
+        terminal = latest['fate'].isin(['deleted', 'moved'])
+        current = {}
+        fetch = lambda chunk: fetch_redirect_targets(list(chunk), endpoint=endpoint)
+        for chunk, result, e in run_concurrently(fetch, list(wf.chunks(latest.loc[terminal, 'title'].unique().tolist(), 50)), max_workers=max_workers, desc="current state"):
+            if e is not None:
+                print(f"Could not check the current state of {len(chunk)} titles starting with {chunk[0]}: {e}")
+                continue
+            current.update(result)
+        # a deleted title has to be missing now, and a moved one missing or a redirect; unchecked titles aren't settled
+        confirmed = [title in current and (current[title][2] or (fate == 'moved' and current[title][1]))
+                     for title, fate in zip(latest['title'], latest['fate'])]
+        contradicted = terminal & ~pd.Series(confirmed, index=latest.index)
+        if contradicted.any():
+            print(f"{int(contradicted.sum())} deleted or moved titles exist now (or couldn't be checked); leaving them unsettled.")
+        latest = latest[~contradicted]
+
+    df = cases.merge(latest[['title', 'afd_date', 'fate', 'fate_timestamp', 'fate_user', 'fate_target', 'fate_comment']], on=['title', 'afd_date'], how='left')
+    return df
+
+"""
+sharding: splitting the titles between machines by a stable hash, so that shards never overlap
+"""
+def parse_shard(spec):
+    """
+    Parses a --shard value "i/N" (i counts from 0) into (i, N).
+    """
+    try:
+        i, n = (int(part) for part in str(spec).split('/'))
+    except ValueError:
+        raise ValueError(f"A shard is given as i/N, e.g. 0/4, not {spec}")
+    if n < 1 or not 0 <= i < n:
+        raise ValueError(f"Shard {spec} is out of range: i has to be between 0 and N-1")
+    return i, n
+
+def shard_of(titles, n_shards):
+    """
+    The shard of each title: the sha1 of the title (UTF-8) mod n_shards. Unlike hash(), this is the same on every
+    machine and in every run.
+
+    Returns:
+    a list of shard numbers, in the order of titles
+    """
+    return [int(hashlib.sha1(str(title).encode("utf-8")).hexdigest()[:12], 16) % n_shards for title in titles]
+
+def in_shard(titles, shard):
+    """
+    Returns:
+    a list of booleans, True for the titles that belong to shard (an (i, N) tuple)
+    """
+    i, n = shard
+    return [s == i for s in shard_of(titles, n)]
+
+def shard_dir(base_dir, shard):
+    """
+    Where a shard writes the files that would otherwise go in base_dir: base_dir/shard_i_of_N.
+    """
+    i, n = shard
+    return Path(base_dir) / f"shard_{i}_of_{n}"
+
+"""
+title keys: one canonical form for the titles in the case table, the chunk metadata, the earliest revision files
+and the revision store, so that they can be joined on it
+"""
+NOMINATION_RE = r'\s*\((?:\d+(?:st|nd|rd|th)|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth) nomination\)$'
+
+try:
+    TITLE_DTYPE = pd.StringDtype("pyarrow")
+except ImportError:
+    TITLE_DTYPE = pd.StringDtype()
+
+def canonical_titles(titles):
+    """
+    Puts titles in one canonical form, column-wise: URL-unquoted, underscores as spaces, without a /wiki/ or
+    Wikipedia:Articles_for_deletion/ prefix or a "(2nd nomination)" suffix, whitespace collapsed, first letter upper case.
+    Only the titles with a % in them are unquoted one by one; everything else is a vectorized string operation
+    (on Arrow strings if pyarrow is installed).
+
+    titles - a list, array or Series of titles
+
+    Returns:
+    a string Series of canonical titles, in the same order, with missing values for missing or empty titles
+    """
+    s = pd.Series(titles).reset_index(drop=True)
+    s = s.where(s.map(type) == str).astype(TITLE_DTYPE)
+
+    quoted = s.str.contains('%', regex=False).fillna(False).astype(bool)
+    if quoted.any():
+        s[quoted] = s[quoted].map(unquote)
+
+    s = s.str.replace('_', ' ', regex=False)
+    s = s.str.replace(r'^(?:https?://[^/]+)?/wiki/', '', regex=True)
+    s = s.str.replace(r'^Wikipedia:Articles for deletion/', '', regex=True, case=False)
+    s = s.str.replace(NOMINATION_RE, '', regex=True, case=False)
+    s = s.str.replace(r'\s+', ' ', regex=True).str.strip()
+    s = s.str.slice(0, 1).str.upper() + s.str.slice(1)
+    return s.mask(s == '')
\ No newline at end of file
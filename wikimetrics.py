@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import requests
+import threading
+import functools
+import contextlib
+import atexit
+import json
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+"""
+One instrumentation layer for the collectors: per-action request counts, latency histograms, response bytes,
+retries, throttle time, cache hits and parse/function time, kept in a module-level Metrics object.
+
+wikihelpers.api_get and RateLimiter record into it, wikifunctions goes through wikimetrics.get instead of requests.get,
+and parse steps are wrapped with @wikimetrics.timed(...). start_writer(...) writes a snapshot to a JSON or
+Prometheus-text file every `interval` seconds, so a running crawl can be watched with `cat` or scraped.
+Metrics are per process: work done inside a ProcessPoolExecutor worker is not counted in the parent.
+"""
+
+# latency buckets in seconds (upper bounds), the last one catches everything
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf')]
+
+def request_label(url, params=None):
+    """
+    The name requests are grouped under: the API action (with the list/prop module for action=query),
+    or the host and first path segment for REST endpoints (e.g., wikimedia.org/api).
+    """
+    params = params or {}
+    action = params.get('action')
+    if action == 'query':
+        module = params.get('list') or params.get('prop') or params.get('meta')
+        return f"query:{module}" if module else "query"
+    if action:
+        return str(action)
+    parsed = urlparse(url)
+    segment = parsed.path.strip('/').split('/')[0]
+    return f"{parsed.netloc}/{segment}" if segment else parsed.netloc
+
+class Metrics:
+    """
+    Thread-safe counters, keyed by request label or timer name.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.timers = {}
+        self.throttle_seconds = 0.0
+        self.throttle_waits = 0
+
+    def _request_entry(self, label):
+        if label not in self.requests:
+            self.requests[label] = {'count': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0,
+                                    'cache_hits': 0, 'cache_misses': 0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+        return self.requests[label]
+
+    def record_request(self, label, seconds, nbytes=0, error=False):
+        with self.lock:
+            entry = self._request_entry(label)
+            entry['count'] += 1
+            entry['errors'] += int(error)
+            entry['bytes'] += nbytes
+            entry['seconds'] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+                    break
+
+    def record_retry(self, label):
+        with self.lock:
+            self._request_entry(label)['retries'] += 1
+
+    def record_cache(self, label, hit):
+        with self.lock:
+            self._request_entry(label)['cache_hits' if hit else 'cache_misses'] += 1
+
+    def record_throttle(self, seconds):
+        with self.lock:
+            self.throttle_waits += 1
+            self.throttle_seconds += seconds
+
+    def record_time(self, name, seconds):
+        with self.lock:
+            entry = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+    def snapshot(self):
+        """
+        Returns:
+        a JSON-serializable dictionary of everything recorded so far
+        """
+        with self.lock:
+            requests_copy = {label: dict(entry, buckets=list(entry['buckets'])) for label, entry in self.requests.items()}
+            timers_copy = {name: dict(entry) for name, entry in self.timers.items()}
+            throttle = {'waits': self.throttle_waits, 'seconds': self.throttle_seconds}
+        return {
+            'started': self.started,
+            'written': time.time(),
+            'latency_buckets': [str(b) for b in LATENCY_BUCKETS],
+            'requests': requests_copy,
+            'timers': timers_copy,
+            'throttle': throttle,
+        }
+
+    def to_prometheus(self):
+        """
+        The snapshot in the Prometheus text exposition format.
+        """
+        snap = self.snapshot()
+        lines = []
+        for label, entry in sorted(snap['requests'].items()):
+            tag = f'action="{label}"'
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS, entry['buckets']):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else str(bound)
+                lines.append(f'wiki_request_seconds_bucket{{{tag},le="{le}"}} {cumulative}')
+            lines.append(f'wiki_request_seconds_sum{{{tag}}} {entry["seconds"]}')
+            lines.append(f'wiki_request_seconds_count{{{tag}}} {entry["count"]}')
+            for key in ['errors', 'retries', 'bytes', 'cache_hits', 'cache_misses']:
+                lines.append(f'wiki_request_{key}_total{{{tag}}} {entry[key]}')
+        for name, entry in sorted(snap['timers'].items()):
+            lines.append(f'wiki_function_seconds_sum{{name="{name}"}} {entry["seconds"]}')
+            lines.append(f'wiki_function_seconds_count{{name="{name}"}} {entry["count"]}')
+        lines.append(f'wiki_throttle_seconds_total {snap["throttle"]["seconds"]}')
+        lines.append(f'wiki_throttle_waits_total {snap["throttle"]["waits"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes the snapshot to path (Prometheus text if it ends in .prom, JSON otherwise), via a temporary file so
+        that a reader never sees a half-written file.
+        """
+        path = Path(path)
+        if path.suffix == '.prom':
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=4)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        tmp_path.replace(path)
+
+# everything records into this one
+metrics = Metrics()
+
+# when set (see use_limiter), get() waits on it before every request
+_limiter = None
+
+def use_limiter(limiter):
+    """
+    Makes every get() wait on limiter (e.g., wikihelpers.api_limiter) first, so threads that call the plain request
+    functions share one request rate with api_get. None turns it off.
+    """
+    global _limiter
+    _limiter = limiter
+
+def get(url, params=None, **kwargs):
+    """
+    Drop-in for requests.get that records the request's latency, bytes and errors under its request_label
+    (after waiting on the rate limiter, if one was set with use_limiter).
+    """
+    label = request_label(url, params)
+    if _limiter is not None:
+        _limiter.wait()
+    start = time.perf_counter()
+    try:
+        response = requests.get(url, params=params, **kwargs)
+    except Exception:
+        metrics.record_request(label, time.perf_counter() - start, error=True)
+        raise
+    metrics.record_request(label, time.perf_counter() - start, len(response.content), error=response.status_code >= 400)
+    return response
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Context manager version of timed, for a block inside a function (e.g., just the BeautifulSoup call).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record_time(name, time.perf_counter() - start)
+
+def timed(name):
+    """
+    Decorator that records how long each call of the function takes under `name` (e.g., 'parse.extract_page').
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.record_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def start_writer(path, interval=30):
+    """
+    Writes the metrics to path every `interval` seconds on a daemon thread, and once more when the process exits.
+
+    Returns:
+    stop - an Event; set it to stop the writer
+    """
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            metrics.write(path)
+
+    threading.Thread(target=loop, daemon=True).start()
+    atexit.register(metrics.write, path)
+    return stop
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+from datetime import datetime
+from urllib.parse import quote
+from pathlib import Path
+import wikihelpers as wiki
+import concurrent.futures
+from tqdm import tqdm
+import argparse
+import gzip
+import bz2
+import re
+
+"""
+Bulk pageview collection for treated and matched articles.
+wikifunctions.get_pageviews makes one call per article over the whole date range and raises on a missing 'items' key;
+here we fetch a window around each article's AfD date, on a bounded thread pool, with cached responses,
+and write everything into one columnar table. Failures are recorded instead of aborting the run.
+"""
+
+PAGEVIEWS_URL = "https://wikimedia.org/api/rest_v1/metrics/pageviews/per-article/{project}/{access}/{agent}/{title}/daily/{start}/{stop}"
+
+# the REST API has no data before this date
+EARLIEST_PAGEVIEWS = pd.Timestamp('2015-07-01')
+
+# the pageviews REST API allows more requests per second than the action API does
+pageviews_limiter = wiki.RateLimiter(rate=50)
+
+def pageview_windows(df, title_col='page_title', date_col='afd_date', days_before=90, days_after=90):
+    """
+    Builds one date window per article around its AfD date (or the pseudo-AfD date of a matched control).
+
+    df - a DataFrame with a title column and a date column
+    days_before, days_after - how many days of pageviews to get on each side of the date
+
+    Returns:
+    windows - a DataFrame with page_title | start | stop, clipped to the earliest date the API has,
+        deduplicated, and without windows that end before the API has any data
+    """
+    windows = pd.DataFrame()
+    windows['page_title'] = df[title_col].astype(str)
+    dates = pd.to_datetime(df[date_col]).dt.tz_localize(None).dt.normalize()
+    windows['start'] = (dates - pd.Timedelta(days=days_before)).clip(lower=EARLIEST_PAGEVIEWS)
+    windows['stop'] = dates + pd.Timedelta(days=days_after)
+
+    windows = windows.dropna()
+    windows = windows[windows['stop'] >= EARLIEST_PAGEVIEWS]
+    windows = windows.drop_duplicates().reset_index(drop=True)
+    return windows
+
+def fetch_pageviews(page_title, start, stop, project='en.wikipedia.org', access='all-access', agent='user', cache=None):
+    """
+    Gets the daily pageviews for one article and one window.
+
+    Returns:
+    df - a DataFrame with page_title | timestamp | views, one row per day with data
+
+    Raises a KeyError (like get_pageviews) if the response has no 'items', and requests.HTTPError if the API says 404.
+    """
+    url = PAGEVIEWS_URL.format(project=project, access=access, agent=agent,
+                               title=quote(page_title.replace(' ', '_'), safe=''),
+                               start=datetime.strftime(pd.to_datetime(start), '%Y%m%d'),
+                               stop=datetime.strftime(pd.to_datetime(stop), '%Y%m%d'))
+    json_response = wiki.api_get(url, cache=cache, limiter=pageviews_limiter)
+
+    if 'items' not in json_response:
+        raise KeyError('There is no "items" key in the JSON response.')
+
+    df = pd.DataFrame(json_response['items'], columns=['timestamp', 'views'])
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y%m%d%H')
+    df.insert(0, 'page_title', page_title)
+    return df
+
+def get_bulk_pageviews(windows, output_file, failures_file=None, cache_file=None, max_workers=8, project='en.wikipedia.org'):
+    """
+    Gets the pageviews for every (page_title, start, stop) window and writes them into one parquet table.
+
+    windows - the output of pageview_windows
+    output_file - where to write the pageview table (page_title | timestamp | views)
+    failures_file - where to write page_title | start | stop | error for the windows that failed;
+        defaults to the output_file with a _failures.tsv suffix
+    cache_file - a sqlite file for caching API responses, so that reruns only fetch what is missing
+    max_workers - how many requests can be in flight at once
+
+    Returns:
+    views_df, failures_df
+    """
+    output_file = Path(output_file)
+    if failures_file is None:
+        failures_file = output_file.with_name(output_file.stem + "_failures.tsv")
+    cache = wiki.ResponseCache(cache_file) if cache_file is not None else None
+
+    rows = list(windows[['page_title', 'start', 'stop']].itertuples(index=False, name=None))
+
+    def fetch(row):
+        page_title, start, stop = row
+        return fetch_pageviews(page_title, start, stop, project=project, cache=cache)
+
+    results = []
+    failures = []
+    for row, df, e in wiki.run_concurrently(fetch, rows, max_workers=max_workers, desc="pageviews"):
+        if e is not None:
+            failures.append([*row, f"{type(e).__name__}: {e}"])
+        elif len(df) > 0:
+            results.append(df)
+
+    if cache is not None:
+        cache.close()
+
+    if results:
+        views_df = pd.concat(results, ignore_index=True)
+    else:
+        views_df = pd.DataFrame(columns=['page_title', 'timestamp', 'views'])
+    # overlapping windows (e.g., one control matched to several treated articles) return the same days more than once
+    views_df = views_df.drop_duplicates(subset=['page_title', 'timestamp'])
+    views_df = views_df.sort_values(['page_title', 'timestamp']).reset_index(drop=True)
+    views_df['page_title'] = views_df['page_title'].astype('category')
+    views_df['views'] = views_df['views'].astype('int64')
+    views_df.to_parquet(output_file, index=False)
+
+    failures_df = pd.DataFrame(failures, columns=['page_title', 'start', 'stop', 'error'])
+    failures_df.to_csv(failures_file, sep="\t", index=False)
+
+    print(f"Saved {len(views_df)} daily pageview rows for {views_df['page_title'].nunique()} pages to {output_file}")
+    print(f"{len(failures_df)} windows failed, see {failures_file}")
+    return views_df, failures_df
+
+def to_series(views_df, page_title):
+    """
+    Pulls one article out of the pageview table in the same shape get_pageviews returns: a Series of views indexed by timestamp.
+    """
+    subset = views_df[views_df['page_title'] == page_title]
+    return subset.set_index('timestamp')['views']
+
+"""
+Offline alternative: aggregate the Wikimedia pageview dump files (https://dumps.wikimedia.org/other/pageviews/ and
+https://dumps.wikimedia.org/other/pageview_complete/) that have been downloaded to local disk.
+Each file is streamed once, line by line, and only the lines for titles in our set are kept, so memory
+only grows with the number of (title, day) pairs we care about, not with the size of the dump.
+"""
+def _open_dump(path):
+    path = str(path)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+def read_pageview_dump(path, titles, wiki_code='en.wikipedia'):
+    """
+    Streams one hourly or daily pageview dump file and sums the views for the titles we care about.
+
+    path - a pageviews-YYYYMMDD-HH0000.gz (hourly) or pageviews-YYYYMMDD-user.bz2 (daily, pageview_complete) file
+    titles - a set of page titles, with underscores instead of spaces (as they appear in the dumps)
+    wiki_code - which wiki to keep. Hourly files use domain codes (en = desktop, en.m = mobile),
+        daily files use the wiki code itself (en.wikipedia); both are handled.
+
+    Returns:
+    counts - a dictionary keyed by (page_title, date) with the number of views
+    """
+    date_match = re.search(r'(\d{8})', Path(path).name)
+    if not date_match:
+        raise ValueError(f"Could not get a date from the dump file name: {path}")
+    date = pd.Timestamp(date_match.group(1))
+
+    lang = wiki_code.split('.')[0]
+    domains = {wiki_code, lang, f"{lang}.m"}
+
+    counts = {}
+    with _open_dump(path) as f:
+        for line in f:
+            fields = line.split(' ')
+            if fields[0] not in domains or len(fields) < 4:
+                continue
+            title = fields[1]
+            if title not in titles:
+                continue
+            if len(fields) >= 6:
+                # daily: wiki_code title page_id access_method daily_total hourly_counts
+                views = fields[4]
+            else:
+                # hourly: domain_code title count_views total_response_size
+                views = fields[2]
+            if not views.isdigit():
+                continue
+            key = (title, date)
+            counts[key] = counts.get(key, 0) + int(views)
+
+    return counts
+
+# the two dump families: hourly pageviews-YYYYMMDD-HH0000(.gz) and daily pageview_complete pageviews-YYYYMMDD-user(.bz2)
+DUMP_FILE_RES = {
+    'hourly': re.compile(r'^pageviews-(\d{8})-\d{6}(?:\.gz|\.bz2)?$'),
+    'daily': re.compile(r'^pageviews-(\d{8})-user(?:\.gz|\.bz2)?$'),
+}
+
+def dump_family(path):
+    """
+    Returns:
+    'hourly' or 'daily' for a pageview dump file (by its name), or None if it is neither
+    """
+    for family, pattern in DUMP_FILE_RES.items():
+        if pattern.match(Path(path).name):
+            return family
+    return None
+
+def select_dump_files(dump_files, dump_type=None):
+    """
+    Picks the dump files to aggregate: only the files of dump_type ('hourly' or 'daily') if it is given, otherwise
+    all the hourly and daily files. Both families cover the same views, so a day that has files of both would be
+    counted twice; that raises a ValueError (choose one family with dump_type).
+
+    Returns:
+    dump_files - the selected files, sorted
+    """
+    families = {path: dump_family(path) for path in dump_files}
+    selected = sorted(path for path, family in families.items() if family is not None and (dump_type is None or family == dump_type))
+    days = {}
+    for path in selected:
+        days.setdefault(DUMP_FILE_RES[families[path]].match(Path(path).name).group(1), set()).add(families[path])
+    overlapping = sorted(day for day, day_families in days.items() if len(day_families) > 1)
+    if overlapping:
+        raise ValueError(f"{len(overlapping)} days have both hourly and daily dump files (e.g. {overlapping[:5]}), so their views would be counted twice; choose one dump type")
+    return selected
+
+# set once per worker process, so the title set isn't pickled again for every file
+_dump_titles = None
+
+def _init_dump_worker(titles):
+    global _dump_titles
+    _dump_titles = titles
+
+def _read_dump_in_worker(path, wiki_code):
+    return read_pageview_dump(path, _dump_titles, wiki_code=wiki_code)
+
+def aggregate_pageview_dumps(dump_files, titles, wiki_code='en.wikipedia', max_workers=4):
+    """
+    Aggregates many dump files (in parallel, one file per process) into daily pageviews for the given titles.
+    Hourly files are summed up to days, so the result lines up with what get_pageviews returns.
+
+    dump_files - a list of paths to hourly and/or daily dump files (no day may have both, see select_dump_files)
+    titles - an iterable of page titles (spaces or underscores)
+
+    Returns:
+    views_df - a DataFrame with page_title | timestamp | views, the same table get_bulk_pageviews writes
+        (use to_series to get the get_pageviews shape for one title)
+    """
+    titles = frozenset(str(t).replace(' ', '_') for t in titles)
+    dump_files = select_dump_files(dump_files)
+
+    totals = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_dump_worker, initargs=(titles,)) as executor:
+        futures = [executor.submit(_read_dump_in_worker, path, wiki_code) for path in dump_files]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="dump files"):
+            for key, views in future.result().items():
+                totals[key] = totals.get(key, 0) + views
+
+    views_df = pd.DataFrame([[title, date, views] for (title, date), views in totals.items()],
+                            columns=['page_title', 'timestamp', 'views'])
+    views_df['page_title'] = views_df['page_title'].str.replace('_', ' ')
+    views_df = views_df.sort_values(['page_title', 'timestamp']).reset_index(drop=True)
+    views_df['views'] = views_df['views'].astype('int64')
+    return views_df
+
+def main():
+    parent_dir = Path.cwd().parent
+    df = pd.read_csv(parent_dir / args.input, sep="\t", header=0)
+
+    if args.dumps:
+        dump_files = select_dump_files((parent_dir / args.dumps).iterdir(), dump_type=args.dump_type)
+        print(f"Aggregating {len(dump_files)} pageview dump files.")
+        views_df = aggregate_pageview_dumps(dump_files, df[args.title_col].dropna().unique(), max_workers=args.workers)
+        views_df['page_title'] = views_df['page_title'].astype('category')
+        views_df.to_parquet(parent_dir / args.output, index=False)
+        print(f"Saved {len(views_df)} daily pageview rows to {parent_dir / args.output}")
+        return
+
+    windows = pageview_windows(df, title_col=args.title_col, date_col=args.date_col, days_before=args.days_before, days_after=args.days_after)
+    print(f"{len(windows)} pageview windows to collect.")
+
+    get_bulk_pageviews(windows, parent_dir / args.output, cache_file=parent_dir / args.cache, max_workers=args.workers)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', type=str, required=True, help='TSV (relative to the parent directory) with a page title column and an AfD date column.')
+parser.add_argument('--title-col', type=str, default='page_title', help='Column with the page titles.')
+parser.add_argument('--date-col', type=str, default='afd_date', help='Column with the AfD (or pseudo-AfD) dates.')
+parser.add_argument('--days-before', type=int, default=90, help='Days of pageviews to get before the AfD date.')
+parser.add_argument('--days-after', type=int, default=90, help='Days of pageviews to get after the AfD date.')
+parser.add_argument('--output', type=str, default='pageviews.parquet', help='Output parquet file, relative to the parent directory.')
+parser.add_argument('--cache', type=str, default='pageviews_cache.sqlite', help='sqlite response cache, relative to the parent directory.')
+parser.add_argument('--workers', type=int, default=8, help='Number of concurrent requests (or processes, with --dumps).')
+parser.add_argument('--dumps', type=str, default=None, help='Directory of downloaded pageview dump files (relative to the parent directory) to aggregate instead of calling the REST API.')
+parser.add_argument('--dump-type', type=str, default=None, choices=['hourly', 'daily'], help='With --dumps, only aggregate the hourly (pageviews-YYYYMMDD-HH0000) or the daily (pageviews-YYYYMMDD-user) files. Without it, both are used, and a day that has files of both is an error.')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    main()
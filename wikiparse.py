@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+from bs4 import BeautifulSoup
+import concurrent.futures
+import re
+import wikimetrics
+
+# mwparserfromhell is optional; without it, wikitext_to_text falls back to a regex-based strip
+try:
+    import mwparserfromhell
+except ImportError:
+    mwparserfromhell = None
+
+"""
+Single-pass extraction from rendered article HTML.
+wikifunctions.parse_to_text and parse_to_links each build their own soup from the same HTML; extract_page builds it once
+and returns the text, the filtered wikilinks, the external links and the section structure together.
+"""
+
+# same lists as wikifunctions.parse_to_text / parse_to_links
+BAD_SECTIONS = {'See_also', 'Notes', 'References', 'Bibliography', 'External_links'}
+BAD_TITLES = ['Special:', 'Wikipedia:', 'Help:', 'Template:', 'Category:', 'International Standard', 'Portal:', 's:', 'File:', 'Digital object identifier', '(page does not exist)']
+
+# one regex for all the bad title substrings, instead of an all(bad not in title ...) scan per link
+BAD_TITLES_RE = re.compile('|'.join(re.escape(bad) for bad in BAD_TITLES))
+CITATION_RE = re.compile(r'\[[0-9]+\]')
+
+def _heading_id(heading):
+    # older parser output: <h2><span class="mw-headline" id="See_also">; newer: <h2 id="See_also">
+    if heading.get('id'):
+        return heading['id']
+    span = heading.find('span', id=True)
+    if span is not None:
+        return span['id']
+    return None
+
+def _heading_anchor(heading):
+    # newer parser output wraps headings in <div class="mw-heading">, so the section content are siblings of that div
+    parent = heading.parent
+    if parent is not None and parent.name == 'div' and 'mw-heading' in (parent.get('class') or []):
+        return parent
+    return heading
+
+@wikimetrics.timed('parse.extract_page')
+def extract_page(page_html, parse_text=True):
+    """
+    Parses the HTML of a page (or revision) once and pulls out everything we use from it.
+
+    page_html - the HTML string (e.g., json_response['parse']['text'])
+    parse_text - True to return plain text paragraphs (citations removed), False to return the <p> HTML
+
+    Returns:
+    a dictionary with
+        text - the paragraphs joined by newlines, as parse_to_text returns
+        links - the wikilink titles in paragraphs and lists, filtered as parse_to_links does
+            (links in nested lists are only counted once)
+        external_links - the hrefs of all the external links on the page, including the ones in the
+            References and External links sections (which text and links leave out)
+        sections - a list of [level, id, heading text] for the h2/h3 headings, in order
+    """
+    soup = BeautifulSoup(page_html, 'lxml')
+
+    # before the end sections are cleared, since that is where most of the external links are
+    external_links = [a['href'] for a in soup.select('a.external[href]')]
+
+    sections = []
+    for heading in soup.find_all(['h2', 'h3']):
+        section_id = _heading_id(heading)
+        sections.append([int(heading.name[1]), section_id, heading.get_text().strip()])
+
+        # Remove sections at end
+        if heading.name == 'h2' and section_id in BAD_SECTIONS:
+            for sibling in _heading_anchor(heading).find_next_siblings(['div', 'ul']):
+                sibling.clear()
+
+    text_list = []
+    for para in soup.find_all('p'):
+        if parse_text:
+            text_list.append(CITATION_RE.sub('', para.text))
+        else:
+            text_list.append(str(para))
+
+    # Delete tags associated with templates (after the text, as parse_to_text keeps them)
+    for tag in soup.find_all('tr'):
+        tag.decompose()
+
+    links = []
+    for link in soup.select('p a[title], ul li a[title]'):
+        title = link['title']
+        # Ignore links that aren't interesting or are redlinks
+        if BAD_TITLES_RE.search(title) is None and 'redlink' not in link.get('href', ''):
+            links.append(title)
+
+    return {
+        'text': '\n'.join(text_list),
+        'links': links,
+        'external_links': external_links,
+        'sections': sections,
+    }
+
+def extract_pages(page_htmls, parse_text=True, max_workers=None, chunksize=16):
+    """
+    Runs extract_page over many HTML strings across a process pool (parsing is CPU-bound, so threads don't help).
+
+    page_htmls - a list of HTML strings
+    max_workers - number of processes, defaults to the number of CPUs
+
+    Returns:
+    a list of extract_page dictionaries, in the same order as page_htmls
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(extract_page, page_htmls, [parse_text] * len(page_htmls), chunksize=chunksize))
+
+"""
+Local wikitext -> plain text, so that revisions fetched as wikitext don't all have to be rendered by action=parse.
+This is an approximation of the rendered text (templates are dropped, not expanded).
+"""
+COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+REF_RE = re.compile(r'<ref[^>/]*/>|<ref[^>]*>.*?</ref>', re.DOTALL | re.IGNORECASE)
+TEMPLATE_RE = re.compile(r'\{\{[^{}]*\}\}')
+TABLE_RE = re.compile(r'\{\|.*?\|\}', re.DOTALL)
+FILE_LINK_RE = re.compile(r'\[\[(?:File|Image|Category):[^\[\]]*(?:\[\[[^\[\]]*\]\][^\[\]]*)*\]\]', re.IGNORECASE)
+PIPED_LINK_RE = re.compile(r'\[\[[^\[\]|]*\|([^\[\]]*)\]\]')
+LINK_RE = re.compile(r'\[\[([^\[\]]*)\]\]')
+EXTERNAL_LINK_RE = re.compile(r'\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]')
+HEADING_RE = re.compile(r'^=+\s*(.*?)\s*=+\s*$', re.MULTILINE)
+TAG_RE = re.compile(r'<[^>]+>')
+QUOTES_RE = re.compile(r"'{2,}")
+
+@wikimetrics.timed('parse.wikitext_to_text')
+def wikitext_to_text(wikitext):
+    """
+    Converts wikitext to plain text locally. Uses mwparserfromhell's strip_code if it is installed,
+    otherwise a regex-based strip of comments, refs, templates, tables, files/categories, links and formatting.
+    """
+    if not isinstance(wikitext, str) or not wikitext:
+        return str()
+
+    if mwparserfromhell is not None:
+        text = mwparserfromhell.parse(wikitext).strip_code()
+    else:
+        text = COMMENT_RE.sub('', wikitext)
+        text = REF_RE.sub('', text)
+        # templates can nest, so strip the innermost ones until none are left
+        while True:
+            text, n = TEMPLATE_RE.subn('', text)
+            if n == 0:
+                break
+        text = TABLE_RE.sub('', text)
+        text = FILE_LINK_RE.sub('', text)
+        text = PIPED_LINK_RE.sub(r'\1', text)
+        text = LINK_RE.sub(r'\1', text)
+        text = EXTERNAL_LINK_RE.sub(r'\1', text)
+        text = HEADING_RE.sub(r'\1', text)
+        text = TAG_RE.sub('', text)
+        text = QUOTES_RE.sub('', text)
+
+    # collapse the blank lines that stripping leaves behind
+    return '\n'.join(line.strip() for line in text.splitlines() if line.strip())
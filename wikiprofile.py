@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import cProfile
+import pstats
+import tracemalloc
+import random
+import time
+import io
+from pathlib import Path
+
+"""
+Profiling for the stage scripts' --profile option: runs one sampled chunk under cProfile and tracemalloc and writes
+a report that splits the time between network wait, HTML/wikitext parsing, pandas/numpy work, sleeping (rate limits
+and backoff) and everything else, so it is clear whether the next bottleneck is I/O or CPU.
+
+Time is attributed by each function's own time (tottime), by the module the function lives in; C functions
+(socket reads, lxml's parser) are attributed by their names.
+"""
+
+CATEGORIES = {
+    'network': ['requests', 'urllib3', 'socket', 'ssl', 'http/client', 'http\\client', '_socket', '_ssl', 'select', 'poll'],
+    'parsing': ['bs4', 'lxml', 'html5lib', 'html/parser', 'html\\parser', '_markupbase', 'mwparserfromhell', 'soupsieve'],
+    'pandas': ['pandas', 'numpy', 'pyarrow'],
+    'sleep': ['time.sleep'],
+}
+
+def categorize(filename, function_name):
+    """
+    Returns the category of a profiled function: network, parsing, pandas, sleep or other.
+    """
+    # built-in functions have filename '~' and a name like "<method 'recv_into' of '_socket.socket' objects>"
+    where = function_name if filename == '~' else filename
+    for category in ['sleep', 'network', 'parsing', 'pandas']:
+        if any(marker in where for marker in CATEGORIES[category]):
+            return category
+    return 'other'
+
+def category_breakdown(stats):
+    """
+    Sums the own time of every profiled function by category.
+
+    stats - a pstats.Stats
+
+    Returns:
+    a dictionary category -> seconds
+    """
+    totals = {category: 0.0 for category in ['network', 'parsing', 'pandas', 'sleep', 'other']}
+    for (filename, lineno, function_name), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+        totals[categorize(filename, function_name)] += tottime
+    return totals
+
+def sample_items(items, n, seed=0):
+    """
+    A reproducible random sample of n items (all of them if there are fewer), in their original order.
+    """
+    items = list(items)
+    if len(items) <= n:
+        return items
+    rng = random.Random(seed)
+    keep = sorted(rng.sample(range(len(items)), n))
+    return [items[i] for i in keep]
+
+def profile_call(func, *args, output_prefix, top=30, **kwargs):
+    """
+    Runs func(*args, **kwargs) under cProfile and tracemalloc and writes
+        {output_prefix}.prof - the raw profile (open with pstats or snakeviz)
+        {output_prefix}_report.txt - the category breakdown, the top functions by own and cumulative time,
+            and the top allocation sites
+
+    Returns:
+    result - what func returned
+    """
+    output_prefix = Path(output_prefix)
+    output_prefix.parent.mkdir(parents=True, exist_ok=True)
+
+    profiler = cProfile.Profile()
+    tracemalloc.start(10)
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    profiler.dump_stats(f"{output_prefix}.prof")
+
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    breakdown = category_breakdown(stats)
+    total = sum(breakdown.values()) or 1.0
+
+    report.write(f"Wall time: {wall:.1f}s; peak traced memory: {peak / 2**20:.1f} MiB\n\n")
+    report.write("Own time by category:\n")
+    for category, seconds in sorted(breakdown.items(), key=lambda item: -item[1]):
+        report.write(f"  {category:<8} {seconds:10.2f}s  {100 * seconds / total:5.1f}%\n")
+
+    report.write(f"\nTop {top} functions by own time:\n")
+    stats.sort_stats('tottime').print_stats(top)
+    report.write(f"\nTop {top} functions by cumulative time:\n")
+    stats.sort_stats('cumulative').print_stats(top)
+
+    report.write(f"\nTop {top} allocation sites (still allocated at the end of the run):\n")
+    for stat in snapshot.statistics('lineno')[:top]:
+        report.write(f"  {stat}\n")
+
+    with open(f"{output_prefix}_report.txt", "w") as f:
+        f.write(report.getvalue())
+
+    print(f"Wall time: {wall:.1f}s. " + ", ".join(f"{c} {100 * s / total:.0f}%" for c, s in breakdown.items()))
+    print(f"Profile written to {output_prefix}.prof and {output_prefix}_report.txt")
+    return result
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import numpy as np
+from pathlib import Path
+from tqdm import tqdm
+import concurrent.futures
+import threading
+import sqlite3
+import hashlib
+import json
+import time
+import os
+import io
+import csv
+import argparse
+import wikihelpers as wiki
+
+"""
+Local stores built from the files the stage scripts write.
+
+The revision store puts every page's revision history (./revisions/{title}_revisions.tsv) into one parquet table,
+sorted by (pageid, timestamp), so that "what did this page look like at time t" can be answered for millions of
+(pageid, timestamp) pairs in one vectorized call instead of filtering each page's DataFrame.
+"""
+
+REVISION_COLUMNS = ['pageid', 'page', 'revid', 'timestamp', 'user', 'size']
+
+def _utc_naive(timestamps):
+    # tz-aware Series convert to numpy as object arrays, which is slow; go through naive UTC instead
+    return timestamps.dt.tz_convert(None).to_numpy(dtype='datetime64[ns]')
+
+def _read_revision_file(path):
+    df = pd.read_csv(path, sep="\t", header=0, usecols=lambda c: c in {'page', 'revid', 'timestamp', 'user', 'size'})
+    return df
+
+def build_revision_store(revisions_dir, output_file, title_to_pageid=None, max_workers=8):
+    """
+    Combines the per-page revision files into one parquet revision store.
+
+    revisions_dir - the directory with the {title}_revisions.tsv files
+    output_file - the parquet file to write
+    title_to_pageid - a dictionary (or Series) mapping page titles (the `page` column) to pageids,
+        e.g., from the returned_title | pageid columns of the case metadata chunks. Titles are compared in their
+        canonical form (wikihelpers.canonical_titles). Pages not in it are dropped. If None, pages get sequential integer ids instead.
+
+    Returns:
+    df - the store, sorted by pageid then timestamp, with cumulative rev_count and editor_count per page
+    """
+    files = sorted(Path(revisions_dir).glob("*_revisions.tsv"))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(tqdm(executor.map(_read_revision_file, files), total=len(files), desc="revision files"))
+    df = pd.concat(frames, ignore_index=True)
+
+    if title_to_pageid is None:
+        df['pageid'] = pd.factorize(df['page'], sort=True)[0]
+    else:
+        # match on canonical titles, computed once per page rather than once per revision
+        page_codes, pages = pd.factorize(df['page'])
+        title_to_pageid = pd.Series(title_to_pageid)
+        lookup = pd.Series(title_to_pageid.to_numpy(), index=wiki.canonical_titles(title_to_pageid.index).to_numpy())
+        lookup = lookup[lookup.index.notna() & ~lookup.index.duplicated()]
+        page_pageids = lookup.reindex(wiki.canonical_titles(pages).to_numpy()).to_numpy(dtype='float64')
+        df['pageid'] = np.append(page_pageids, np.nan)[page_codes]
+        missing = df['pageid'].isna()
+        if missing.any():
+            print(f"Dropping {df.loc[missing, 'page'].nunique()} pages with no pageid.")
+        df = df[~missing]
+    df['pageid'] = df['pageid'].astype('int64')
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+
+    df = df[REVISION_COLUMNS].sort_values(['pageid', 'timestamp'], kind='stable').reset_index(drop=True)
+
+    # cumulative counts as of each revision
+    df['rev_count'] = df.groupby('pageid').cumcount() + 1
+    first_edit = ~df.duplicated(subset=['pageid', 'user'])
+    df['editor_count'] = first_edit.astype('int64').groupby(df['pageid']).cumsum()
+
+    df.to_parquet(output_file, index=False)
+    print(f"Saved {len(df)} revisions for {df['pageid'].nunique()} pages to {output_file}")
+    return df
+
+class RevisionStore:
+    """
+    As-of queries over a revision store written by build_revision_store.
+
+    The rows are sorted by (pageid, timestamp). Each page's rows start at an offset; adding page_index * span to
+    each revision's time (in seconds since the earliest revision) gives one globally sorted key, so a single
+    numpy.searchsorted finds the revision in effect for every (pageid, timestamp) pair at once.
+    """
+    def __init__(self, store_file):
+        self.df = pd.read_parquet(store_file)
+
+        pageids = self.df['pageid'].to_numpy(dtype='int64')
+        self.rev_timestamps = _utc_naive(self.df['timestamp'])
+        seconds = self.rev_timestamps.astype('datetime64[s]').astype('int64')
+
+        self.page_keys, self.offsets = np.unique(pageids, return_index=True)
+        self.t0 = seconds.min() if len(seconds) else 0
+        self.span = int(seconds.max() - self.t0 + 2) if len(seconds) else 1
+
+        page_index = np.repeat(np.arange(len(self.page_keys)), np.diff(np.append(self.offsets, len(pageids))))
+        self.keys = page_index * self.span + (seconds - self.t0)
+
+        # plain numpy columns, so lookups are fancy indexing rather than pandas .iloc
+        self.columns = {c: self.df[c].fillna(0).to_numpy(dtype='int64') for c in ['revid', 'size', 'rev_count', 'editor_count']}
+
+    def as_of(self, pageids, timestamps):
+        """
+        Finds the revision in effect for each (pageid, timestamp) pair: the last revision at or before the timestamp.
+
+        pageids - an array-like of pageids
+        timestamps - an array-like of timestamps (strings, datetimes; naive ones are treated as UTC)
+
+        Returns:
+        df - a DataFrame with one row per pair: pageid | as_of | revid | rev_timestamp | size | rev_count | editor_count,
+            with missing values where the page isn't in the store or the timestamp is before its first revision
+        """
+        pageids = np.asarray(pageids, dtype='int64')
+        as_of = pd.to_datetime(pd.Series(timestamps), utc=True).reset_index(drop=True)
+        seconds = _utc_naive(as_of).astype('datetime64[s]').astype('int64')
+
+        if len(self.page_keys) == 0:
+            # an empty store has no revision in effect for any pair (and no rows to index into)
+            result = pd.DataFrame({'pageid': pageids, 'as_of': as_of})
+            none_found = np.ones(len(pageids), dtype=bool)
+            result['revid'] = pd.arrays.IntegerArray(np.zeros(len(pageids), dtype='int64'), none_found)
+            result['rev_timestamp'] = pd.to_datetime(np.full(len(pageids), np.datetime64('NaT'), dtype='datetime64[ns]'), utc=True)
+            for column in ['size', 'rev_count', 'editor_count']:
+                result[column] = pd.arrays.IntegerArray(np.zeros(len(pageids), dtype='int64'), none_found)
+            return result
+
+        page_pos = np.searchsorted(self.page_keys, pageids)
+        page_pos_clipped = np.minimum(page_pos, len(self.page_keys) - 1)
+        found_page = (page_pos < len(self.page_keys)) & (self.page_keys[page_pos_clipped] == pageids)
+
+        # times before the earliest revision go to -1 (before every row of the page); later ones to the end of the page
+        relative = np.clip(seconds - self.t0, -1, self.span - 1)
+        query_keys = page_pos_clipped * self.span + relative
+        rows = np.searchsorted(self.keys, query_keys, side='right') - 1
+
+        valid = found_page & (rows >= self.offsets[page_pos_clipped])
+        rows = np.where(valid, rows, 0)
+
+        result = pd.DataFrame({'pageid': pageids, 'as_of': as_of})
+        rev_timestamp = self.rev_timestamps[rows]
+        rev_timestamp[~valid] = np.datetime64('NaT')
+        result['revid'] = pd.arrays.IntegerArray(self.columns['revid'][rows], ~valid)
+        result['rev_timestamp'] = pd.to_datetime(rev_timestamp, utc=True)
+        for column in ['size', 'rev_count', 'editor_count']:
+            result[column] = pd.arrays.IntegerArray(self.columns[column][rows], ~valid)
+        return result
+
+"""
+partitioned parquet datasets: one directory per table, one file per partition, read back with pd.read_parquet(directory)
+"""
+def write_partition(df, dataset_dir, name):
+    """
+    Writes one partition of a dataset. The file is written under a temporary name and renamed when complete,
+    so a partition that exists is always whole, and existing partitions can be skipped on a rerun.
+    """
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    final_path = dataset_dir / f"{name}.parquet"
+    tmp_path = dataset_dir / f".{name}.parquet.tmp"
+    df.to_parquet(tmp_path, index=False)
+    tmp_path.replace(final_path)
+    return final_path
+
+def partition_exists(dataset_dir, name):
+    return (Path(dataset_dir) / f"{name}.parquet").exists()
+
+"""
+atomic, checksummed result files: a crash never leaves a truncated file that looks finished
+"""
+def atomic_write_bytes(path, data):
+    """
+    Writes data to path through a temporary file in the same directory that is fsynced and then renamed over path,
+    so path is either the old file or the whole new one.
+
+    Returns:
+    the sha256 of data
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    tmp_path.replace(path)
+    return hashlib.sha256(data).hexdigest()
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _valid_tsv(path):
+    # a file cut short mid-row still parses with pandas (the missing fields become NaN), so check that it ends with
+    # a newline and that every row has as many fields as the header
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return False
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                return False
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            rows = csv.reader(f, delimiter="\t")
+            n_fields = len(next(rows))
+            return all(len(row) == n_fields for row in rows)
+    except Exception:
+        return False
+
+def _valid_json(path):
+    try:
+        with open(path, "r") as f:
+            json.load(f)
+        return True
+    except Exception:
+        return False
+
+VALIDATORS = {'.tsv': _valid_tsv, '.json': _valid_json}
+
+# the stage 1 chunk files in case_meta_data: chunk_XXXX.tsv, and chunk_stream_XXXXX.tsv from 1_get_case_data.py --stream
+CHUNK_PATTERN = "chunk_*.tsv"
+
+class ResultWriter:
+    """
+    Buffered writer for the files of one output directory (chunk files, per-case JSON).
+
+    put() buffers a file; every batch_size files (and on flush() / leaving a `with` block) the buffered files are
+    written with atomic_write_bytes and their sha256 and size are committed to the directory's _manifest.sqlite in one
+    transaction. A file only counts as written (is_done) if it is in the manifest with the size on disk, so a file
+    written before a crash but not yet committed, or cut short, is written again on resume.
+
+    The first time a writer with a given `pattern` opens a directory, the files already in it that match the pattern
+    (from runs before the writer existed) are adopted if they parse (.tsv with pandas, .json with json); the ones
+    that don't are left out. Several writers (e.g., stage 1 and stage 1.5 in case_meta_data) can share a manifest.
+    Safe to share between threads.
+    """
+    def __init__(self, output_dir, pattern="*", batch_size=50):
+        self.output_dir = Path(output_dir)
+        self.pattern = pattern
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.buffer = {}
+
+        self.conn = sqlite3.connect(str(self.output_dir / "_manifest.sqlite"), check_same_thread=False, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, written REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS adopted (pattern TEXT PRIMARY KEY)")
+        self.conn.commit()
+        self.sizes = dict(self.conn.execute("SELECT name, size FROM files"))
+        if self.conn.execute("SELECT 1 FROM adopted WHERE pattern = ?", (pattern,)).fetchone() is None:
+            self.adopt_existing()
+
+    def adopt_existing(self):
+        """
+        Records the files already in the directory that parse, and returns the names of the ones that don't.
+        """
+        paths = [p for p in self.output_dir.glob(self.pattern) if p.is_file() and not p.name.startswith(('.', '_'))]
+        rows, bad = [], []
+        paths = [p for p in paths if p.name not in self.sizes]
+        for path in tqdm(paths, desc=f"checking {self.output_dir.name}", disable=len(paths) < 1000):
+            validate = VALIDATORS.get(path.suffix)
+            if validate is not None and not validate(path):
+                bad.append(path.name)
+                continue
+            rows.append((path.name, _file_sha256(path), path.stat().st_size, time.time()))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO files (name, sha256, size, written) VALUES (?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO adopted (pattern) VALUES (?)", (self.pattern,))
+            self.conn.commit()
+            self.sizes.update({name: size for name, _, size, _ in rows})
+        if bad:
+            print(f"{len(bad)} files in {self.output_dir} don't parse and will be written again, e.g. {bad[:5]}")
+        return bad
+
+    def put(self, name, content):
+        """
+        Buffers the file `name` (str or bytes content); it is written at the next flush.
+        """
+        data = content.encode("utf-8") if isinstance(content, str) else content
+        with self.lock:
+            self.buffer[name] = data
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def write_df(self, name, df, **to_csv_kwargs):
+        """
+        Writes a DataFrame as a tab-separated file right away (e.g., a chunk file, which marks the chunk as done).
+        """
+        text = df.to_csv(sep="\t", index=False, header=True, **to_csv_kwargs)
+        with self.lock:
+            self.buffer[name] = text.encode("utf-8")
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
+            rows = []
+            for name, data in self.buffer.items():
+                sha = atomic_write_bytes(self.output_dir / name, data)
+                rows.append((name, sha, len(data), time.time()))
+            # make the renames durable before the manifest says the files are there
+            dir_fd = os.open(self.output_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            except OSError:
+                pass
+            finally:
+                os.close(dir_fd)
+            self.conn.executemany("INSERT OR REPLACE INTO files (name, sha256, size, written) VALUES (?, ?, ?, ?)", rows)
+            self.conn.commit()
+            self.sizes.update({name: size for name, _, size, _ in rows})
+            self.buffer.clear()
+
+    def is_done(self, name):
+        """
+        True if the file was written completely: it is buffered, or it is in the manifest with the size on disk.
+        """
+        with self.lock:
+            if name in self.buffer:
+                return True
+            size = self.sizes.get(name)
+        if size is None:
+            return False
+        path = self.output_dir / name
+        return path.exists() and path.stat().st_size == size
+
+    def verify(self, checksums=False):
+        """
+        Checks every file in the manifest (size, and the sha256 too if checksums is True) and drops the ones that
+        are missing or don't match from the manifest, so they are written again.
+
+        Returns:
+        the names of the files that failed
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT name, sha256, size FROM files").fetchall()
+        bad = []
+        for name, sha, size in tqdm(rows, desc=f"verifying {self.output_dir.name}", disable=len(rows) < 1000):
+            path = self.output_dir / name
+            if not path.exists() or path.stat().st_size != size or (checksums and _file_sha256(path) != sha):
+                bad.append(name)
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE name = ?", [(name,) for name in bad])
+            self.conn.commit()
+            for name in bad:
+                self.sizes.pop(name, None)
+        if bad:
+            print(f"{len(bad)} files in {self.output_dir} are incomplete or changed and will be written again, e.g. {bad[:5]}")
+        return bad
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def discard_outputs(output_dir, pattern):
+    """
+    Deletes the files of output_dir that match pattern and drops them from the directory's manifest, so that a stage
+    that skips the files it already wrote (e.g., chunk files) starts over instead of keeping stale ones.
+
+    Returns:
+    n - the number of files deleted
+    """
+    output_dir = Path(output_dir)
+    paths = [p for p in output_dir.glob(pattern) if p.is_file() and not p.name.startswith(('.', '_'))]
+    if (output_dir / "_manifest.sqlite").exists():
+        conn = sqlite3.connect(str(output_dir / "_manifest.sqlite"), timeout=60)
+        conn.executemany("DELETE FROM files WHERE name = ?", [(p.name,) for p in paths])
+        conn.commit()
+        conn.close()
+    for path in paths:
+        path.unlink()
+    return len(paths)
+
+"""
+title index: canonical title -> integer key -> pageid, kept across runs
+"""
+class TitleIndex:
+    """
+    Gives every canonical title (see wikihelpers.canonical_titles) a stable integer key, and keeps the pageid of the
+    titles whose pageid is known. Tables with titles in any of their forms (case titles, chunk page_title /
+    returned_title, "Wikipedia:Articles for deletion/..." pages, revision `page`) get a key column with keys_for,
+    and are then merged on the integer key instead of on strings.
+
+    The index is a sqlite table, loaded into memory when it is opened.
+    """
+    def __init__(self, index_file):
+        self.conn = sqlite3.connect(str(index_file))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS titles (key INTEGER PRIMARY KEY, title TEXT UNIQUE, pageid INTEGER)")
+        self.conn.commit()
+        table = pd.read_sql_query("SELECT key, title, pageid FROM titles", self.conn)
+        self.keys = pd.Series(table['key'].to_numpy(dtype='int64'), index=table['title'].astype(wiki.TITLE_DTYPE))
+        self.pageids = pd.Series(pd.array(table['pageid'], dtype='Int64'), index=table['key'].to_numpy(dtype='int64'))
+
+    def keys_for(self, titles, add=True):
+        """
+        The key of each title. With add=True, titles not in the index yet get new keys (and are saved).
+
+        Returns:
+        an Int64 array of keys, in the order of titles, missing for missing titles (and, with add=False, unknown ones)
+        """
+        codes, uniques = pd.factorize(wiki.canonical_titles(titles))
+        found = self.keys.reindex(uniques)
+        if add and found.isna().any():
+            new_titles = uniques[found.isna().to_numpy()]
+            next_key = int(self.keys.max()) + 1 if len(self.keys) else 1
+            new_keys = np.arange(next_key, next_key + len(new_titles), dtype='int64')
+            self.conn.executemany("INSERT INTO titles (key, title) VALUES (?, ?)", zip(new_keys.tolist(), [str(t) for t in new_titles]))
+            self.conn.commit()
+            self.keys = pd.concat([self.keys, pd.Series(new_keys, index=pd.Index(new_titles, dtype=wiki.TITLE_DTYPE))])
+            self.pageids = pd.concat([self.pageids, pd.Series(pd.array([pd.NA] * len(new_keys), dtype='Int64'), index=new_keys)])
+            found = self.keys.reindex(uniques)
+        # codes are -1 for missing titles
+        unique_keys = np.append(found.to_numpy(dtype='float64'), np.nan)
+        return pd.array(unique_keys[codes], dtype='Int64')
+
+    def set_pageids(self, titles, pageids):
+        """
+        Records the pageid of each title (non-numeric pageids, e.g. "REDIRECTED", are skipped).
+        """
+        pageids = pd.to_numeric(pd.Series(pageids).reset_index(drop=True), errors='coerce')
+        keys = pd.Series(self.keys_for(titles))
+        known = keys.notna() & pageids.notna()
+        rows = pd.DataFrame({'key': keys[known].astype('int64'), 'pageid': pageids[known].astype('int64')}).drop_duplicates('key', keep='last')
+        self.conn.executemany("UPDATE titles SET pageid = ? WHERE key = ?", zip(rows['pageid'].tolist(), rows['key'].tolist()))
+        self.conn.commit()
+        self.pageids.loc[rows['key'].to_numpy()] = rows['pageid'].to_numpy()
+        return len(rows)
+
+    def pageids_for(self, titles):
+        """
+        Returns:
+        an Int64 array of the pageid of each title, missing where it isn't known
+        """
+        keys = pd.Series(self.keys_for(titles, add=False))
+        return pd.array(self.pageids.reindex(keys.fillna(-1).astype('int64')).to_numpy(), dtype='Int64')
+
+    def close(self):
+        self.conn.close()
+
+def build_title_index(meta_dir, index_file):
+    """
+    Builds (or updates) the title index from the stage 1 chunk files: the case titles and the returned titles get
+    keys, and the returned titles (and the case titles of pages that exist under their own title) get their pageids.
+    """
+    chunks = [pd.read_csv(f, sep="\t", header=0) for f in sorted(Path(meta_dir).glob(CHUNK_PATTERN))]
+    meta_df = pd.concat(chunks, ignore_index=True)
+    index = TitleIndex(index_file)
+    index.keys_for(meta_df['page_title'])
+    n = index.set_pageids(meta_df['returned_title'], meta_df['pageid'])
+    exists = meta_df['page_exists'] == True
+    index.set_pageids(meta_df.loc[exists, 'page_title'], meta_df.loc[exists, 'pageid'])
+    print(f"Title index {index_file}: {len(index.keys)} titles, {int(index.pageids.notna().sum())} with pageids ({n} from this update)")
+    return index
+
+def main():
+    parent_dir = Path.cwd().parent
+
+    title_to_pageid = None
+    if args.pageids:
+        chunks = [pd.read_csv(f, sep="\t", header=0) for f in sorted((parent_dir / args.pageids).glob(CHUNK_PATTERN))]
+        meta_df = pd.concat(chunks, ignore_index=True)
+        meta_df = meta_df[pd.to_numeric(meta_df['pageid'], errors='coerce').notna()]
+        title_to_pageid = meta_df.drop_duplicates('returned_title').set_index('returned_title')['pageid'].astype('int64')
+
+    if args.title_index:
+        if not args.pageids:
+            raise ValueError("--title-index needs the chunk files to build from; give them with --pageids")
+        index = build_title_index(parent_dir / args.pageids, parent_dir / args.title_index)
+        index.close()
+        return
+
+    build_revision_store(parent_dir / "revisions", parent_dir / args.output, title_to_pageid=title_to_pageid)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--output', type=str, default='revision_store.parquet', help='Revision store to write, relative to the parent directory.')
+parser.add_argument('--pageids', type=str, default=None, help='Directory with the stage 1 chunk_*.tsv files (e.g., case_meta_data) to take pageids from.')
+parser.add_argument('--title-index', type=str, default=None, help='Build or update this title index (sqlite, relative to the parent directory) from the --pageids chunk files, instead of the revision store.')
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    main()